@@ -696,6 +696,9 @@ def main(argv=None):
     if args.append:
         args.log.info("Reindexing the detectid column")
         tableMain.cols.detectid.reindex()
+        tableMain.cols.shotid.reindex()
+        tableMain.cols.wave.reindex()
+        tableMain.cols.sn.reindex()
         tableFibers.cols.detectid.reindex()
         tableSpectra.cols.detectid.reindex()
         tableFibers.flush()  # just to be safe
@@ -703,6 +706,10 @@ def main(argv=None):
         tableMain.flush()
     else:
         tableMain.cols.detectid.create_csindex()
+        # index the common query columns for Detections(query=...)
+        tableMain.cols.shotid.create_csindex()
+        tableMain.cols.wave.create_csindex()
+        tableMain.cols.sn.create_csindex()
         tableFibers.cols.detectid.create_csindex()
         tableSpectra.cols.detectid.create_csindex()
         tableFibers.flush()  # just to be safe
@@ -13,18 +13,21 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import sys
+import os
 import os.path as op
+import hashlib
 import numpy as np
 import tables as tb
 import copy
+import warnings
 
-np.warnings.filterwarnings("ignore")
+warnings.filterwarnings("ignore")
 
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
-from astropy.table import vstack, Table, Column, join
+from astropy.table import vstack, Table, Column
 import astropy.units as u
 from astropy.coordinates import SkyCoord
 from astropy.io import ascii
@@ -46,10 +49,74 @@ except Exception as e:
     print("Warning! Cannot find or import HDRconfig from hetdex_api!!", e)
     LATEST_HDR_NAME = "hdr2.1"
 
+# bump this when the refine() masking code changes to
+# invalidate any masks cached on disk
+REFINE_CACHE_VERSION = 1
+
+
+def query_string_from_limits(limits):
+    """
+    Convert a query_by_dictionary() limits object into a
+    PyTables condition for the Detections(query=...) option,
+    so only candidate rows are read from the HDF5 file.
+
+    The aperture search is reduced to a declination band
+    and, when aperture_flag is False, the field selection
+    should be passed as Detections(field=limits.field).
+    The condition may keep a few detections right on a
+    limit, as PyTables compares the float32 columns in
+    double precision, so query_by_dictionary() should
+    still be applied to the result for the exact cut.
+
+    Parameters
+    ----------
+    limits
+        a Det_limits style object (see query_by_dictionary)
+
+    Returns
+    -------
+    query : string or None
+        the condition string, None if nothing to select on
+
+    Examples
+    --------
+    query = query_string_from_limits(limits)
+    detects = Detections(query=query, field=limits.field)
+    detects = detects[detects.query_by_dictionary(limits)]
+    """
+
+    bounds = [
+        ("wave", "wave_low", "wave_high"),
+        ("flux", "flux_low", "flux_high"),
+        ("linewidth", "linewidth_low", "linewidth_high"),
+        ("sn", "sn_low", "sn_high"),
+        ("chi2", "chi2_low", "chi2_high"),
+        ("continuum", "cont_low", "cont_high"),
+    ]
+
+    conditions = []
+    for colname, low, high in bounds:
+        if getattr(limits, low, None) is not None:
+            conditions.append("({:s} > {!r})".format(colname, float(getattr(limits, low))))
+        if getattr(limits, high, None) is not None:
+            conditions.append("({:s} < {!r})".format(colname, float(getattr(limits, high))))
+
+    if getattr(limits, "aperture_flag", False):
+        # rad is in arcmin
+        rad_deg = limits.rad / 60.0
+        conditions.append("(dec > {!r})".format(float(limits.dec - rad_deg)))
+        conditions.append("(dec < {!r})".format(float(limits.dec + rad_deg)))
+
+    if len(conditions) > 0:
+        return " & ".join(conditions)
+    else:
+        return None
+
     
 class Detections:
     def __init__(self, survey=LATEST_HDR_NAME, catalog_type="lines",
-                 curated_version=None, loadtable=True):
+                 curated_version=None, loadtable=True, columns=None,
+                 query=None, field=None):
         """
         Initialize the detection catalog class for a given data release
 
@@ -64,6 +131,19 @@ class Detections:
         load_table : bool
            Boolean flag to load all detection table info upon initialization.
            For example, if you just want to grab a spectrum this isn't needed.
+        columns : list of strings
+           Only load these columns of the Detections and Elixer tables.
+           detectid, shotid, ra and dec are always loaded. Default is
+           to load every column.
+        query : string
+           PyTables condition, e.g. '(wave > 3600) & (sn > 5.5)', that
+           is evaluated in the HDF5 scan (using any column indexes) so
+           only matching rows are read into memory. See
+           query_string_from_limits() to build one from a
+           query_by_dictionary limits object.
+        field : list of strings
+           Only load detections in shots from these survey fields,
+           e.g. ['dex-spring', 'dex-fall']
         
         """
         survey_options = ["hdr1", "hdr2", "hdr2.1"]
@@ -80,6 +160,8 @@ class Detections:
             return None
 
         # store to class
+        self._query_mode = (columns is not None or query is not None
+                            or field is not None)
         if curated_version is not None:
             self.version = curated_version
             self.loadtable = False
@@ -134,7 +216,12 @@ class Detections:
                 return None
 
         elif self.loadtable:
-            colnames = self.hdfile.root.Detections.colnames
+            if self._query_mode:
+                # only the matching rows and requested columns
+                self._read_query(columns, query, field)
+                colnames = []
+            else:
+                colnames = self.hdfile.root.Detections.colnames
             for name in colnames:
                 if isinstance(
                     getattr(self.hdfile.root.Detections.cols, name)[0], np.bytes_
@@ -150,7 +237,10 @@ class Detections:
                     )
 
             # add in the elixer probabilties and associated info:
-            if self.survey == "hdr1" and catalog_type=='lines':
+            if self._query_mode:
+                # the Elixer columns were read by _read_query()
+                pass
+            elif self.survey == "hdr1" and catalog_type=='lines':
 
                 self.hdfile_elix = tb.open_file(config.elixerh5, mode="r")
                 colnames2 = self.hdfile_elix.root.Classifications.colnames
@@ -221,40 +311,50 @@ class Detections:
 
             S = Survey(self.survey)
 
-            for index, shot in enumerate(S.shotid):
-                ix = np.where(self.shotid == shot)
-                self.field[ix] = S.field[index].astype(str)
-                # NOTE: python2 to python3 strings now unicode
-                if self.survey == 'hdr1':
-                    self.fwhm[ix] = S.fwhm_moffat[index]
-                    self.fluxlimit_4550[ix] = S.fluxlimit_4550[index] 
-                else:
-                    self.fwhm[ix] = S.fwhm_virus[index]
-                try:
-                    self.fluxlimit_4540[ix] = S.fluxlimit_4540[index]
-                except:
-                    pass
-                self.throughput[ix] = S.response_4540[index]
-                self.n_ifu[ix] = S.n_ifu[index]
-
-                # assign a vis_class field for future classification
-                # -2 = ignore (bad detectid, shot)
-                # -1 = no assignemnt
-                # 0 = artifact
-                # 1 = OII emitter
-                # 2 = LAE emitter
-                # 3 = star
-                # 4 = nearby galaxies (HBeta, OIII usually)
-                # 5 = other line
+            # join the per-shot survey info onto the detections with a
+            # sorted search on shotid instead of looping over every shot
+            survey_sort = np.argsort(S.shotid)
+            pos = np.searchsorted(S.shotid, self.shotid, sorter=survey_sort)
+            pos = np.clip(pos, 0, np.size(S.shotid) - 1)
+            survey_idx = survey_sort[pos]
+
+            ix = S.shotid[survey_idx] == self.shotid
+            survey_idx = survey_idx[ix]
+
+            # NOTE: python2 to python3 strings now unicode
+            self.field[ix] = S.field[survey_idx].astype(str)
+            if self.survey == 'hdr1':
+                self.fwhm[ix] = S.fwhm_moffat[survey_idx]
+                self.fluxlimit_4550[ix] = S.fluxlimit_4550[survey_idx]
+            else:
+                self.fwhm[ix] = S.fwhm_virus[survey_idx]
+            try:
+                self.fluxlimit_4540[ix] = S.fluxlimit_4540[survey_idx]
+            except:
+                pass
+            self.throughput[ix] = S.response_4540[survey_idx]
+            self.n_ifu[ix] = S.n_ifu[survey_idx]
+
+            # assign a vis_class field for future classification
+            # -2 = ignore (bad detectid, shot)
+            # -1 = no assignemnt
+            # 0 = artifact
+            # 1 = OII emitter
+            # 2 = LAE emitter
+            # 3 = star
+            # 4 = nearby galaxies (HBeta, OIII usually)
+            # 5 = other line
             # close the survey HDF5 file
             S.close()
 
             self.vis_class = -1 * np.ones(np.size(self.detectid))
 
-            if self.survey == "hdr1":
+            if self.survey == "hdr1" and self._query_mode:
+                print("Query mode does not load the hdr1 gmag and plae pickles")
+            elif self.survey == "hdr1":
                 self.add_hetdex_gmag(loadpickle=True, picklefile=config.gmags)
             
-            if self.survey == "hdr1":
+            if self.survey == "hdr1" and not self._query_mode:
                 if PYTHON_MAJOR_VERSION < 3:
                     self.plae_poii_hetdex_gmag = np.array(
                         pickle.load(open(config.plae_poii_hetdex_gmag, "rb"))
@@ -276,6 +376,79 @@ class Detections:
         self.coords = SkyCoord(self.ra * u.degree, self.dec * u.degree, frame="icrs")
 
             
+    def _read_query(self, columns, query, field):
+        """
+        Read only the rows matching query and field, and only
+        the requested columns, of the Detections table and
+        the row-aligned Elixer table
+        """
+        table = self.hdfile.root.Detections
+
+        # None means every row, so whole columns can be read directly
+        rows = None
+        if query is not None:
+            rows = table.get_where_list(query, sort=True)
+
+        if field is not None and "all" not in field:
+            S = Survey(self.survey)
+            field_shots = S.shotid[np.isin(S.field, field)]
+            S.close()
+
+            shotid = table.col("shotid")
+            if rows is None:
+                rows = np.where(np.isin(shotid, field_shots))[0]
+            else:
+                rows = rows[np.isin(shotid[rows], field_shots)]
+
+        self._set_table_columns(table, rows, columns)
+
+        if self.survey == "hdr1":
+            print("Query mode does not load the hdr1 elixer classifications")
+        else:
+            try:
+                elix_table = self.hdfile.root.Elixer
+            except tb.NoSuchNodeError:
+                print('No Elixer table found')
+            else:
+                self._set_table_columns(elix_table, rows, columns, skip=["detectid"])
+                if hasattr(self, "mag_sdss_g"):
+                    self.gmag = self.mag_sdss_g
+                    self.gmag_err = self.mag_sdss_g
+
+    def _set_table_columns(self, table, rows, columns, skip=()):
+        """
+        Set the requested columns of a PyTables table as
+        attributes, reading only the given row coordinates
+        """
+        required = ["detectid", "shotid", "ra", "dec"]
+
+        if columns is None:
+            colnames = table.colnames
+        else:
+            colnames = [name for name in table.colnames
+                        if (name in columns) or (name in required)]
+        colnames = [name for name in colnames if name not in skip]
+
+        if columns is None:
+            # every column is wanted, so read whole rows in one pass
+            if rows is None:
+                data = table.read()
+            else:
+                data = table.read_coordinates(rows)
+
+        for name in colnames:
+            if columns is None:
+                values = data[name]
+            elif rows is None:
+                values = table.col(name)
+            else:
+                values = table.read_coordinates(rows, field=name)
+
+            if values.dtype.kind == "S":
+                values = values.astype(str)
+
+            setattr(self, name, values)
+
     def __getitem__(self, indx):
         """ 
         This allows for slicing of the Detections class
@@ -295,7 +468,7 @@ class Detections:
                 setattr(p, attrname, getattr(self, attrname))
         return p
 
-    def refine(self, gmagcut=None, removebalmerstars=False):
+    def refine(self, gmagcut=None, removebalmerstars=False, cache_dir=None):
         """
         Masks out bad and bright detections 
         and returns a refined Detections class
@@ -303,10 +476,21 @@ class Detections:
 
         gmagcut = mag limit to exclude everything
                   brighter, defaults to None
+        cache_dir = optional directory to save the masks built from
+                    the known issues files. Each mask is keyed by the
+                    detect H5 file and the known issues files it uses,
+                    so only masks whose inputs changed are recomputed.
+                    Defaults to None, no caching.
         """
 
+        # masks saved to cache_dir are keyed by the contents of the
+        # known issues files, so build them from the files as they
+        # are now rather than from tables kept in memory
+        reload = cache_dir is not None
+
         if self.survey == 'hdr1':
-            mask1 = self.remove_bad_amps()
+            mask1 = self._refine_mask("badamps", self.remove_bad_amps,
+                                      ["badamp"], cache_dir)
             mask2 = self.remove_bright_stuff(gmagcut)
             mask3 = self.remove_ccd_features()
             
@@ -315,25 +499,119 @@ class Detections:
             else:
                 mask4 = np.ones(np.size(self.detectid), dtype=bool)
                 
-            mask5 = self.remove_bad_detects()
+            mask5 = self._refine_mask("baddetects", self.remove_bad_detects,
+                                      ["baddetect"], cache_dir)
         
-            mask6 = self.remove_shots()
-            mask7 = self.remove_bad_pix()
+            mask6 = self._refine_mask("badshots", self.remove_shots,
+                                      ["badshot"], cache_dir, vis_class=-2)
+            mask7 = self._refine_mask("badpix", self.remove_bad_pix,
+                                      ["badpix"], cache_dir, vis_class=0)
             
             mask = mask1 * mask2 * mask3 * mask4 * mask5 * mask6 * mask7
 
         else:
-            mask1 = self.remove_bad_amps()
-            mask2 = self.remove_bad_detects()
+            mask1 = self._refine_mask("badamps",
+                                      lambda: self.remove_bad_amps(reload=reload),
+                                      ["badamp", "badamp2"], cache_dir)
+            mask2 = self._refine_mask("baddetects", self.remove_bad_detects,
+                                      ["baddetect"], cache_dir)
             mask3 = self.remove_bright_stuff(gmagcut)
-            mask4 = self.remove_bad_pix()
-            mask5 = self.remove_shots()
-            mask6 = self.remove_meteors()
+            mask4 = self._refine_mask("badpix", self.remove_bad_pix,
+                                      ["badpix"], cache_dir, vis_class=0)
+            mask5 = self._refine_mask("badshots", self.remove_shots,
+                                      ["badshot"], cache_dir, vis_class=-2)
+            mask6 = self._refine_mask("meteors",
+                                      lambda: self.remove_meteors(reload=reload),
+                                      ["meteor"], cache_dir)
             
             mask = mask1 * mask2 * mask3 * mask4 * mask5 * mask6
             
         return self[mask]
 
+    def _refine_mask(self, name, mask_func, inputs, cache_dir, vis_class=None):
+        """
+        Return the mask from one of the refine() steps, reading
+        it from cache_dir if it was saved for the same inputs
+
+        Parameters
+        ----------
+        name : str
+            name of the refine step
+        mask_func : callable
+            method returning the boolean mask (True = keep)
+        inputs : list of str
+            names of the config attributes of the known
+            issues files this mask depends on
+        cache_dir : str
+            directory of the cache. If None always compute
+        vis_class : int (optional)
+            the vis_class value mask_func assigns to
+            the masked detections
+
+        Returns
+        -------
+        mask : array
+            boolean mask, True for detections to keep
+        """
+
+        if cache_dir is None:
+            return mask_func()
+
+        cachefile = op.join(
+            cache_dir,
+            "refine_{:s}_{:s}.npy".format(name, self._refine_cache_key(name, inputs)),
+        )
+
+        # the cache stores the masked detectids so it can be applied
+        # to any selection of the catalog
+        if op.isfile(cachefile):
+            masked = np.isin(self.detectid, np.load(cachefile))
+            if vis_class is not None:
+                self.vis_class[masked] = vis_class
+            return np.invert(masked)
+
+        mask = mask_func()
+
+        # only save masks evaluated over the full catalog
+        if np.size(self.detectid) == self.hdfile.root.Detections.nrows:
+            if not op.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # write then rename so readers never see a partial file
+            tmpfile = cachefile[:-4] + ".tmp{:d}.npy".format(os.getpid())
+            np.save(tmpfile, self.detectid[np.invert(mask)])
+            os.replace(tmpfile, cachefile)
+
+        return mask
+
+    def _refine_cache_key(self, name, inputs):
+        """
+        Return a hash of the detect H5 file and the known
+        issues files used by one of the refine() steps
+        """
+        global config
+
+        sha = hashlib.sha1()
+
+        # the detect H5 is too large to hash, use its path, size and
+        # modification time instead
+        stat = os.stat(self.filename)
+        sha.update(
+            "{:d} {:s} {:s} {:s} {:d} {:d}".format(
+                REFINE_CACHE_VERSION, self.survey, name, op.abspath(self.filename),
+                stat.st_size, stat.st_mtime_ns,
+            ).encode()
+        )
+
+        for attr in inputs:
+            filename = getattr(config, attr, None)
+            sha.update(attr.encode())
+            if filename is not None and op.isfile(filename):
+                with open(filename, "rb") as fp:
+                    for chunk in iter(lambda: fp.read(2 ** 20), b""):
+                        sha.update(chunk)
+
+        return sha.hexdigest()[:16]
+
     def query_by_coords(self, coords, radius):
         """
         Returns mask based on a coordinate search
@@ -521,23 +799,22 @@ class Detections:
         classifying algorithms tests.
         """
         global config
-        # set an empty mask to start
-        mask = np.zeros(np.size(self.detectid), dtype=bool)
 
         baddetects = np.loadtxt(config.baddetect, dtype=int)
 
-        for baddet in baddetects:
-            maskdet = self.detectid == baddet
-            mask = np.logical_or(mask, maskdet)
+        mask = np.isin(self.detectid, baddetects)
 
         return np.invert(mask)
 
-    def remove_bad_amps(self):
+    def remove_bad_amps(self, reload=False):
         """
         Reads in the bad amp list from config.py
         and creates a mask to remove those detections.
         It will also assign a 0 to signify an artifact
         in vis_class
+
+        reload = read the amp flag file again rather than
+                 use the lookup kept in memory
         """
         global config
         # set an empty mask to start
@@ -557,52 +834,45 @@ class Detections:
 
             if self.survey == 'hdr2':
                 self.date = (self.shotid/1000).astype(int)
-        
-            for row in np.arange(np.size(badamps)):
-                if badamps["amp"][row] == "AA":
-                    maskamp = (
-                        (self.ifuslot == str(badamps["ifuslot"][row]).zfill(3))
-                        * (self.date >= badamps["date_start"][row])
-                        * (self.date <= badamps["date_end"][row])
-                    )
-                    mask = np.logical_or(mask, maskamp)
-                else:
-                    maskamp = (
-                        (self.amp == badamps["amp"][row])
-                        * (self.ifuslot == str(badamps["ifuslot"][row]).zfill(3))
-                        * (self.date >= badamps["date_start"][row])
-                        * (self.date <= badamps["date_end"][row])
-                    )
-                    mask = np.logical_or(mask, maskamp)
 
-            return np.logical_not(mask)
-        else:
+            ifuslot = np.array([str(x).zfill(3) for x in badamps["ifuslot"]])
+            sel_aa = badamps["amp"] == "AA"
 
-            # first read in amp_flag.fits file
-            badamps = Table.read(config.badamp)
-            
-            det_table = self.return_astropy_table()
-            
-            join_tab = join(det_table, badamps, keys=['shotid','multiframe'], join_type='left')
-            # this is needed to match with detection class object sorting
-            join_tab.sort('detectid')
+            # whole IFU entries are keyed by ifuslot only, the
+            # rest by ifuslot and amp
+            mask_ifu = flag_in_intervals(
+                self.ifuslot, self.date, ifuslot[sel_aa],
+                badamps["date_start"][sel_aa], badamps["date_end"][sel_aa]
+            )
+            ampkey = np.char.add(ifuslot[~sel_aa],
+                                 np.array(badamps["amp"][~sel_aa]).astype(str))
+            mask_amp = flag_in_intervals(
+                np.char.add(self.ifuslot.astype(str), self.amp.astype(str)),
+                self.date, ampkey,
+                badamps["date_start"][~sel_aa], badamps["date_end"][~sel_aa]
+            )
+            mask = mask_ifu | mask_amp
 
-            mask1 = join_tab['flag'] != 0
+            return np.logical_not(mask)
+        else:
 
-            del det_table, join_tab
+            # look up each detection's amp in the amp_flag.fits file,
+            # amps missing from the file are kept
+            mask1 = amp_flag_from_shotid_multiframe(
+                self.shotid, self.multiframe,
+                bad_amps_table=load_amp_flag_lookup(config.badamp, reload=reload),
+                missing=True,
+            )
             
             # add in any newly found badamps that haven't made it into the
             # amp_flag.fits file yet
             
-            mask2 = np.zeros( np.size(self.detectid), dtype=bool)
-            
             badamps2 = Table.read(config.badamp2, format='ascii')
 
-            for row in badamps2:
-                selmf = self.multiframe == row['multiframe']
-                seldate = (self.date >= row['date_start']) \
-                          * (self.date <= row['date_end'])
-                mask2 = np.logical_or(mask2, selmf*seldate)
+            mask2 = flag_in_intervals(self.multiframe, self.date,
+                                      badamps2['multiframe'],
+                                      badamps2['date_start'],
+                                      badamps2['date_end'])
                 
             mask = mask1 * np.logical_not( mask2)
             
@@ -637,18 +907,12 @@ class Detections:
                 config.badpix, names=["multiframe", "x1", "x2", "y1", "y2"]
             )
 
-            mask = np.zeros(np.size(self.detectid), dtype=bool)
+            mask = flag_in_boxes(
+                self.multiframe, self.x_raw, self.y_raw,
+                badpixlist["multiframe"], badpixlist["x1"], badpixlist["x2"],
+                badpixlist["y1"], badpixlist["y2"]
+            )
 
-            for row in badpixlist:
-                maskbadpix = (
-                    (self.multiframe == row["multiframe"])
-                    * (self.x_raw >= row["x1"])
-                    * (self.x_raw <= row["x2"])
-                    * (self.y_raw >= row["y1"])
-                    * (self.y_raw <= row["y2"])
-                )
-                mask = np.logical_or(maskbadpix, mask)
-                
             self.vis_class[mask] = 0
 
         else: #except:
@@ -663,12 +927,9 @@ class Detections:
         in any MLing analysis
         """
         global config
-        mask = np.zeros(np.size(self.detectid), dtype=bool)
         badshots = np.loadtxt(config.badshot, dtype=int)
 
-        for shot in badshots:
-            maskshot = self.shotid == shot
-            mask = np.logical_or(maskshot, mask)
+        mask = np.isin(self.shotid, badshots)
 
         self.vis_class[mask] = -2
 
@@ -720,26 +981,65 @@ class Detections:
 
         return np.invert(mask)
 
-    def remove_meteors(self):
+    def remove_meteors(self, reload=False):
         """
         Returns boolean mask with detections landing on meteor
         streaks masked. Use np.invert(mask) to find meteors
+
+        reload = read the meteor file again rather than
+                 use the table kept in memory
         """
         
         global config
 
-        met_tab = Table.read(config.meteor, format='ascii')
+        met_tab = load_meteor_table(config.meteor, reload=reload)
+
+        mask = meteor_flag_from_radec(self.ra, self.dec, self.shotid,
+                                      met_tab=met_tab)
 
-        mask = np.ones_like(self.detectid, dtype=bool)
-        
-        for row in met_tab:
-            sel_shot = np.where(self.shotid == row['shotid'])[0]
-            for idx in sel_shot:
-                coord = self.coords[idx]
-                mask[idx] = meteor_flag_from_coords(coord,
-                                                    row['shotid'])
         return mask
         
+    def add_flux_limits(self, sncut=6.0, use_ifuslot=True, nproc=1):
+        """
+        Look up the flux limit of every detection in the
+        sensitivity cubes of its shot and add the f50 (in
+        erg/s/cm2), the 1-sigma noise flim_sigma and the
+        completeness at the detection's flux as attributes.
+        The per-shot fluxlimit_4540 is left unchanged
+
+        Parameters
+        ----------
+        sncut : float
+            the detection significance (S/N) cut
+            the flux limits are for. Default 6.0
+        use_ifuslot : bool
+            look detections up in the IFU they were
+            found in, otherwise find the IFU whose
+            cube contains them
+        nproc : int
+            number of processes to look up the
+            shots with
+        """
+        from hetdex_api.flux_limits.selection_function import detection_flux_limits
+
+        if self.survey == "hdr1":
+            print("Per detection flux limits are not available for hdr1")
+            return
+
+        if use_ifuslot:
+            ifuslot = self.ifuslot.astype(str)
+        else:
+            ifuslot = None
+
+        flims = detection_flux_limits(self.shotid, self.ra, self.dec, self.wave, sncut,
+                                      flux=1e-17*np.asarray(self.flux, dtype=float),
+                                      ifuslot=ifuslot, release=self.survey,
+                                      nproc=nproc)
+
+        self.f50 = np.array(flims["f50"])
+        self.flim_sigma = np.array(flims["sigma"])
+        self.completeness = np.array(flims["completeness"])
+
     def get_spectrum(self, detectid_i):
         """
         Grabs the 1D spectrum used to measure fitted parameters.
@@ -840,7 +1140,9 @@ class Detections:
         """
         table = Table()
         for name in self.hdfile.root.Detections.colnames:
-            table[name] = getattr(self, name)
+            # skip columns not loaded in query mode
+            if hasattr(self, name):
+                table[name] = getattr(self, name)
 
         table.add_column(Column(self.fwhm), index=1, name="fwhm")
         table.add_column(Column(self.throughput), index=2, name="throughput")
@@ -861,13 +1163,19 @@ class Detections:
                 table.add_column(Column(self.gmag), index=6, name="gmag")
                 table.add_column(Column(self.gmag_err), index=6, name="gmag_err")
                 for name in self.hdfile.root.Elixer.colnames:
-                    table[name] = getattr(self, name)
+                    if hasattr(self, name):
+                        table[name] = getattr(self, name)
             except:
                 print('Could not add elixer columns')
             try:
                 table.add_column(Column(self.fluxlimit_4540), index=3, name="fluxlimit_4540")
             except:
                 print('Could not add average flux limit')
+
+            # per detection flux limits from add_flux_limits()
+            for name in ["f50", "flim_sigma", "completeness"]:
+                if hasattr(self, name):
+                    table[name] = getattr(self, name)
                 
         return table
 
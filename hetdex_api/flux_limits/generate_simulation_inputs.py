@@ -23,7 +23,7 @@ from astropy.table import Table, vstack
 from pyhetdex.coordinates.tangent_projection import TangentPlane
 from pyhetdex.het.fplane import FPlane
 from hetdex_api.survey import Survey 
-from hetdex_api.mask_tools.generate_sky_masks import get_fplane    
+from hetdex_api.mask_tools.generate_sky_masks import load_fplane    
 from hetdex_api.flux_limits.hdf5_sensitivity_cubes import SensitivityCubeHDF5Container
 from hetdex_api.flux_limits.sensitivity_cube import SensitivityCube
 
@@ -125,14 +125,7 @@ def generate_sencube_hdf(datevshot, ra, dec, pa, fplane_output_dir,
     tp = TangentPlane(ra, dec, rot)
 
     date = datevshot[:8]
-    fplane_bn = "{:s}_fplane.txt".format(date)
-    fplane_fn = join(fplane_output_dir, fplane_bn)
-
-    if not isfile(fplane_fn):
-       get_fplane(fplane_fn, datestr=str(date))
-       fplane = FPlane(fplane_fn)
-    else:
-       fplane = FPlane(fplane_fn) 
+    fplane = load_fplane(date, fplane_dir=fplane_output_dir)
 
     for ifuslot, ifu in iteritems(fplane.difus_ifuslot):
 
@@ -404,12 +397,7 @@ def split_into_ifus(table, unique_fields, unique_ifus, outdir,
                ttable = table_ifu[isplit*NMAX : (isplit + 1)*NMAX]
 
                date = field[:-4]
-               fplane_fn = "{:s}_fplane.txt".format(date)
-               if not isfile(fplane_fn):
-                   get_fplane(fplane_fn, datestr=date)
-                   fplane = FPlane(fplane_fn)
-               else:
-                   fplane = FPlane(fplane_fn) 
+               fplane = load_fplane(date, fplane_dir=".")
 
 
                ifu = fplane.by_id(ifuslot[-3:], "ifuslot")               
@@ -9,11 +9,12 @@ files
 """
 
 import logging
-from os.path import isfile, join
+from collections import OrderedDict
+from os.path import isfile, join, basename, abspath
 from re import compile
 import tables as tb
 from hetdex_api.config import HDRconfig
-from hetdex_api.flux_limits.sensitivity_cube import SensitivityCube
+from hetdex_api.flux_limits.sensitivity_cube import SensitivityCube, LazyNoiseArray
 from numpy.ma import MaskedArray
 
 _logger = logging.getLogger()
@@ -76,6 +77,113 @@ def return_sensitivity_hdf_path(datevobs, release="hdr2.1",
         )
 
 
+def cube_chunkshape(shape, layout=None, block=8):
+    """
+    Return the HDF5 chunk shape of a noise 
+    cube for an access pattern
+
+    Parameters
+    ----------
+    shape : tuple
+        the (nz, ny, nx) shape of the cube
+    layout : str or tuple (optional)
+        'slice' for chunks of the full spatial plane
+        and ``block`` wavelengths, best for reading 
+        wavelength slices; 'spectrum' for chunks of
+        all wavelengths and ``block`` x ``block`` 
+        pixels, best for spectra at a pixel. A tuple
+        is used as the chunk shape. Default, None, 
+        lets PyTables choose
+    block : int (optional)
+        the size of the small chunk dimensions
+
+    Returns
+    -------
+    chunkshape : tuple
+        the chunk shape, or None
+    """
+    nz, ny, nx = shape
+
+    if layout is None:
+        return None
+    elif layout == "slice":
+        return (min(block, nz), ny, nx)
+    elif layout == "spectrum":
+        return (nz, min(block, ny), min(block, nx))
+    else:
+        return tuple(layout)
+
+
+class SensitivityCubeCache(object):
+    """
+    A least recently used cache of SensitivityCube
+    objects. Every SensitivityCubeHDF5Container 
+    has one, off unless cache_size is set. Pass 
+    the same cache to several containers to share
+    cubes between them, e.g. when a file is reopened
+    for each lookup. Cached cubes are shared, so copy
+    a cube before changing it, e.g. with 
+    apply_flux_recalibration
+
+    Parameters
+    ----------
+    maxsize : int
+        the maximum number of cubes to
+        keep, 0 turns the cache off
+
+    Attributes
+    ----------
+    hits, misses : int
+        counts of cache lookups
+    """
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cubes = OrderedDict()
+
+    def __len__(self):
+        return len(self._cubes)
+
+    def get(self, key):
+        """ Return the cube of key or None """
+        try:
+            scube = self._cubes[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self._cubes.move_to_end(key)
+        self.hits += 1
+
+        return scube
+
+    def put(self, key, scube):
+        """ Add a cube, dropping the least recently used ones """
+        if self.maxsize <= 0:
+            return
+
+        self._cubes[key] = scube
+        self._cubes.move_to_end(key)
+
+        while len(self._cubes) > self.maxsize:
+            self._cubes.popitem(last=False)
+
+    def discard_lazy(self, h5file):
+        """ 
+        Drop the cubes lazily read through an open
+        file, they can't be used once it is closed 
+        """
+        # keys end with the id of the file handle of
+        # lazy cubes, see SensitivityCubeHDF5Container
+        for key in [k for k in self._cubes if k[-1] == id(h5file)]:
+            del self._cubes[key]
+
+    def clear(self):
+        """ Drop all cubes """
+        self._cubes.clear()
+
+
 class SensitivityCubeHDF5Container(object):
     """
     Handle accessing and writing the sensitivity
@@ -100,16 +208,37 @@ class SensitivityCubeHDF5Container(object):
     mask_filename : str (optional)
         optional mask to apply, path to
         one of the _mask.h5 files
+    complib, complevel : str, int (optional)
+        compression of cubes added to the
+        file, default zlib level 4. The
+        Blosc codecs, e.g. 'blosc:lz4', are 
+        faster to read but the files then 
+        need PyTables (or hdf5plugin) to read
+    chunk_layout : str or tuple (optional)
+        chunk layout of cubes added to the
+        file, see cube_chunkshape()
+    cache_size : int (optional)
+        number of extracted cubes to keep,
+        so extracting them again is fast. 
+        Default 0, no cache. Cached cubes are
+        returned to every caller, so copy them
+        before changing them
+    cube_cache : SensitivityCubeCache (optional)
+        a cache shared with other containers,
+        overrides cache_size
 
     Attributes
     ----------
     h5file : tables:File 
         the tables File object
+    cube_cache : SensitivityCubeCache
+        the cache of extracted cubes
 
     """
 
     def __init__(self, filename, mode="r", flim_model="hdr2pt1", aper_corr=1.0, 
-                 mask_filename = None, **kwargs):
+                 mask_filename = None, complib="zlib", complevel=4,
+                 chunk_layout=None, cache_size=0, cube_cache=None, **kwargs):
 
         if (mode == "w") and isfile(filename):
             raise FileExists("Error! Output file {:s} exists!".format(filename))
@@ -117,7 +246,9 @@ class SensitivityCubeHDF5Container(object):
         # Filter for compression, set complevel=4 as higher levels only
         # give a few extra MB per file
         # fletcher32 error checking and zlib
-        self.compress_filter = tb.Filters(complevel=4, fletcher32=True, complib="zlib")
+        self.compress_filter = tb.Filters(complevel=complevel, fletcher32=True, 
+                                          complib=complib)
+        self.chunk_layout = chunk_layout
         self.h5file = tb.open_file(
             filename, mode=mode, filters=self.compress_filter, **kwargs
         )
@@ -127,9 +258,18 @@ class SensitivityCubeHDF5Container(object):
             self.h5mask = None
 
         self.filename = filename
+        self.mask_filename = mask_filename
         self.flim_model = flim_model
         self.aper_corr = aper_corr
 
+        if cube_cache is None:
+            cube_cache = SensitivityCubeCache(cache_size)
+        self.cube_cache = cube_cache
+
+        if mask_filename:
+            mask_filename = abspath(mask_filename)
+        self._cache_key = (abspath(filename), mask_filename, flim_model, aper_corr)
+
     def add_sensitivity_cube(self, datevshot, ifuslot, scube, flush=False):
         """
         Add a sensitivity cube to the HDF5 file
@@ -153,15 +293,17 @@ class SensitivityCubeHDF5Container(object):
         except tb.NoSuchNodeError:
             shot = self.h5file.create_group(self.h5file.root, datevshot)
 
+        chunkshape = cube_chunkshape(scube.shape, self.chunk_layout)
+
         # Store this in a compressible array
         if type(scube.sigmas) == MaskedArray.__class__:
             array = self.h5file.create_carray(
                                shot, ifuslot, obj=scube.sigmas.data, 
-                               title="1 sigma noise")
+                               title="1 sigma noise", chunkshape=chunkshape)
         else:     
             array = self.h5file.create_carray(
                                 shot, ifuslot, obj=scube.sigmas, 
-                                title="1 sigma noise")
+                                title="1 sigma noise", chunkshape=chunkshape)
  
         #  Store what aperture correction has been applied
         array.attrs.aper_corr = scube.aper_corr
@@ -178,7 +320,7 @@ class SensitivityCubeHDF5Container(object):
         """ List the contents of the HDF5 file """
         print(self.h5file)
 
-    def itercubes(self, datevshot=None):
+    def itercubes(self, datevshot=None, lazy=False):
         """ 
         Iterate over the IFUs 
 
@@ -188,6 +330,11 @@ class SensitivityCubeHDF5Container(object):
             specify a datevshot or
             just take the first shot in
             the HDF5 file
+        lazy : bool (Optional)
+            only read the noise from the
+            file when it's needed, the
+            container has to stay open
+            while the cubes are used
 
         Yields
         ------
@@ -220,7 +367,10 @@ class SensitivityCubeHDF5Container(object):
             header = ifu.attrs.header
             wavelengths = ifu.attrs.wavelengths
             alphas = ifu.attrs.alphas
-            sigmas = ifu.read() / ifu.attrs.aper_corr
+            if lazy:
+                sigmas = LazyNoiseArray(ifu, divisor=ifu.attrs.aper_corr)
+            else:
+                sigmas = ifu.read() / ifu.attrs.aper_corr
 
             if self.h5mask:
                 mask = self.h5mask.get_node(self.h5mask.root.Mask, 
@@ -247,7 +397,7 @@ class SensitivityCubeHDF5Container(object):
                                             aper_corr=self.aper_corr, 
                                             nsigma=nsigma, mask=mask)
 
-    def extract_ifu_sensitivity_cube(self, ifuslot, datevshot=None):
+    def extract_ifu_sensitivity_cube(self, ifuslot, datevshot=None, lazy=False):
         """
         Extract the sensitivity cube
         from IFU (ifuslot). If multiple
@@ -265,11 +415,17 @@ class SensitivityCubeHDF5Container(object):
             that one shot is present 
             and return the IFU
             for that
+        lazy : bool (Optional)
+            only read the noise from the
+            file when it's needed, the
+            container has to stay open
+            while the cube is used
 
         Returns
         -------
         scube : hetdex_api.flux_limits.sensitivity_cube:SensitivityCube
-            the sensitivity cube
+            the sensitivity cube, shared with
+            the cube cache if there is one
         """
 
         # Use first shot if dateshot not specified
@@ -286,6 +442,14 @@ class SensitivityCubeHDF5Container(object):
         else:
             shot = self.h5file.get_node(self.h5file.root, name=datevshot)
 
+        # everything that changes the cube is part of the key,
+        # lazy cubes read through this container's file handle
+        key = self._cache_key + (shot._v_name, ifuslot,
+                                 id(self.h5file) if lazy else None)
+
+        scube = self.cube_cache.get(key)
+        if scube is not None:
+            return scube
 
         if self.h5mask:
             mask = self.h5mask.get_node(self.h5mask.root.Mask, 
@@ -302,7 +466,10 @@ class SensitivityCubeHDF5Container(object):
         alphas = ifu.attrs.alphas
 
         # Remove any aperture correction
-        sigmas = ifu.read() / ifu.attrs.aper_corr
+        if lazy:
+            sigmas = LazyNoiseArray(ifu, divisor=ifu.attrs.aper_corr)
+        else:
+            sigmas = ifu.read() / ifu.attrs.aper_corr
 
         try:
             nsigma = ifu.attrs.nsigma
@@ -314,9 +481,40 @@ class SensitivityCubeHDF5Container(object):
             print("No nsigma found, assuming nsigma={:2.1f} ".format(nsigma))
 
         # Force apcor to be 1.0 here, so we don't double count it
-        return SensitivityCube(sigmas, header, wavelengths, alphas, 
-                               nsigma=nsigma, flim_model=self.flim_model,
-                               aper_corr=self.aper_corr, mask=mask)
+        scube = SensitivityCube(sigmas, header, wavelengths, alphas, 
+                                nsigma=nsigma, flim_model=self.flim_model,
+                                aper_corr=self.aper_corr, mask=mask)
+        self.cube_cache.put(key, scube)
+
+        return scube
+
+    def get_slice(self, ifuslot, wavelength, datevshot=None):
+        """
+        Return the noise in one wavelength slice
+        of an IFU, only that slice is read from 
+        the file
+
+        Parameters
+        ----------
+        ifuslot : string
+            the IFU slot to extract
+        wavelength : float
+            wavelength in Angstrom, the closest
+            slice is returned
+        datevshot : string (Optional)
+            the datevshot if multiple
+            shots are stored in the 
+            HDF5
+
+        Returns
+        -------
+        noise : masked array
+            2D noise slice, masked where
+            the spatial mask is bad
+        """
+        scube = self.extract_ifu_sensitivity_cube(ifuslot, datevshot=datevshot,
+                                                  lazy=True)
+        return scube.get_slice(wavelength)
 
     def flush(self):
         """ Write all alive leaves to disk """
@@ -324,6 +522,7 @@ class SensitivityCubeHDF5Container(object):
 
     def close(self):
         """ Close the file and destroy the object """
+        self.cube_cache.discard_lazy(self.h5file)
         self.h5file.close()
         _logger.info("Closed {:s}".format(self.filename))
         if self.h5mask:
@@ -401,6 +600,77 @@ def add_sensitivity_cube_to_hdf5(args=None):
     hdfcont.close()
 
 
+def rewrite_sensitivity_hdf5(infile, outfile, complib="blosc:lz4", complevel=4,
+                             chunk_layout="slice"):
+    """
+    Copy a HDF5 container of sensitivity cubes to
+    a new file with a different compression
+    and chunk layout
+
+    Parameters
+    ----------
+    infile, outfile : str
+        the input and output files, 
+        outfile must not exist
+    complib, complevel : str, int (optional)
+        the compression of the output, default
+        is Blosc LZ4 level 4
+    chunk_layout : str or tuple (optional)
+        the chunk layout of the output, see
+        cube_chunkshape(). Default is 'slice'
+    """
+
+    with SensitivityCubeHDF5Container(infile, mode="r") as hdfin, \
+         SensitivityCubeHDF5Container(outfile, mode="w", complib=complib,
+                                      complevel=complevel, 
+                                      chunk_layout=chunk_layout) as hdfout:
+
+        hdfin.h5file.root._v_attrs._f_copy(hdfout.h5file.root)
+
+        for shot in hdfin.h5file.iter_nodes(hdfin.h5file.root, classname="Group"):
+            group = hdfout.h5file.create_group(hdfout.h5file.root, shot._v_name)
+            shot._v_attrs._f_copy(group)
+
+            for ifu in shot:
+                ifu.copy(group, ifu.name, filters=hdfout.compress_filter,
+                         chunkshape=cube_chunkshape(ifu.shape, chunk_layout))
+
+
+def rewrite_sensitivity_hdf5_cmd(args=None):
+    """
+    Command line tool to rewrite HDF5
+    containers of sensitivity cubes with
+    a different compression and chunk 
+    layout
+
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Rewrite sensitivity cube HDF5 containers",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument("--complib", default="blosc:lz4", 
+                        help="Compression library, e.g. zlib or blosc:lz4")
+    parser.add_argument("--complevel", default=4, type=int, help="Compression level")
+    parser.add_argument("--chunk-layout", default="slice", choices=["slice", "spectrum"],
+                        help="""Chunks of whole wavelength slices or of whole spectra
+                                of small spatial tiles""")
+    parser.add_argument("h5files", type=str, nargs="+", 
+                        help="HDF5 containers to rewrite, e.g. *_sensitivity_cube.h5")
+    parser.add_argument("outdir", type=str, help="Directory for the rewritten files")
+
+    opts = parser.parse_args(args=args)
+
+    for fn in opts.h5files:
+        outfn = join(opts.outdir, basename(fn))
+        _logger.info("Rewriting {:s} to {:s}".format(fn, outfn))
+        rewrite_sensitivity_hdf5(fn, outfn, complib=opts.complib,
+                                 complevel=opts.complevel, 
+                                 chunk_layout=opts.chunk_layout)
+
+
 def extract_sensitivity_cube(args=None):
     """
     Extract a sensitivity cube from an HDF5 file
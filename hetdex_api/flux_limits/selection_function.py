@@ -0,0 +1,542 @@
+"""
+
+Survey-wide selection function. Sources are
+routed to the IFUs of every shot covering them
+through a footprint index of the IFUs and
+completeness is computed from the sensitivity
+cubes of those shots, one batch per IFU. Flux
+limits of detection catalogues are looked up
+the same way, one shot at a time
+
+"""
+from multiprocessing import Pool
+from os.path import isfile
+from numpy import (array, asarray, zeros, ones, full, unique, argsort, concatenate,
+                   maximum, multiply, arange, searchsorted, sqrt, broadcast_to, repeat,
+                   int64, rad2deg, arcsin, float64)
+import tables as tb
+from scipy.spatial import cKDTree
+from astropy.table import Table
+import astropy.units as u
+from hetdex_api.survey import radec_to_unit_vectors, angle_to_chord
+from hetdex_api.config import HDRconfig
+from hetdex_api.flux_limits.hdf5_sensitivity_cubes import (SensitivityCubeHDF5Container,
+                                                           return_sensitivity_hdf_path,
+                                                           NoFluxLimsAvailable)
+
+
+def _shot_files(datevshot, filenames, release, use_masks, mask_filenames=None):
+    """ 
+    Return the sensitivity cube and mask files of a shot,
+    the mask is None if it's not used or doesn't exist.
+    Shots in filenames take their mask from mask_filenames
+    """
+    filename = filenames.get(datevshot)
+
+    if filename is None:
+        filename, mask_filename = return_sensitivity_hdf_path(datevshot, release=release,
+                                                              return_mask_fn=True)
+    elif mask_filenames is not None:
+        mask_filename = mask_filenames.get(datevshot)
+    else:
+        mask_filename = None
+
+    if not (use_masks and mask_filename and isfile(mask_filename)):
+        mask_filename = None
+
+    return filename, mask_filename
+
+
+def _shot_footprints(args):
+    """
+    Return the centres and radii of the IFUs in
+    one sensitivity cube container
+    """
+    datevshot, filename = args
+
+    rows = []
+    with SensitivityCubeHDF5Container(filename) as hdfcont:
+        for ifuslot, scube in hdfcont.itercubes(lazy=True):
+            nz, ny, nx = scube.shape
+            wcs = scube.wcs.celestial
+
+            ra, dec = wcs.wcs_pix2world([0.5*(nx - 1)], [0.5*(ny - 1)], 0)
+            rac, decc = wcs.wcs_pix2world([-0.5, -0.5, nx - 0.5, nx - 0.5],
+                                          [-0.5, ny - 0.5, -0.5, ny - 0.5], 0)
+
+            # radius is the distance to the furthest corner
+            xyz = radec_to_unit_vectors(ra, dec)
+            chord = sqrt(((radec_to_unit_vectors(rac, decc) - xyz)**2).sum(axis=1)).max()
+            radius = rad2deg(2.0*arcsin(0.5*chord))
+
+            rows.append((datevshot, ifuslot, ra[0], dec[0], radius))
+
+    return rows
+
+
+def build_footprint_index(datevshots, filenames=None, release=None, nproc=1):
+    """
+    Build a table of the centres and radii of all
+    the IFUs in a list of shots. Only the headers of
+    the sensitivity cubes are read. Save the table
+    with its write method and pass the file to
+    SurveySelectionFunction to reuse it
+
+    Parameters
+    ----------
+    datevshots : list of str
+        the shots, e.g. 20181203v013
+    filenames : dict (optional)
+        the sensitivity cube container of each
+        datevshot, default from
+        return_sensitivity_hdf_path()
+    release : str (optional)
+        the data release, default is
+        HDRconfig.LATEST_HDR_NAME
+    nproc : int (optional)
+        number of processes to read the
+        files with
+
+    Returns
+    -------
+    footprints : astropy.table.Table
+        datevshot, ifuslot, centre ra, dec and
+        radius of each IFU in degrees
+    """
+    if release is None:
+        release = HDRconfig.LATEST_HDR_NAME
+
+    if filenames is None:
+        filenames = {}
+
+    tasks = []
+    for datevshot in datevshots:
+        try:
+            fn = filenames.get(datevshot)
+            if fn is None:
+                fn = return_sensitivity_hdf_path(datevshot, release=release)
+        except NoFluxLimsAvailable:
+            print("No flux limits for {:s}, skipping".format(datevshot))
+            continue
+        tasks.append((datevshot, fn))
+
+    if nproc > 1:
+        with Pool(nproc) as pool:
+            results = pool.map(_shot_footprints, tasks)
+    else:
+        results = [_shot_footprints(task) for task in tasks]
+
+    rows = [row for result in results for row in result]
+
+    return Table(rows=rows, names=["datevshot", "ifuslot", "ra", "dec", "radius"],
+                 dtype=[str, str, float64, float64, float64])
+
+
+def _ifu_completeness(args):
+    """
+    Compute the completeness of sources in the
+    IFUs of one shot. Sources outside of the
+    cubes get zero completeness
+
+    Returns
+    -------
+    compl : array
+        the completeness, in the order of the
+        sources given for each IFU
+    """
+    (filename, mask_filename, flim_model, aper_corr, sncut,
+     ifuslots, offsets, flux, ra, dec, wave) = args
+
+    compl = zeros(len(flux))
+
+    with SensitivityCubeHDF5Container(filename, flim_model=flim_model,
+                                      aper_corr=aper_corr,
+                                      mask_filename=mask_filename) as hdfcont:
+
+        for ifuslot, start, stop in zip(ifuslots, offsets[:-1], offsets[1:]):
+            scube = hdfcont.extract_ifu_sensitivity_cube(ifuslot, lazy=True)
+            sl = slice(start, stop)
+
+            ix, iy, iz = scube.radecwltoxyz(ra[sl], dec[sl], wave[sl])
+            inside = ((ix >= 0) & (ix < scube.shape[2]) & (iy >= 0) &
+                      (iy < scube.shape[1]) & (iz >= 0) & (iz < scube.shape[0]))
+
+            if inside.any():
+                cin = compl[sl]
+                cin[inside] = scube.return_completeness(flux[sl][inside], ra[sl][inside],
+                                                        dec[sl][inside], wave[sl][inside],
+                                                        sncut)
+                compl[sl] = cin
+
+    return compl
+
+
+class SurveySelectionFunction(object):
+    """
+    Completeness of sources anywhere in the survey. Each
+    source is routed to the IFUs covering it with a
+    KD-tree of the IFU centres, then the sensitivity
+    cubes of each shot are opened once and evaluated
+    for all of the shot's sources at once
+
+    Parameters
+    ----------
+    footprints : astropy.table.Table or str
+        the IFU footprints from build_footprint_index()
+        or a file it was saved to
+    filenames : dict (optional)
+        the sensitivity cube container of each
+        datevshot, default from
+        return_sensitivity_hdf_path()
+    release : str (optional)
+        the data release, default is
+        HDRconfig.LATEST_HDR_NAME
+    flim_model : str (optional)
+        the flux limit model, default
+        hdr2pt1
+    aper_corr : float (optional)
+        aperture correction passed on to
+        the cubes, default 1.0
+    use_masks : bool (optional)
+        apply the flux limit masks of the
+        release if they exist. Default True
+    mask_filenames : dict (optional)
+        the mask of each datevshot given in 
+        filenames, those shots are not masked
+        unless they are listed here
+
+    Attributes
+    ----------
+    footprints : astropy.table.Table
+        the IFU footprints
+    """
+    def __init__(self, footprints, filenames=None, release=None,
+                 flim_model="hdr2pt1", aper_corr=1.0, use_masks=True,
+                 mask_filenames=None):
+
+        if isinstance(footprints, str):
+            footprints = Table.read(footprints)
+
+        if release is None:
+            release = HDRconfig.LATEST_HDR_NAME
+
+        if filenames is None:
+            filenames = {}
+
+        self.footprints = footprints
+        self.filenames = filenames
+        self.release = release
+        self.flim_model = flim_model
+        self.aper_corr = aper_corr
+        self.use_masks = use_masks
+        self.mask_filenames = mask_filenames
+
+        self._radius = asarray(footprints["radius"], dtype=float)
+        self._tree = cKDTree(radec_to_unit_vectors(footprints["ra"], footprints["dec"]))
+
+    def route(self, ra, dec):
+        """
+        Find the IFUs that might cover each source
+
+        Parameters
+        ----------
+        ra, dec : array
+            positions of the sources in degrees
+
+        Returns
+        -------
+        isource, ifoot : arrays of int
+            pairs of source index and row of
+            the footprint table, sorted by row
+        """
+        xyz = radec_to_unit_vectors(ra, dec)
+
+        if len(self._radius) == 0:
+            return zeros(0, dtype=int), zeros(0, dtype=int)
+
+        lists = self._tree.query_ball_point(xyz, angle_to_chord(self._radius.max()*u.deg))
+        nfound = array([len(l) for l in lists], dtype=int)
+        isource = repeat(arange(len(lists)), nfound)
+        ifoot = concatenate([asarray(l, dtype=int) for l in lists] + [zeros(0, dtype=int)])
+
+        # keep the pairs inside each IFU's own radius
+        dist2 = ((xyz[isource] - self._tree.data[ifoot])**2).sum(axis=1)
+        keep = dist2 <= angle_to_chord(self._radius[ifoot]*u.deg)**2
+        isource, ifoot = isource[keep], ifoot[keep]
+
+        order = argsort(ifoot, kind="stable")
+
+        return isource[order], ifoot[order]
+
+    def completeness(self, flux, ra, dec, wave, sncut, combine="max", nproc=1):
+        """
+        Return the completeness of sources
+
+        Parameters
+        ----------
+        flux : array
+            fluxes of the sources
+        ra, dec : array
+            positions of the sources in degrees
+        wave : array
+            wavelengths of the sources in Angstrom
+        sncut : float
+            the detection significance (S/N) cut
+            applied to the data
+        combine : str (optional)
+            how to combine shots covering the same
+            source. 'max' for the highest completeness,
+            'any' for the chance of being detected in
+            at least one shot, or 'per_shot' to
+            return all of them. Default 'max'
+        nproc : int (optional)
+            number of processes to evaluate the
+            shots with. Default 1
+
+        Returns
+        -------
+        compl : array or astropy.table.Table
+            the completeness of each source, zero where
+            no shot covers it. For 'per_shot' a table of
+            source index, datevshot and completeness
+        """
+        if combine not in ["max", "any", "per_shot"]:
+            raise ValueError("Unknown combine option {:s}".format(combine))
+
+        ra = asarray(ra, dtype=float).ravel()
+        dec = asarray(dec, dtype=float).ravel()
+        n = len(ra)
+        flux = broadcast_to(asarray(flux, dtype=float), (n,)).copy()
+        wave = broadcast_to(asarray(wave, dtype=float), (n,)).copy()
+
+        isource, ifoot = self.route(ra, dec)
+
+        # the footprint table rows of a shot are contiguous after sorting
+        # by row, but one shot's rows need not be, so group by shot
+        datevshots = asarray(self.footprints["datevshot"])[ifoot]
+        shots, ishot = unique(datevshots, return_inverse=True)
+        order = argsort(ishot, kind="stable")
+        isource, ifoot, ishot = isource[order], ifoot[order], ishot[order]
+        shot_offsets = searchsorted(ishot, arange(len(shots) + 1))
+
+        ifuslots = asarray(self.footprints["ifuslot"])
+
+        tasks = []
+        for i, datevshot in enumerate(shots):
+            sl = slice(shot_offsets[i], shot_offsets[i + 1])
+            rows = ifoot[sl]
+            urows, first = unique(rows, return_index=True)
+            offsets = concatenate((first, [len(rows)]))
+            src = isource[sl]
+
+            filename, mask_filename = _shot_files(datevshot, self.filenames,
+                                                  self.release, self.use_masks,
+                                                  self.mask_filenames)
+            tasks.append((filename, mask_filename, self.flim_model, self.aper_corr,
+                          sncut, ifuslots[urows], offsets, flux[src], ra[src],
+                          dec[src], wave[src]))
+
+        if nproc > 1 and len(tasks) > 1:
+            with Pool(nproc) as pool:
+                results = pool.map(_ifu_completeness, tasks)
+        else:
+            results = [_ifu_completeness(task) for task in tasks]
+
+        pair_compl = concatenate(results) if results else zeros(0)
+
+        if combine == "max":
+            compl = zeros(n)
+            maximum.at(compl, isource, pair_compl)
+            return compl
+
+        # an IFU covers a source at most once per shot, so take the
+        # maximum over IFUs then combine shots
+        key = ishot.astype(int64)*n + isource
+        ukey, inv = unique(key, return_inverse=True)
+        shot_compl = zeros(len(ukey))
+        maximum.at(shot_compl, inv, pair_compl)
+
+        if combine == "any":
+            missed = ones(n)
+            multiply.at(missed, ukey % n, 1.0 - shot_compl)
+            return 1.0 - missed
+
+        return Table([ukey % n, shots[ukey // n], shot_compl],
+                     names=["source", "datevshot", "completeness"])
+
+
+def _shot_flux_limits(args):
+    """
+    Look up the flux limits of the detections of one shot.
+    Detections are matched to the IFU given for them or,
+    without one, to the IFU whose cube contains them
+    """
+    (filename, mask_filename, flim_model, aper_corr, sncut,
+     ra, dec, wave, flux, ifuslots) = args
+
+    n = len(ra)
+    f50 = full(n, 999.0)
+    sigma = full(n, 999.0)
+    compl = zeros(n)
+    found = full(n, "", dtype="U11")
+
+    with SensitivityCubeHDF5Container(filename, flim_model=flim_model,
+                                      aper_corr=aper_corr,
+                                      mask_filename=mask_filename) as hdfcont:
+
+        if ifuslots is None:
+            cubes = hdfcont.itercubes(lazy=True)
+        else:
+            cubes = []
+            for ifuslot in unique(ifuslots):
+                try:
+                    cubes.append((ifuslot, 
+                                  hdfcont.extract_ifu_sensitivity_cube(ifuslot, lazy=True)))
+                except tb.NoSuchNodeError:
+                    print("No flux limits for {:s} in {:s}".format(ifuslot, filename))
+
+        for ifuslot, scube in cubes:
+            if ifuslots is None:
+                idx = (found == "").nonzero()[0]
+                if len(idx) == 0:
+                    break
+            else:
+                idx = (ifuslots == ifuslot).nonzero()[0]
+
+            ix, iy, iz = scube.radecwltoxyz(ra[idx], dec[idx], wave[idx])
+            inside = ((ix >= 0) & (ix < scube.shape[2]) & (iy >= 0) &
+                      (iy < scube.shape[1]) & (iz >= 0) & (iz < scube.shape[0]))
+            idx, ix, iy, iz = idx[inside], ix[inside], iy[inside], iz[inside]
+
+            if len(idx) == 0:
+                continue
+
+            sigma[idx] = scube.noise_at(ix, iy, iz)
+            f50[idx] = scube.f50_from_noise(sigma[idx], sncut)
+            found[idx] = ifuslot
+
+            if flux is not None:
+                compl[idx] = scube.return_completeness(flux[idx], ra[idx], dec[idx],
+                                                       wave[idx], sncut)
+
+    return f50, sigma, compl, found
+
+
+def detection_flux_limits(shotid, ra, dec, wave, sncut, flux=None, ifuslot=None,
+                          release=None, filenames=None, flim_model="hdr2pt1",
+                          aper_corr=1.0, use_masks=True, nproc=1):
+    """
+    Return the flux limit of each detection in a catalogue.
+    Detections are grouped by shot so the sensitivity
+    cubes of each shot are opened once, and all the 
+    detections of an IFU are looked up together
+
+    Parameters
+    ----------
+    shotid : array of int
+        the shot of each detection, e.g. 20181203013
+    ra, dec : array
+        positions of the detections in degrees
+    wave : array
+        wavelengths of the detections in Angstrom
+    sncut : float
+        the detection significance (S/N) cut
+        the flux limits are for
+    flux : array (optional)
+        line fluxes in erg/s/cm2, if given the
+        completeness of each detection is 
+        returned too
+    ifuslot : array (optional)
+        the IFU slot of each detection, e.g. '063'.
+        If not given each detection is matched to 
+        the IFU whose cube contains it
+    release : str (optional)
+        the data release, default is
+        HDRconfig.LATEST_HDR_NAME
+    filenames : dict (optional)
+        the sensitivity cube container of
+        each datevshot, default from
+        return_sensitivity_hdf_path()
+        Shots given here are not masked
+    flim_model : str (optional)
+        the flux limit model, default
+        hdr2pt1
+    aper_corr : float (optional)
+        aperture correction passed on to
+        the cubes, default 1.0
+    use_masks : bool (optional)
+        apply the flux limit masks of the
+        release if they exist. Default True
+    nproc : int (optional)
+        number of processes to look up
+        the shots with. Default 1
+
+    Returns
+    -------
+    flims : astropy.table.Table
+        f50 (erg/s/cm2) and sigma, the 1-sigma
+        noise, of each detection, the IFU it was 
+        found in and, if flux is given, its 
+        completeness. Detections outside of the
+        cubes have f50 and sigma of 999
+    """
+    if release is None:
+        release = HDRconfig.LATEST_HDR_NAME
+
+    if filenames is None:
+        filenames = {}
+
+    shotid = asarray(shotid, dtype=int64).ravel()
+    ra = asarray(ra, dtype=float).ravel()
+    dec = asarray(dec, dtype=float).ravel()
+    wave = asarray(wave, dtype=float).ravel()
+    n = len(shotid)
+
+    if flux is not None:
+        flux = asarray(flux, dtype=float).ravel()
+    if ifuslot is not None:
+        ifuslot = array(["ifuslot_" + str(x).zfill(3) for x in ifuslot])
+
+    shots, ishot = unique(shotid, return_inverse=True)
+    order = argsort(ishot, kind="stable")
+    offsets = searchsorted(ishot[order], arange(len(shots) + 1))
+
+    tasks = []
+    rows = []
+    for i, shot in enumerate(shots):
+        datevshot = str(shot)[:8] + "v" + str(shot)[8:].zfill(3)
+        try:
+            filename, mask_filename = _shot_files(datevshot, filenames, release,
+                                                  use_masks)
+        except NoFluxLimsAvailable:
+            print("No flux limits for {:s}".format(datevshot))
+            continue
+
+        idx = order[offsets[i]:offsets[i + 1]]
+        tasks.append((filename, mask_filename, flim_model, aper_corr, sncut,
+                      ra[idx], dec[idx], wave[idx],
+                      None if flux is None else flux[idx],
+                      None if ifuslot is None else ifuslot[idx]))
+        rows.append(idx)
+
+    if nproc > 1 and len(tasks) > 1:
+        with Pool(nproc) as pool:
+            results = pool.map(_shot_flux_limits, tasks)
+    else:
+        results = [_shot_flux_limits(task) for task in tasks]
+
+    flims = Table()
+    flims["f50"] = full(n, 999.0)
+    flims["sigma"] = full(n, 999.0)
+    flims["ifuslot"] = full(n, "", dtype="U11")
+    if flux is not None:
+        flims["completeness"] = zeros(n)
+
+    for idx, (f50, sigma, compl, found) in zip(rows, results):
+        flims["f50"][idx] = f50
+        flims["sigma"][idx] = sigma
+        flims["ifuslot"][idx] = found
+        if flux is not None:
+            flims["completeness"][idx] = compl
+
+    return flims
@@ -24,8 +24,12 @@ mpl.use("Agg")
 import matplotlib.pyplot as plt
 from numpy import (rint, array, around, multiply, isnan, meshgrid, mean, isfinite,
                    median, sqrt, divide, linspace, ones, log10, loadtxt, polyval, inf,
-                   repeat, newaxis, logical_not)
+                   newaxis, logical_not, deg2rad, rad2deg, sin, cos,
+                   allclose, asarray, broadcast_to, where, zeros, atleast_1d,
+                   empty, add)
+from numpy.linalg import inv
 from numpy.ma import array as maskedarray
+from numpy.ma import nomask
 from numpy import any as nany
 from scipy.interpolate import interp1d
 import astropy.io.fits as fits
@@ -65,6 +69,62 @@ def fleming_function(flux, flim, alpha):
     return 0.5*(1.0 + divide(fdiff, sqrt(1.0 + fdiff*fdiff)))
 
 
+class LazyNoiseArray(object):
+    """
+    Noise cube stored in a file that is only read
+    when needed, e.g. a tables.CArray in a
+    SensitivityCubeHDF5Container. Only the wavelength
+    slices or the box of pixels asked for are read,
+    so the file has to stay open while it's used
+
+    Parameters
+    ----------
+    node : array-like
+        the stored cube, anything with a shape
+        that can be sliced like a numpy array
+    divisor : float (optional)
+        divide the values read by this, e.g.
+        to remove a stored aperture correction
+
+    Attributes
+    ----------
+    shape : tuple
+        the shape of the cube
+    nread : int
+        number of values read so far
+    """
+    def __init__(self, node, divisor=1.0):
+        self.node = node
+        self.divisor = divisor
+        self.shape = tuple(node.shape)
+        self.nread = 0
+
+    def read(self, izlo=0, izhigh=None):
+        """
+        Read wavelength slices izlo to izhigh - 1,
+        default is the whole cube
+        """
+        data = self.node[izlo:izhigh]/self.divisor
+        self.nread += data.size
+
+        return data
+
+    def read_pixels(self, ix, iy, iz):
+        """
+        Read the values at pixel indices ix, iy, iz.
+        Only the box around the pixels is read
+        """
+        ix, iy, iz = asarray(ix), asarray(iy), asarray(iz)
+        if ix.size == 0:
+            return zeros(ix.shape)
+
+        xlo, ylo, zlo = ix.min(), iy.min(), iz.min()
+        box = self.node[zlo:iz.max() + 1, ylo:iy.max() + 1, xlo:ix.max() + 1]
+        self.nread += box.size
+
+        return box[iz - zlo, iy - ylo, ix - xlo]/self.divisor
+
+
 def read_cube(fn, datascale=1e-17):
     """
     Read a Karl sensitivity cube and
@@ -101,10 +161,12 @@ class SensitivityCube(object):
 
     Parameters
     ----------
-    sigmas : array
+    sigmas : array or LazyNoiseArray
         3D datacube of datascale/noise
         where noise is the noise on
-        a point source detection
+        a point source detection. A
+        LazyNoiseArray is only read 
+        where it's needed
     header : dict
         a dictionary of the headervalues to be stored in a
         FITS file
@@ -135,6 +197,11 @@ class SensitivityCube(object):
     ----------
     sigmas : array
         an array of the noise values
+    mask : array
+        the 2D spatial mask, True for good
+        pixels (None if no mask)
+    shape : tuple
+        the shape of the noise cube
     alpha_func : callable
         returns the Fleming alpha
         for an input wavelength
@@ -150,13 +217,6 @@ class SensitivityCube(object):
     def __init__(self, sigmas, header, wavelengths, alphas, aper_corr=1.0, 
                  nsigma=1.0, flim_model="hdr2pt1", mask=None): 
 
-        if type(mask) != type(None):
-            mask = logical_not(mask)
-            mask3d = repeat(mask[newaxis, :, :], sigmas.shape[0], axis=0)
-            self.sigmas = maskedarray(sigmas/nsigma, mask=mask3d, fill_value=999.0)
-        else:
-            self.sigmas = maskedarray(sigmas/nsigma, fill_value=999.0)
-
         self.nsigma = nsigma
 
         # Fix issue with header
@@ -170,6 +230,10 @@ class SensitivityCube(object):
         self.wcs = WCS(header)
         self.header = header
 
+        # precompute a fast world to pixel mapping if
+        # the WCS allows it
+        self._pixel_mapping = self._linear_pixel_mapping()
+
         # Deal with aperture corrections
         if aper_corr:
             self.aper_corr = aper_corr
@@ -180,7 +244,21 @@ class SensitivityCube(object):
         else:
             self.aper_corr = 1.0
 
-        self.sigmas = self.sigmas*self.aper_corr
+        if type(mask) != type(None):
+            self.mask = array(mask, dtype=bool)
+        else:
+            self.mask = None
+
+        self.shape = tuple(sigmas.shape)
+        self.fill_value = 999.0
+
+        # a lazy cube is only read in full if sigmas is used
+        if isinstance(sigmas, LazyNoiseArray):
+            self._lazy_sigmas = sigmas
+            self._sigmas = None
+        else:
+            self._lazy_sigmas = None
+            self._sigmas = self._masked_noise(sigmas)
 
         self.alphas = array(alphas)
         self.wavelengths = wavelengths
@@ -202,6 +280,41 @@ class SensitivityCube(object):
             raise e
 
 
+    def _scale_noise(self, data):
+        """ Apply nsigma and the aperture correction to stored noise """
+
+        # float64, as the masked array arithmetic used to return
+        data = asarray(data, dtype=float)/self.nsigma
+        data *= self.aper_corr
+
+        return data
+
+    def _masked_noise(self, data):
+        """
+        Return the noise as a masked array, the spatial mask
+        is stored once and the masked array only holds a
+        broadcast view of it
+        """
+        data = self._scale_noise(data)
+
+        if self.mask is not None:
+            mask3d = broadcast_to(logical_not(self.mask)[newaxis, :, :], data.shape)
+        else:
+            mask3d = nomask
+
+        return maskedarray(data, mask=mask3d, fill_value=self.fill_value, copy=False)
+
+    @property
+    def sigmas(self):
+        """ 
+        The noise cube as a masked array. A lazy cube is
+        read in full the first time this is used
+        """
+        if self._sigmas is None:
+            self._sigmas = self._masked_noise(self._lazy_sigmas.read())
+
+        return self._sigmas
+
     def get_alpha(self, ra, dec, lambda_):
         """
         Return the parameter controlling
@@ -298,10 +411,107 @@ class SensitivityCube(object):
             if wl < 3850.0:
                 wl = 3850.0
 
+            # scale the data in place, the mask is a read-only view
             if flux_calib_correction_file:
-                self.sigmas[iz, :, :] = rescale*self.sigmas[iz, :, :]*(1.0 - polyval(pvals, wl - 4600.0)) 
+                self.sigmas.data[iz, :, :] *= rescale*(1.0 - polyval(pvals, wl - 4600.0)) 
             else: 
-                self.sigmas[iz, :, :] = rescale*self.sigmas[iz, :, :]  
+                self.sigmas.data[iz, :, :] *= rescale
+
+    def _linear_pixel_mapping(self):
+        """
+        Precompute the parameters to convert ra, dec, wavelength
+        to pixels without calling the WCS, for the usual cubes
+        with a TAN projection and a linear wavelength axis that
+        is independent of the spatial axes
+
+        Returns
+        -------
+        mapping : dict or None
+            the parameters used by world2pix, or None
+            if the WCS is not of that form
+        """
+
+        wcs = self.wcs
+
+        if wcs.naxis != 3 or wcs.sip is not None or wcs.cpdis1 is not None \
+           or wcs.cpdis2 is not None or wcs.det2im1 is not None \
+           or wcs.det2im2 is not None:
+            return None
+
+        ctype = wcs.wcs.ctype
+        if not (ctype[0].endswith("-TAN") and ctype[1].endswith("-TAN")) \
+           or wcs.wcs.lng != 0 or wcs.wcs.lat != 1 or wcs.wcs.lonpole != 180.0 \
+           or len(wcs.wcs.get_pv()) > 0:
+            return None
+
+        # spatial and spectral axes must not mix
+        cd = wcs.pixel_scale_matrix
+        if nany(cd[2, :2] != 0.0) or nany(cd[:2, 2] != 0.0):
+            return None
+
+        ra0, dec0 = wcs.wcs.crval[0], wcs.wcs.crval[1]
+
+        # the wavelength axis in the units the WCS is called with,
+        # and check it is linear
+        lambdas = array([3500.0, 4500.0, 5500.0])
+        ignore, ignore, iz = wcs.wcs_world2pix(array([ra0]*3), array([dec0]*3),
+                                               lambdas, 0)
+        dz = (iz[2] - iz[0])/(lambdas[2] - lambdas[0])
+        z0 = iz[0] - dz*lambdas[0]
+        if not allclose(iz[1], z0 + dz*lambdas[1], rtol=0.0, atol=1e-6):
+            return None
+
+        return {"ra0": deg2rad(ra0), "sin_dec0": sin(deg2rad(dec0)),
+                "cos_dec0": cos(deg2rad(dec0)), "cdinv": inv(cd[:2, :2]),
+                "crpix": wcs.wcs.crpix[:2] - 1.0, "z0": z0, "dz": dz}
+
+    def world2pix(self, ra, dec, lambda_):
+        """
+        Convert ra, dec, wavelength to (non-integer)
+        pixel positions in the cube. The same as
+        self.wcs.wcs_world2pix(ra, dec, lambda_, 0),
+        but with precomputed parameters for the usual
+        TAN projection and linear wavelength axis
+
+        Parameters
+        ----------
+        ra, dec : arrays
+            right ascension &
+            declination of source
+        lambda_ : array
+            wavelength in Angstrom
+
+        Returns
+        -------
+        x, y, z : arrays
+            pixel positions, zero indexed
+        """
+        mapping = self._pixel_mapping
+
+        if mapping is None:
+            return self.wcs.wcs_world2pix(ra, dec, lambda_, 0)
+
+        ra = deg2rad(asarray(ra, dtype=float))
+        dec = deg2rad(asarray(dec, dtype=float))
+        lambda_ = asarray(lambda_, dtype=float)
+
+        # gnomonic projection to intermediate world
+        # coordinates in degrees
+        dra = ra - mapping["ra0"]
+        sin_dec = sin(dec)
+        cos_dec = cos(dec)
+        cos_dra = cos(dra)
+        cos_c = mapping["sin_dec0"]*sin_dec + mapping["cos_dec0"]*cos_dec*cos_dra
+        xi = rad2deg(cos_dec*sin(dra)/cos_c)
+        eta = rad2deg((mapping["cos_dec0"]*sin_dec 
+                       - mapping["sin_dec0"]*cos_dec*cos_dra)/cos_c)
+
+        cdinv = mapping["cdinv"]
+        x = cdinv[0, 0]*xi + cdinv[0, 1]*eta + mapping["crpix"][0]
+        y = cdinv[1, 0]*xi + cdinv[1, 1]*eta + mapping["crpix"][1]
+        z = mapping["z0"] + mapping["dz"]*lambda_
+
+        return x, y, z
 
     def radecwltoxyz(self, ra, dec, lambda_):
         """
@@ -323,11 +533,96 @@ class SensitivityCube(object):
         """
 
         lambda_ = array(lambda_)
-        ix,iy,iz = self.wcs.wcs_world2pix(ra, dec, lambda_, 0)
+        ix,iy,iz = self.world2pix(ra, dec, lambda_)
 
         return array(around(ix), dtype=int), array(around(iy), dtype=int), \
             array(around(iz), dtype=int)
 
+    def noise_at(self, ix, iy, iz):
+        """
+        Return the noise at pixel indices of the cube, with
+        masked pixels set to the fill value of sigmas (999). The
+        same as self.sigmas.filled()[iz, iy, ix] without
+        copying the cube
+
+        Parameters
+        ----------
+        ix, iy, iz : arrays of int
+            indices in the cube
+
+        Returns
+        -------
+        noise : array
+        """
+        if self._sigmas is None:
+            noise = self._scale_noise(self._lazy_sigmas.read_pixels(ix, iy, iz))
+        else:
+            noise = self._sigmas.data[iz, iy, ix]
+
+        if self.mask is not None:
+            noise = where(self.mask[iy, ix], noise, self.fill_value)
+
+        return noise
+
+    def noise_slice(self, izlo, izhigh):
+        """
+        Return the noise in the wavelength slices izlo to
+        izhigh - 1, with masked pixels set to the fill value
+        of sigmas (999). Only the slices are copied
+
+        Parameters
+        ----------
+        izlo, izhigh : int
+            range of wavelength slices
+
+        Returns
+        -------
+        noise : array
+        """
+        noise = self._read_noise(izlo, izhigh)
+        if self.mask is not None:
+            noise = where(self.mask[newaxis, :, :], noise, self.fill_value)
+
+        return noise
+
+    def _read_noise(self, izlo, izhigh):
+        """ Return a copy of the noise in slices izlo to izhigh - 1 """
+        izlo, izhigh = int(izlo), int(izhigh)
+        if self._sigmas is None:
+            return self._scale_noise(self._lazy_sigmas.read(izlo, izhigh))
+        else:
+            return self._sigmas.data[izlo:izhigh, :, :].copy()
+
+    def get_slice(self, lambda_):
+        """
+        Return the noise in the wavelength slice 
+        closest to lambda_, only this slice
+        is read for a lazy cube
+
+        Parameters
+        ----------
+        lambda_ : float
+            wavelength in Angstrom
+
+        Returns
+        -------
+        noise : masked array
+            2D noise slice, masked where
+            the spatial mask is bad
+        """
+        ix, iy, iz = self.radecwltoxyz(self.wcs.wcs.crval[0], self.wcs.wcs.crval[1], 
+                                       lambda_)
+        if iz < 0 or iz >= self.shape[0]:
+            raise WavelengthException("Wavelength {:f} outside of cube".format(lambda_))
+
+        noise = self._read_noise(iz, iz + 1)[0]
+        if self.mask is not None:
+            mask = logical_not(self.mask)
+        else:
+            mask = nomask
+
+        return maskedarray(noise, mask=mask, fill_value=self.fill_value)
+
     def get_f50(self, ra, dec, lambda_, sncut):
         """
         Get 50% completeness flux from the cube at
@@ -354,15 +649,15 @@ class SensitivityCube(object):
         ix, iy, iz = self.radecwltoxyz(ra, dec, lambda_)
 
         # Check for stuff outside of cube
-        bad_vals = (ix >= self.sigmas.shape[2]) | (ix < 0) 
-        bad_vals = bad_vals | (iy >= self.sigmas.shape[1]) | (iy < 0) 
-        bad_vals = bad_vals | (iz >= self.sigmas.shape[0]) | (iz < 0) 
+        bad_vals = (ix >= self.shape[2]) | (ix < 0) 
+        bad_vals = bad_vals | (iy >= self.shape[1]) | (iy < 0) 
+        bad_vals = bad_vals | (iz >= self.shape[0]) | (iz < 0) 
  
-        ix[(ix >= self.sigmas.shape[2]) | (ix < 0)] = 0
-        iy[(iy >= self.sigmas.shape[1]) | (iy < 0)] = 0
-        iz[(iz >= self.sigmas.shape[0]) | (iz < 0)] = 0
+        ix[(ix >= self.shape[2]) | (ix < 0)] = 0
+        iy[(iy >= self.shape[1]) | (iy < 0)] = 0
+        iz[(iz >= self.shape[0]) | (iz < 0)] = 0
 
-        f50s = self.f50_from_noise(self.sigmas.filled()[iz, iy, ix], sncut)
+        f50s = self.f50_from_noise(self.noise_at(ix, iy, iz), sncut)
 
         # Support arrays and floats
         try:
@@ -397,15 +692,15 @@ class SensitivityCube(object):
         ix, iy, iz = self.radecwltoxyz(ra, dec, lambda_)
 
         # Check for stuff outside of cube
-        bad_vals = (ix >= self.sigmas.shape[2]) | (ix < 0) 
-        bad_vals = bad_vals | (iy >= self.sigmas.shape[1]) | (iy < 0) 
-        bad_vals = bad_vals | (iz >= self.sigmas.shape[0]) | (iz < 0) 
+        bad_vals = (ix >= self.shape[2]) | (ix < 0) 
+        bad_vals = bad_vals | (iy >= self.shape[1]) | (iy < 0) 
+        bad_vals = bad_vals | (iz >= self.shape[0]) | (iz < 0) 
 
-        ix[(ix >= self.sigmas.shape[2]) | (ix < 0)] = 0
-        iy[(iy >= self.sigmas.shape[1]) | (iy < 0)] = 0
-        iz[(iz >= self.sigmas.shape[0]) | (iz < 0)] = 0
+        ix[(ix >= self.shape[2]) | (ix < 0)] = 0
+        iy[(iy >= self.shape[1]) | (iy < 0)] = 0
+        iz[(iz >= self.shape[0]) | (iz < 0)] = 0
 
-        noise = self.sigmas.filled()[iz, iy, ix]
+        noise = self.noise_at(ix, iy, iz)
         snr = flux/noise
 
         # Support arrays and floats
@@ -476,7 +771,7 @@ class SensitivityCube(object):
 
 
     def return_wlslice_completeness(self, flux, lambda_low, lambda_high, 
-                                    sncut, noise_cut=1e-16):
+                                    sncut, noise_cut=1e-16, max_elements=100000):
         """
         Return completeness of a wavelength slice. NaN completeness
         values are replaced with zeroes, noise values greater than
@@ -496,6 +791,9 @@ class SensitivityCube(object):
         noise_cut : float
             remove areas with more noise
             than this. Default: 1e-16 erg/s/cm2
+        max_elements : int
+            the most flux and pixel pairs to
+            compute completeness for at once
  
         Return
         ------
@@ -510,10 +808,7 @@ class SensitivityCube(object):
 
         ix, iy, izlo = self.radecwltoxyz(self.wcs.wcs.crval[0], self.wcs.wcs.crval[1], lambda_low)
         ix, iy, izhigh = self.radecwltoxyz(self.wcs.wcs.crval[0], self.wcs.wcs.crval[1], lambda_high)
-        noise = self.sigmas.filled()[izlo:(izhigh + 1), :, :]
-        noise = noise[(noise < noise_cut) & isfinite(noise)] 
-
-        f50s = self.f50_from_noise(noise, sncut)
+        noise = self.noise_slice(izlo, izhigh + 1)
 
         if len(self.alphas.shape) > 1:
             alphas = self.alphas[izlo:(izhigh + 1), :, :] 
@@ -521,19 +816,124 @@ class SensitivityCube(object):
             # rough approximation to lambda varying across window
             alphas = self.alpha_func(0.5*(lambda_low + lambda_high))
 
-        compls = []
-        for f in flux:
-            compl = fleming_function(f, f50s, alphas)       
-            compl[isnan(compl)] = 0.0
+        return self._slice_completeness(flux, noise, alphas, sncut, noise_cut,
+                                        max_elements)
 
-            # works so long as pixels equal area
-            if len(compl) > 0:
-                compls.append(mean(compl))
+    def return_wlslice_completeness_curves(self, flux, lambda_low, lambda_high,
+                                           sncut, noise_cut=1e-16, 
+                                           max_elements=100000):
+        """
+        Return completeness versus flux for many wavelength
+        slices at once, the same as calling 
+        return_wlslice_completeness for each slice but
+        the noise is only read once
+
+        Parameters
+        ----------
+        flux : array
+            fluxes of objects
+        lambda_low, lambda_high : array
+            wavelength slices in Angstrom
+            (includes these slices)
+        sncut : float
+            the detection significance (S/N) cut
+            applied to the data
+        noise_cut : float
+            remove areas with more noise
+            than this. Default: 1e-16 erg/s/cm2
+        max_elements : int
+            the most flux and pixel pairs to
+            compute completeness for at once
+
+        Return
+        ------
+        fracdet : array
+            fraction detected, of shape 
+            (number of slices, number of fluxes)
+
+        """
+        lambda_low = atleast_1d(asarray(lambda_low, dtype=float))
+        lambda_high = atleast_1d(asarray(lambda_high, dtype=float))
+
+        if nany(lambda_low < 3000.0) or nany(lambda_low > 6000.0):
+            raise WavelengthException("""Odd wavelength value. Are you
+                                         sure it's in Angstrom?""")
+
+        ra = self.wcs.wcs.crval[0]*ones(len(lambda_low))
+        dec = self.wcs.wcs.crval[1]*ones(len(lambda_low))
+        ix, iy, izlo = self.radecwltoxyz(ra, dec, lambda_low)
+        ix, iy, izhigh = self.radecwltoxyz(ra, dec, lambda_high)
+
+        # read the noise of all the slices together
+        zmin = izlo.min()
+        noise = self.noise_slice(zmin, izhigh.max() + 1)
+
+        fracdet = zeros((len(lambda_low), len(atleast_1d(flux))))
+        for i, (zlo, zhigh) in enumerate(zip(izlo, izhigh)):
+            if len(self.alphas.shape) > 1:
+                alphas = self.alphas[zlo:(zhigh + 1), :, :] 
             else:
-                compls.append(0.0)
+                alphas = self.alpha_func(0.5*(lambda_low[i] + lambda_high[i]))
+
+            fracdet[i] = self._slice_completeness(flux, noise[(zlo - zmin):(zhigh - zmin + 1)],
+                                                  alphas, sncut, noise_cut, max_elements)
+
+        return fracdet
+
+    def _slice_completeness(self, flux, noise, alphas, sncut, noise_cut, 
+                            max_elements):
+        """
+        Mean completeness of the pixels in noise for each 
+        flux, excluding pixels noisier than noise_cut or 
+        with NaN noise. The fluxes are done in chunks so
+        at most max_elements values are computed at once
+        """
+        good = (noise < noise_cut) & isfinite(noise) 
+        f50s = self.f50_from_noise(noise[good], sncut)
+        npix = len(f50s)
+
+        if len(asarray(alphas).shape) > 0:
+            alphas = asarray(alphas)[good]
+
+        flux = atleast_1d(asarray(flux, dtype=float))
+        compls = zeros(len(flux))
+
+        if npix == 0:
+            return compls
+
+        # fleming_function with the logs only taken once per flux
+        # and once per pixel. Pixels with NaN completeness count
+        # as zero, so they're dropped here but still in npix
+        mag_flux = -2.5*log10(flux)
+        mag_f50 = 2.5*log10(f50s)
+        finite = isfinite(mag_f50)
+        mag_f50 = mag_f50[finite]
+        if len(asarray(alphas).shape) > 0:
+            alphas = alphas[finite]
+
+        # work in place on two buffers of at most max_elements
+        nflux = max(1, int(max_elements // max(len(mag_f50), 1)))
+        fdiff = empty((min(nflux, len(flux)), len(mag_f50)))
+        tmp = empty(fdiff.shape)
+
+        for start in range(0, len(flux), nflux):
+            stop = min(start + nflux, len(flux))
+            fd = fdiff[:(stop - start)]
+            tm = tmp[:(stop - start)]
+
+            add(mag_flux[start:stop, newaxis], mag_f50, out=fd)
+            multiply(fd, alphas, out=fd)
+            multiply(fd, fd, out=tm)
+            tm += 1.0
+            sqrt(tm, out=tm)
+            divide(fd, tm, out=fd)
+
+            # works so long as pixels equal area
+            compls[start:stop] = 0.5*(len(mag_f50) + fd.sum(axis=1))/npix
 
+        compls[isnan(compls)] = 0.0
 
-        return array(compls)
+        return compls
 
     def return_wlslice_f50(self, lambda_low, lambda_high, 
                            sncut, noise_cut=1e-16):
@@ -572,7 +972,7 @@ class SensitivityCube(object):
  
         ix, iy, izlo = self.radecwltoxyz(self.wcs.wcs.crval[0], self.wcs.wcs.crval[1], lambda_low)
         ix, iy, izhigh = self.radecwltoxyz(self.wcs.wcs.crval[0], self.wcs.wcs.crval[1], lambda_high)
-        noise = self.sigmas.filled()[izlo:(izhigh + 1), :, :]
+        noise = self.noise_slice(izlo, izhigh + 1)
         noise = noise[(noise < noise_cut) & (noise > 0)]
   
         f50 = self.f50_from_noise(median(noise), sncut)
@@ -11,17 +11,435 @@ Created on 2020/09/08
 
 from __future__ import print_function
 
+import os
+import os.path as op
+import hashlib
+
 import numpy as np
+import tables as tb
 
 from astropy.table import Table, join
 import astropy.units as u
-from astropy.coordinates import SkyCoord
+from scipy.spatial import cKDTree
 
 from hetdex_api.config import HDRconfig
-from hetdex_api.survey import FiberIndex
+from hetdex_api.survey import FiberIndex, radec_to_unit_vectors, angle_to_chord
 
 config = HDRconfig()
 
+# meteor tables read by load_meteor_table(), keyed by the absolute
+# filename, with the size and modification time they were read from
+_meteor_tables = {}
+
+# amp flag lookups built by load_amp_flag_lookup(), keyed by the
+# absolute filename, with the size and modification time they were
+# built from
+_amp_flag_lookups = {}
+
+# the last table passed to the amp_flag_* functions and its lookup
+_amp_flag_table_lookup = [None, None]
+
+
+def _fold_keys(keys, values, interval_keys, interval_low, interval_high):
+    """
+    Fold a key and an integer value into one sortable int64, for
+    the entries and for the bounds of the intervals. Every key gets
+    its own block of values, so a sorted search never mixes keys.
+    """
+    values = np.atleast_1d(np.asarray(values, dtype=np.int64))
+    interval_low = np.atleast_1d(np.asarray(interval_low, dtype=np.int64))
+    interval_high = np.atleast_1d(np.asarray(interval_high, dtype=np.int64))
+
+    # integer code for each key, shared by entries and intervals
+    codes = np.unique(
+        np.concatenate([interval_keys, keys]), return_inverse=True
+    )[1].reshape(-1)
+    interval_codes = codes[: np.size(interval_keys)]
+    codes = codes[np.size(interval_keys):]
+
+    offset = min(values.min(), interval_low.min(), interval_high.min())
+    span = max(values.max(), interval_low.max(), interval_high.max()) - offset + 1
+
+    return (codes * span + (values - offset),
+            interval_codes * span + (interval_low - offset),
+            interval_codes * span + (interval_high - offset))
+
+
+def flag_in_intervals(keys, values, interval_keys, interval_low, interval_high):
+    """
+    Vectorized test of whether each (key, value) pair falls in any
+    of the inclusive [low, high] intervals listed for that key. For
+    example, whether a detection's date is inside one of the date
+    ranges of a bad amp with the same multiframe.
+
+    The intervals are grouped by key and sorted once, then every
+    entry is located with a single binary search, so this scales as
+    O((N + M) log M) rather than looping over the M intervals.
+
+    Parameters
+    ----------
+    keys : array
+        key of each entry, e.g. multiframe
+    values : array of int
+        integer value of each entry to test, e.g. date
+    interval_keys : array
+        key of each interval
+    interval_low, interval_high : array of int
+        inclusive bounds of each interval
+
+    Returns
+    -------
+    flag : array of bool
+        True where the entry falls in an interval for its key
+
+    Examples
+    --------
+    badamps = Table.read(config.badamp2, format='ascii')
+    bad = flag_in_intervals(detects.multiframe, detects.date,
+                            badamps['multiframe'], badamps['date_start'],
+                            badamps['date_end'])
+    """
+
+    keys = np.atleast_1d(np.asarray(keys))
+    interval_keys = np.atleast_1d(np.asarray(interval_keys))
+
+    flag = np.zeros(np.size(keys), dtype=bool)
+
+    if np.size(keys) == 0 or np.size(interval_keys) == 0:
+        return flag
+
+    entry, low, high = _fold_keys(keys, values, interval_keys,
+                                  interval_low, interval_high)
+
+    order = np.argsort(low, kind="stable")
+    low = low[order]
+    # running maximum handles overlapping intervals of the same key,
+    # ends from earlier keys are always below the current key's block
+    high = np.maximum.accumulate(high[order])
+
+    idx = np.searchsorted(low, entry, side="right") - 1
+    inside = idx >= 0
+    flag[inside] = entry[inside] <= high[idx[inside]]
+
+    return flag
+
+
+def flag_in_boxes(keys, x, y, box_keys, x1, x2, y1, y2):
+    """
+    Vectorized test of whether each (key, x, y) entry falls in any
+    of the inclusive rectangles [x1, x2] x [y1, y2] listed for that
+    key. For example, whether a detection's (x_raw, y_raw) is in
+    one of the bad pixel boxes on its multiframe.
+
+    Entries are grouped by key and sorted on x once. Each box then
+    finds its candidate entries with a binary search on x and only
+    those candidates are tested in y, so any rectangular CCD defect
+    list can be applied without looping over the boxes.
+
+    Parameters
+    ----------
+    keys : array
+        key of each entry, e.g. multiframe
+    x, y : array of int
+        position of each entry, e.g. x_raw, y_raw
+    box_keys : array
+        key of each box
+    x1, x2, y1, y2 : array of int
+        inclusive corners of each box
+
+    Returns
+    -------
+    flag : array of bool
+        True where the entry falls in a box for its key
+
+    Examples
+    --------
+    badpix = ascii.read(config.badpix, names=["multiframe", "x1", "x2", "y1", "y2"])
+    bad = flag_in_boxes(detects.multiframe, detects.x_raw, detects.y_raw,
+                        badpix["multiframe"], badpix["x1"], badpix["x2"],
+                        badpix["y1"], badpix["y2"])
+    """
+
+    keys = np.atleast_1d(np.asarray(keys))
+    box_keys = np.atleast_1d(np.asarray(box_keys))
+    y = np.atleast_1d(np.asarray(y))
+    y1 = np.atleast_1d(np.asarray(y1))
+    y2 = np.atleast_1d(np.asarray(y2))
+
+    flag = np.zeros(np.size(keys), dtype=bool)
+
+    if np.size(keys) == 0 or np.size(box_keys) == 0:
+        return flag
+
+    entry, low, high = _fold_keys(keys, x, box_keys, x1, x2)
+
+    order = np.argsort(entry, kind="stable")
+    entry = entry[order]
+
+    # range of sorted entries inside each box's x interval
+    start = np.searchsorted(entry, low, side="left")
+    counts = np.maximum(np.searchsorted(entry, high, side="right") - start, 0)
+
+    # expand to (box, entry) candidate pairs and test them in y
+    box_idx = np.repeat(np.arange(np.size(box_keys)), counts)
+    within = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    entry_idx = order[np.repeat(start, counts) + within]
+
+    inside = (y[entry_idx] >= y1[box_idx]) & (y[entry_idx] <= y2[box_idx])
+    flag[entry_idx[inside]] = True
+
+    return flag
+
+
+def _as_str_array(values):
+    """
+    Return values as a numpy unicode array, decoding bytes
+    columns read from FITS/HDF5 files
+    """
+    values = np.atleast_1d(np.asarray(values))
+    if values.dtype.kind == "S":
+        values = np.char.decode(values)
+    return values.astype(str)
+
+
+def build_amp_flag_lookup(bad_amps_table):
+    """
+    Build a compact lookup of the amp flags. Each (shotid, multiframe)
+    row is folded into a single sorted int64 key so that a batch of
+    lookups is one np.searchsorted call rather than a string
+    comparison over the full table per lookup
+
+    Parameters
+    ----------
+    bad_amps_table
+        astropy table containing the bad amp flag values with columns
+        shotid, multiframe and flag. This can be retrieved from
+        config.badamp
+
+    Returns
+    -------
+    lookup : dict
+        with the sorted unique multiframe names ('multiframes'), the
+        sorted folded keys ('keys') and the matching flags ('flags')
+    """
+
+    multiframe = _as_str_array(bad_amps_table["multiframe"])
+    shotid = np.asarray(bad_amps_table["shotid"], dtype=np.int64)
+
+    multiframes, codes = np.unique(multiframe, return_inverse=True)
+    keys = shotid * np.int64(len(multiframes)) + codes.ravel()
+
+    order = np.argsort(keys, kind="stable")
+
+    return {
+        "multiframes": multiframes,
+        "keys": keys[order],
+        "flags": np.asarray(bad_amps_table["flag"])[order].astype(bool),
+    }
+
+
+def _file_signature(filename):
+    """
+    Return the absolute path, size and modification time of a
+    file, which change whenever the file is rewritten
+    """
+    stat = os.stat(filename)
+    return (op.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+
+def _amp_flag_lookup_file(filename, cache_dir):
+    """
+    Name of the on-disk lookup for an amp flag file, keyed by
+    the path, size and modification time of the file
+    """
+    sha = hashlib.sha1(
+        "{:s} {:d} {:d}".format(*_file_signature(filename)).encode()
+    )
+    return op.join(cache_dir, "amp_flag_{:s}.npz".format(sha.hexdigest()[:16]))
+
+
+def load_amp_flag_lookup(filename=None, cache_dir=None, reload=False):
+    """
+    Return the amp flag lookup for an amp_flag.fits file. The lookup
+    is built once per session and, if cache_dir is given, saved there
+    so that later sessions skip reading the FITS table. It is rebuilt
+    when the size or modification time of the file change
+
+    Parameters
+    ----------
+    filename : str (optional)
+        path to the amp flag file, default is config.badamp
+    cache_dir : str (optional)
+        directory to keep the lookup in between sessions
+    reload : bool (optional)
+        build the lookup from the file, ignoring the
+        lookups kept in memory and in cache_dir
+
+    Returns
+    -------
+    lookup : dict
+        see build_amp_flag_lookup()
+    """
+    global config
+
+    if filename is None:
+        filename = config.badamp
+
+    signature = _file_signature(filename)
+    if not reload and signature[0] in _amp_flag_lookups:
+        stored, lookup = _amp_flag_lookups[signature[0]]
+        if stored == signature:
+            return lookup
+
+    cachefile = None
+    if cache_dir is not None:
+        cachefile = _amp_flag_lookup_file(filename, cache_dir)
+
+    if cachefile is not None and op.isfile(cachefile) and not reload:
+        with np.load(cachefile) as data:
+            lookup = {name: data[name] for name in data.files}
+    else:
+        lookup = build_amp_flag_lookup(Table.read(filename))
+        if cachefile is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmpfile = cachefile[:-4] + ".tmp{:d}.npz".format(os.getpid())
+            np.savez(tmpfile, **lookup)
+            os.replace(tmpfile, cachefile)
+
+    _amp_flag_lookups[signature[0]] = (signature, lookup)
+
+    return lookup
+
+
+def _amp_flag_lookup_for_table(bad_amps_table):
+    """
+    Return the lookup for an amp flag table passed to one of
+    the single-position functions, building it on first use
+    """
+    if bad_amps_table is None:
+        return load_amp_flag_lookup()
+
+    if isinstance(bad_amps_table, dict):
+        return bad_amps_table
+
+    # only the last table is kept, so repeated calls with the same
+    # table build its lookup once
+    if _amp_flag_table_lookup[0] is not bad_amps_table:
+        _amp_flag_table_lookup[:] = [bad_amps_table, build_amp_flag_lookup(bad_amps_table)]
+
+    return _amp_flag_table_lookup[1]
+
+
+def amp_flag_shot_slice(lookup, shotid):
+    """
+    Return the slice of a lookup from load_amp_flag_lookup()
+    holding the amps of one shot. The keys of a shot are
+    contiguous, so this is two binary searches
+
+    Examples
+    --------
+    sl = amp_flag_shot_slice(lookup, 20190201012)
+    multiframes = lookup['multiframes'][lookup['keys'][sl] % len(lookup['multiframes'])]
+    flags = lookup['flags'][sl]
+    """
+    nmf = np.int64(len(lookup["multiframes"]))
+    start, stop = np.searchsorted(lookup["keys"], [np.int64(shotid) * nmf,
+                                                   (np.int64(shotid) + 1) * nmf])
+    return slice(start, stop)
+
+
+def _amp_flag_search(lookup, shotid, multiframe):
+    """
+    Search a lookup for (shotid, multiframe) pairs and return
+    the flags and whether each pair was found
+    """
+    shotid, multiframe = np.broadcast_arrays(
+        np.atleast_1d(np.asarray(shotid, dtype=np.int64)), _as_str_array(multiframe)
+    )
+
+    multiframes = lookup["multiframes"]
+    keys = lookup["keys"]
+
+    flag = np.zeros(shotid.shape, dtype=bool)
+    if len(multiframes) == 0 or len(keys) == 0:
+        return flag, np.zeros(shotid.shape, dtype=bool)
+
+    codes = np.clip(np.searchsorted(multiframes, multiframe), 0, len(multiframes) - 1)
+    known = multiframes[codes] == multiframe
+
+    query = shotid * np.int64(len(multiframes)) + codes
+    idx = np.clip(np.searchsorted(keys, query), 0, len(keys) - 1)
+    found = known & (keys[idx] == query)
+
+    flag[found] = lookup["flags"][idx[found]]
+
+    return flag, found
+
+
+def amp_flag_from_shotid_multiframe(shotid, multiframe, bad_amps_table=None,
+                                    missing=False):
+    """
+    Returns the amp flags for arrays of (shotid, multiframe) pairs
+
+    Parameters
+    ----------
+    shotid
+        integer shotid(s)
+    multiframe
+        multiframe string(s), e.g. 'multi_319_083_023_LL'. Must be
+        broadcastable against shotid
+    bad_amps_table
+        astropy table containing the bad amp flag values or a lookup
+        from load_amp_flag_lookup(). Default is the table in
+        config.badamp
+    missing
+        value returned for pairs not in the table
+
+    Returns
+    -------
+    flag : bool array
+        True if the amp is usable, False if flagged bad
+    """
+
+    flag, found = _amp_flag_search(_amp_flag_lookup_for_table(bad_amps_table),
+                                   shotid, multiframe)
+    flag[~found] = missing
+
+    return flag
+
+
+def amp_flag_from_fiberids(fiberids, bad_amps_table=None, missing=False):
+    """
+    Returns the amp flags for an array of fiber_id strings
+    (e.g. '20180124010_1_multi_319_083_023_LL_045')
+
+    Parameters
+    ----------
+    fiberids
+        fiber_id string(s)
+    bad_amps_table
+        astropy table containing the bad amp flag values or a lookup
+        from load_amp_flag_lookup(). Default is the table in
+        config.badamp
+    missing
+        value returned for fibers whose amp is not in the table
+
+    Returns
+    -------
+    flag : bool array
+        True if the amp is usable, False if flagged bad
+    """
+
+    fiberids = _as_str_array(fiberids)
+
+    shotid = fiberids.astype("U11").astype(np.int64)
+    multiframe = np.array([fiberid[14:34] for fiberid in fiberids], dtype="U20")
+
+    return amp_flag_from_shotid_multiframe(shotid, multiframe,
+                                           bad_amps_table=bad_amps_table,
+                                           missing=missing)
+
+
 def amp_flag_from_coords(coords, FibIndex, bad_amps_table, radius=3.*u.arcsec, shotid=None):
     """
     Returns a boolean flag whether the amp has been flagged usable
@@ -53,6 +471,7 @@ def amp_flag_from_coords(coords, FibIndex, bad_amps_table, radius=3.*u.arcsec, s
     --------
     from hetdex_api.config import HDRconfig
     from hetdex_api.mask import *
+    from astropy.coordinates import SkyCoord
 
     config = HDRconfig()
     bad_amps_table = Table.read(config.badamp)
@@ -70,19 +489,10 @@ def amp_flag_from_coords(coords, FibIndex, bad_amps_table, radius=3.*u.arcsec, s
                                         radius=radius,
                                         shotid=shotid)
     if np.size(fiber_table) > 0:
-        mf_list = np.unique(fiber_table['multiframe']).astype(str)
-        
-        flags = []
-        for mf in mf_list:
-
-            sel = bad_amps_table['multiframe'] == mf
-            
-            if shotid is not None:
-                sel_shot = bad_amps_table['shotid'] == shotid
-                sel = sel*sel_shot
-
-            flags.append(bad_amps_table['flag'][sel][0])
-
+        flags = amp_flag_from_shotid_multiframe(fiber_table['shotid'],
+                                                fiber_table['multiframe'],
+                                                bad_amps_table=bad_amps_table,
+                                                missing=True)
         amp_flag = np.all(flags)
     else:
         amp_flag = None
@@ -114,10 +524,13 @@ def amp_flag_from_fiberid(fiberid, bad_amps_table):
 
     shotid = int(fiberid[0:11])
     mf = fiberid[14:34]
-    
-    sel = (bad_amps_table['shotid'] == shotid) * (bad_amps_table['multiframe'] == mf)
 
-    return bad_amps_table['flag'][sel][0]
+    flag, found = _amp_flag_search(_amp_flag_lookup_for_table(bad_amps_table),
+                                   shotid, mf)
+    if not found[0]:
+        raise IndexError("No amp flag for {}".format(fiberid))
+
+    return flag[0]
 
 
 def amp_flag_from_closest_fiber(coords, FibIndex, bad_amps_table,
@@ -166,6 +579,174 @@ def amp_flag_from_closest_fiber(coords, FibIndex, bad_amps_table,
     return flag
 
     
+def amp_flag_from_closest_fibers(ra, dec, fiber_table, bad_amps_table=None,
+                                 maxdistance=8.*u.arcsec):
+    """
+    Vectorized amp_flag_from_closest_fiber() for many positions
+    in one shot. The closest fiber to every position is found with
+    one cKDTree query against the fibers of the shot
+
+    Parameters
+    ----------
+    ra, dec : array
+        positions in degrees
+    fiber_table
+        table of the fibers in the shot with columns shotid, ra, dec
+        and multiframe, e.g. from FiberIndex.get_shot_fibers()
+    bad_amps_table
+        astropy table containing the bad amp flag values or a lookup
+        from load_amp_flag_lookup(). Default is the table in
+        config.badamp
+    maxdistance
+        The max distance you want to search for a nearby fiber.
+        Default is 8.*u.arcsec
+
+    Returns
+    -------
+    flag : bool array
+        True if the amp of the closest fiber is usable. False if it
+        is flagged bad or has no entry in the amp flag table
+    has_fiber : bool array
+        False where no fiber is within maxdistance, flag is True there
+    """
+
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+
+    flag = np.ones(ra.shape, dtype=bool)
+    has_fiber = np.zeros(ra.shape, dtype=bool)
+
+    if np.size(fiber_table) == 0:
+        return flag, has_fiber
+
+    tree = cKDTree(radec_to_unit_vectors(fiber_table['ra'], fiber_table['dec']))
+    dist, idx = tree.query(radec_to_unit_vectors(ra.ravel(), np.ravel(dec)),
+                           distance_upper_bound=angle_to_chord(maxdistance))
+
+    has_fiber = (idx < tree.n).reshape(ra.shape)
+    idx = idx.reshape(ra.shape)[has_fiber]
+
+    flag[has_fiber] = amp_flag_from_shotid_multiframe(
+        np.asarray(fiber_table['shotid'])[idx],
+        _as_str_array(fiber_table['multiframe'])[idx],
+        bad_amps_table=bad_amps_table,
+        missing=False,
+    )
+
+    return flag, has_fiber
+
+
+def load_meteor_table(filename=None, reload=False):
+    """
+    Read the meteor streak table once and keep it for
+    later calls, it is read again when the size or
+    modification time of the file change
+
+    Parameters
+    ----------
+    filename : str (optional)
+        path to the meteor file, default is config.meteor
+    reload : bool (optional)
+        read the file, ignoring the table kept in memory
+
+    Returns
+    -------
+    met_tab : astropy.table.Table
+        table with shotid and the line parameters a, b
+        of the streak DEC = a + RA*b (degrees)
+    """
+    global config
+
+    if filename is None:
+        filename = config.meteor
+
+    signature = _file_signature(filename)
+    if not reload and signature[0] in _meteor_tables:
+        stored, met_tab = _meteor_tables[signature[0]]
+        if stored == signature:
+            return met_tab
+
+    met_tab = Table.read(filename, format='ascii')
+    _meteor_tables[signature[0]] = (signature, met_tab)
+
+    return met_tab
+
+
+def meteor_distance_from_radec(ra, dec, a, b):
+    """
+    Angular distance from positions to the meteor streak
+    line DEC = a + RA*b, all in degrees. The line is
+    treated as straight in the tangent plane at each
+    position (RA scaled by cos(dec)), which is exact for
+    the few arcsec scales the meteor mask cares about.
+
+    Parameters
+    ----------
+    ra, dec : array
+        positions in degrees
+    a, b : float
+        line parameters from the meteor table
+
+    Returns
+    -------
+    dist : array
+        perpendicular distance in degrees
+    """
+    cos_dec = np.cos(np.deg2rad(dec))
+
+    return np.abs(a + b*ra - dec) / np.sqrt(1.0 + np.square(b / cos_dec))
+
+
+def meteor_flag_from_radec(ra, dec, shotid, streaksize=12.*u.arcsec, met_tab=None):
+    """
+    Vectorized meteor flag for many positions. Each
+    position is only compared to the streaks of its own shot
+
+    Parameters
+    ----------
+    ra, dec : array
+        positions in degrees
+    shotid : int or array
+        shotid of each position, or one shotid for all
+    streaksize
+        an astropy quantity object defining how far off the
+        perpendicular line of the meteor streak to mask out. Default
+        is 12*u.arcsec
+    met_tab : astropy.table.Table (optional)
+        meteor table, default is load_meteor_table()
+
+    Returns
+    -------
+    flag : array of bool
+        True if no meteor falls within streaksize
+        False if a meteor falls within streaksize
+    """
+
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+    shape = np.shape(ra)
+    ra = ra.ravel()
+    dec = np.ravel(np.asarray(dec, dtype=float))
+    shotid = np.broadcast_to(np.atleast_1d(shotid), shape).ravel()
+
+    if met_tab is None:
+        met_tab = load_meteor_table()
+
+    flag = np.ones(np.shape(ra), dtype=bool)
+
+    maxdist = streaksize.to(u.deg).value
+
+    # only positions in shots with a meteor need checking
+    in_met_shot = np.where(np.isin(shotid, met_tab['shotid']))[0]
+
+    for row in met_tab:
+        sel = in_met_shot[shotid[in_met_shot] == row['shotid']]
+        if np.size(sel) == 0:
+            continue
+        dist = meteor_distance_from_radec(ra[sel], dec[sel], row['a'], row['b'])
+        flag[sel] = flag[sel] & (dist >= maxdist)
+
+    return flag.reshape(shape)
+
+
 def meteor_flag_from_coords(coords, shotid=None, streaksize=12.*u.arcsec):
     """
     Returns a boolean flag value to mask out meteors
@@ -188,36 +769,150 @@ def meteor_flag_from_coords(coords, shotid=None, streaksize=12.*u.arcsec):
         True if no meteors fall in the aperture
         False if a meteor falls in the aperture
 
+        If coords holds an array of positions an array
+        of flags is returned
+
     Example
     -------
     
     """
 
-    global config
-
     # meteors are found with +/- X arcsec of the line DEC=a+RA*b in this file
 
-    met_tab = Table.read(config.meteor, format='ascii')
-    sel_shot = met_tab['shotid'] == shotid
+    flag = meteor_flag_from_radec(coords.ra.deg, coords.dec.deg, shotid,
+                                  streaksize=streaksize)
+
+    if coords.isscalar:
+        return bool(flag[0])
+    else:
+        return flag
+
+
+def flim_mask_from_cube(sencube, shotid, fiber_table, bad_amps_table=None,
+                        met_tab=None, ifuslot=None, wslice=400,
+                        maxdistance=10.*u.arcsec):
+    """
+    Build the spatial mask of one IFU's flux limit cube. All pixel
+    centres are converted to ra/dec in one WCS call, then flagged
+    in bulk for bad amps (through the closest fiber) and meteors
+
+    Parameters
+    ----------
+    sencube : hetdex_api.flux_limits.sensitivity_cube.SensitivityCube
+        the flux limit cube of the IFU
+    shotid : int
+        the shot the cube belongs to
+    fiber_table
+        table of the fibers in the shot, e.g. from
+        FiberIndex.get_shot_fibers()
+    bad_amps_table
+        astropy table containing the bad amp flag values or a lookup
+        from load_amp_flag_lookup(). Default is the table in
+        config.badamp
+    met_tab : astropy.table.Table (optional)
+        meteor table, default is load_meteor_table()
+    ifuslot : int (optional)
+        IFU slot of the cube. If given the amp flags are only checked
+        when an amp of this IFU is flagged bad in the shot
+    wslice : int
+        wavelength slice used to convert pixels to ra/dec
+    maxdistance
+        The max distance to search for the closest fiber
 
-    if np.sum(sel_shot) > 0:
-        a = met_tab['a'][sel_shot]
-        b = met_tab['b'][sel_shot]
+    Returns
+    -------
+    mask : array
+        int array of shape (ny, nx), 1 for good and 0 for masked
+    """
 
-        ra_met = coords.ra + np.arange(-180, 180, 0.1)*u.arcsec
-        dec_met = (a + ra_met.deg*b ) * u.deg
+    lookup = _amp_flag_lookup_for_table(bad_amps_table)
 
-        met_coords = SkyCoord(ra=ra_met, dec=dec_met)
+    if met_tab is None:
+        met_tab = load_meteor_table()
 
-        meteor_match = met_coords.separation(coords) < streaksize
+    ny, nx = sencube.shape[1:]
+    mask = np.ones((ny, nx), dtype=int)
 
-        
-        if np.any(meteor_match):
-            flag = False
-        else:
-            flag = True
+    check_meteor = shotid in met_tab['shotid']
+
+    # only check the amps if this IFU has a bad amp in the shot
+    sel_shot = amp_flag_shot_slice(lookup, shotid)
+    if ifuslot is None:
+        check_amp = np.any(~lookup['flags'][sel_shot])
     else:
-        flag = True
+        codes = lookup['keys'][sel_shot] % len(lookup['multiframes'])
+        mf_ifuslot = np.array([int(mf[10:13]) for mf in lookup['multiframes'][codes]],
+                              dtype=int)
+        check_amp = np.any(~lookup['flags'][sel_shot][mf_ifuslot == int(ifuslot)])
 
-    return flag
-    
+    if not (check_amp or check_meteor):
+        return mask
+
+    jj, ii = np.indices((ny, nx))
+    ra, dec, wave = sencube.wcs.wcs_pix2world(ii, jj, wslice, 0)
+
+    if check_amp:
+        flag_amp, has_fiber = amp_flag_from_closest_fibers(
+            ra, dec, fiber_table, bad_amps_table=lookup, maxdistance=maxdistance
+        )
+        mask[~flag_amp] = 0
+
+    if check_meteor:
+        flag_meteor = meteor_flag_from_radec(ra, dec, shotid, met_tab=met_tab)
+        mask[~flag_meteor] = 0
+
+    return mask
+
+
+def write_flim_mask(shotid, flimhdf, outfile, fiber_table,
+                    bad_amps_table=None, met_tab=None, badshot=False,
+                    wslice=400, maxdistance=10.*u.arcsec):
+    """
+    Write the flux limit masks of all IFUs in a shot to an
+    HDF5 file with one array per IFU in the Mask group
+
+    Parameters
+    ----------
+    shotid : int
+        the shot to mask
+    flimhdf : SensitivityCubeHDF5Container
+        the flux limit cubes of the shot
+    outfile : str
+        name of the output HDF5 file
+    fiber_table
+        table of the fibers in the shot, e.g. from
+        FiberIndex.get_shot_fibers()
+    bad_amps_table
+        astropy table containing the bad amp flag values or a lookup
+        from load_amp_flag_lookup(). Default is the table in
+        config.badamp
+    met_tab : astropy.table.Table (optional)
+        meteor table, default is load_meteor_table()
+    badshot : bool
+        mask the whole shot, e.g. for bad shots or
+        low throughput shots
+    wslice : int
+        wavelength slice used to convert pixels to ra/dec
+    maxdistance
+        The max distance to search for the closest fiber
+    """
+
+    lookup = _amp_flag_lookup_for_table(bad_amps_table)
+
+    fileh = tb.open_file(outfile, 'w')
+    groupMask = fileh.create_group(fileh.root, 'Mask', 'Flux limit masks')
+
+    # the masks only need the WCS, so the noise is never read
+    for ifu_name, tscube in flimhdf.itercubes(lazy=True):
+
+        if badshot:
+            mask = np.zeros(tscube.shape[1:], dtype=int)
+        else:
+            mask = flim_mask_from_cube(tscube, shotid, fiber_table,
+                                       bad_amps_table=lookup, met_tab=met_tab,
+                                       ifuslot=int(ifu_name[8:11]),
+                                       wslice=wslice, maxdistance=maxdistance)
+
+        fileh.create_array(groupMask, ifu_name, mask)
+
+    fileh.close()
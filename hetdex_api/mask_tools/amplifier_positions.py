@@ -13,6 +13,8 @@ order to account for sources on the edge
 .. moduleauthor:: Daniel Farrow <dfarrow@mpe.mpg.de>
 
 """
+import numpy as np
+from scipy.spatial import cKDTree
 
 
 # List of swapped amps, indexed by IFUSLOT + AMP and
@@ -97,6 +99,149 @@ amp_fiber_ranges = {
                     "LU" : [1, 112]
                    }
 
+
+def _amp_rectangles():
+    """
+    Return the amp name and x1, x2, y1, y2 bounds of
+    every rectangle in amp_corners as flat arrays
+    """
+    names = []
+    bounds = []
+    for amp, rects in amp_corners.items():
+        for rect in rects:
+            names.append(amp)
+            bounds.append([min(rect[0]), max(rect[0]), min(rect[1]), max(rect[1])])
+
+    bounds = np.array(bounds, dtype=float)
+
+    return np.array(names), bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]
+
+
+def _ifuslot_strings(ifuslot):
+    """
+    Return IFU slots as zero padded 3 character strings
+    """
+    ifuslot = np.asarray(ifuslot)
+    if ifuslot.dtype.kind == "S":
+        ifuslot = np.char.decode(ifuslot)
+    return np.char.zfill(ifuslot.astype(str), 3)
+
+
+def amp_from_ifu_xy(x, y, ifuslot=None):
+    """
+    Return the amplifier at IFU coordinates x, y for many
+    positions in one pass
+
+    Parameters
+    ----------
+    x, y : array
+        IFU coordinates in arcseconds
+    ifuslot : str, int or array (optional)
+        IFU slot of each position. If given, the swapped
+        around amps of that IFU are accounted for
+
+    Returns
+    -------
+    amp : array
+        amplifier name (e.g. 'LL') of each position, an
+        empty string for positions off the IFU
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x, y = np.broadcast_arrays(x, y)
+
+    names, x1, x2, y1, y2 = _amp_rectangles()
+
+    xf = x.reshape(-1, 1)
+    yf = y.reshape(-1, 1)
+    inside = (xf >= x1) & (xf <= x2) & (yf >= y1) & (yf <= y2)
+
+    # first matching rectangle, shared edges go to the first amp
+    amp = np.where(np.any(inside, axis=1), names[np.argmax(inside, axis=1)], "")
+    amp = amp.astype("U2")
+
+    if ifuslot is not None:
+        slots = _ifuslot_strings(np.broadcast_to(ifuslot, x.shape).ravel())
+        keys = np.char.add(slots, amp)
+        # swapped_around_amps maps IFUSLOT + AMP to the position of
+        # the amp, invert that to get the amp at a position
+        for key, position in swapped_around_amps.items():
+            amp[keys == key[:3] + position] = key[3:]
+
+    return amp.reshape(x.shape)
+
+
+def ifu_amp_from_fplane_xy(x, y, fplane):
+    """
+    Return the IFU slot and amplifier of focal plane
+    positions for many positions in one pass
+
+    Parameters
+    ----------
+    x, y : array
+        positions in the tangent plane of the shot in arcseconds,
+        e.g. from TangentPlane.raDec2xy()
+    fplane : pyhetdex.het.fplane.FPlane
+        the focal plane of the shot
+
+    Returns
+    -------
+    ifuslot, amp : array
+        IFU slot and amplifier name of each position, empty
+        strings for positions off the IFUs
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x, y = np.broadcast_arrays(x, y)
+
+    ifus = list(fplane.ifus)
+    # the IFU x/y axes are flipped relative to the tangent plane
+    centres = np.array([[ifu.y, ifu.x] for ifu in ifus], dtype=float)
+    slots = _ifuslot_strings([ifu.ifuslot for ifu in ifus])
+
+    # IFUs are far enough apart that a position can only be on
+    # the IFU with the closest centre
+    tree = cKDTree(centres)
+    dist, idx = tree.query(np.vstack((x.ravel(), y.ravel())).T)
+
+    ifuslot = slots[idx]
+    amp = amp_from_ifu_xy(x.ravel() - centres[idx, 0],
+                          y.ravel() - centres[idx, 1],
+                          ifuslot=ifuslot)
+    ifuslot = np.where(amp == "", "", ifuslot)
+
+    return ifuslot.reshape(x.shape), amp.reshape(x.shape)
+
+
+def ifu_amp_from_radec(ra, dec, fplane, tp):
+    """
+    Return the IFU slot and amplifier of many ra/dec
+    positions in a shot
+
+    Parameters
+    ----------
+    ra, dec : array
+        positions in degrees
+    fplane : pyhetdex.het.fplane.FPlane
+        the focal plane of the shot
+    tp : pyhetdex.coordinates.tangent_projection.TangentPlane
+        the tangent plane of the shot, e.g.
+        TangentPlane(ra_shot, dec_shot, 360.0 - (pa + 90.))
+
+    Returns
+    -------
+    ifuslot, amp : array
+        IFU slot and amplifier name of each position, empty
+        strings for positions off the IFUs
+    """
+
+    x, y = tp.raDec2xy(np.asarray(ra, dtype=float), np.asarray(dec, dtype=float))
+
+    return ifu_amp_from_fplane_xy(x, y, fplane)
+
+
 if __name__ == "__main__":
 
     import six
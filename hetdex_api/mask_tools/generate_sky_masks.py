@@ -16,9 +16,11 @@ except ImportError:
     # Python 2
     from urllib2 import urlopen, HTTPError
 
-from os.path import isfile
+from os import makedirs
+from os.path import isfile, isdir, join, splitext
 from six import iteritems
 import re
+import numpy as np
 from numpy import array
 import tables as tb
 from astropy.table import Table
@@ -26,6 +28,15 @@ from pyhetdex.het.fplane import FPlane, NoIFUError
 from pyhetdex.coordinates.tangent_projection import TangentPlane
 from hetdex_api.mask_tools.amplifier_positions import amp_corners, swapped_around_amps
 
+# FPlane objects read by load_fplane(), keyed by
+# directory and date
+_fplanes = {}
+
+# rectangle covering a whole IFU with a little extra
+# border, in the format of amp_corners
+ifu_rect = [[-30.0, -30.0, 30.0, 30.0],
+            [-30.0, 30.0, 30.0, -30.0]]
+
 
 def get_fplane(filename, datestr='', actpos=False, full=True):
     """
@@ -59,8 +70,219 @@ def get_fplane(filename, datestr='', actpos=False, full=True):
         f.write(resp.read().decode())
 
 
+def load_fplane(date, fplane_dir="fplanes"):
+    """
+    Return the FPlane for a date, downloading the
+    fplane file only if it is not in fplane_dir yet.
+    Each date is only read once per session
+
+    Parameters
+    ----------
+    date : int or str
+        the date, e.g. 20190201
+    fplane_dir : str
+        directory to keep the fplane files in
+
+    Returns
+    -------
+    fplane : pyhetdex.het.fplane.FPlane
+    """
+
+    key = (fplane_dir, str(date))
+
+    if key not in _fplanes:
+        fplane_fn = join(fplane_dir, "{:s}_fplane.txt".format(str(date)))
+
+        if not isfile(fplane_fn):
+            if not isdir(fplane_dir):
+                makedirs(fplane_dir)
+            get_fplane(fplane_fn, datestr=str(date))
+
+        _fplanes[key] = FPlane(fplane_fn)
+
+    return _fplanes[key]
+
+
+def shot_tangent_plane(ra, dec, pa):
+    """
+    Return the TangentPlane of a shot from
+    its pointing and parallactic angle
+    """
+    rot = 360.0 - (pa + 90.)
+    return TangentPlane(ra, dec, rot)
+
+
+def rects_to_polygons(tp, rects, ifu_x, ifu_y):
+    """
+    Transform many rectangles in IFU coordinates to ra/dec
+    polygons with a single TangentPlane call
+
+    Parameters
+    ----------
+    tp : pyhetdex.coordinates.tangent_projection.TangentPlane
+        the tangent plane of the shot
+    rects : array
+        (N, 2, 4) x and y corners of each rectangle in
+        IFU coordinates, in the format of amp_corners
+    ifu_x, ifu_y : array
+        focal plane position of the IFU of each rectangle
+
+    Returns
+    -------
+    polys : array
+        (N, 8) array of ra1, dec1, ..., ra4, dec4
+    """
+
+    rects = np.asarray(rects, dtype=float).reshape(-1, 2, 4)
+
+    # Flip is correct
+    x = rects[:, 0, :] + np.asarray(ifu_y, dtype=float)[:, None]
+    y = rects[:, 1, :] + np.asarray(ifu_x, dtype=float)[:, None]
+
+    ra, dec = tp.xy2raDec(x.ravel(), y.ravel())
+
+    polys = np.empty((len(rects), 8))
+    polys[:, 0::2] = np.reshape(ra, (-1, 4))
+    polys[:, 1::2] = np.reshape(dec, (-1, 4))
+
+    return polys
+
+
+def ifu_polygons(fplane, tp, xsize=25.0, ysize=25.0):
+    """
+    Return the corners of all IFUs in a shot
+
+    Parameters
+    ----------
+    fplane : pyhetdex.het.fplane.FPlane
+        the focal plane of the shot
+    tp : pyhetdex.coordinates.tangent_projection.TangentPlane
+        the tangent plane of the shot
+    xsize, ysize : float
+        half of the size of the IFU in x and y
+        in arcseconds
+
+    Returns
+    -------
+    polys : array
+        (N, 8) array of ra1, dec1, ..., ra4, dec4
+    ifuslots : array
+        the IFU slot of each polygon
+    """
+
+    ifus = list(fplane.ifus)
+
+    rect = [[-1.0*xsize, -1.0*xsize, xsize, xsize],
+            [-1.0*ysize, ysize, ysize, -1.0*ysize]]
+    rects = np.repeat([rect], len(ifus), axis=0)
+
+    polys = rects_to_polygons(tp, rects, [ifu.x for ifu in ifus],
+                              [ifu.y for ifu in ifus])
+
+    return polys, array([ifu.ifuslot for ifu in ifus])
+
+
+def amp_polygons(fplane, tp, ifuslots, amps, shotid=None):
+    """
+    Return the polygons covering a list of amplifiers in a
+    shot. The amp 'AA' covers the whole IFU
+
+    Parameters
+    ----------
+    fplane : pyhetdex.het.fplane.FPlane
+        the focal plane of the shot
+    tp : pyhetdex.coordinates.tangent_projection.TangentPlane
+        the tangent plane of the shot
+    ifuslots : list of str
+        three digit IFU slot of each amp
+    amps : list of str
+        name of each amp, e.g. 'LL', or 'AA'
+    shotid : int (optional)
+        only used in warnings
+
+    Returns
+    -------
+    polys : array
+        (N, 8) array of ra1, dec1, ..., ra4, dec4
+    labels : array
+        the amp of each polygon
+    """
+
+    rects = []
+    ifu_x = []
+    ifu_y = []
+    labels = []
+
+    for ifuslot, amp_name in zip(ifuslots, amps):
+        try:
+            ifu = fplane.by_ifuslot(ifuslot)
+        except NoIFUError:
+            print("Warning. IFU {:s} not found for dateobs {}".format(ifuslot, shotid))
+            continue
+
+        if amp_name == "AA":
+            rects_to_mask = [ifu_rect]
+        else:
+            # Check if the amps in this IFU are swapped around
+            ampkey = "{:s}{:s}".format(ifuslot, amp_name)
+            amp = swapped_around_amps.get(ampkey, amp_name)
+
+            # coordinates of amplifier for default dither and IFU cen
+            rects_to_mask = amp_corners[amp]
+
+        for rect in rects_to_mask:
+            rects.append(rect)
+            ifu_x.append(ifu.x)
+            ifu_y.append(ifu.y)
+            labels.append(amp_name)
+
+    if len(rects) == 0:
+        return np.empty((0, 8)), array([], dtype=str)
+
+    return rects_to_polygons(tp, rects, ifu_x, ifu_y), array(labels)
+
+
+def write_polygons(output_fn, polys, labels, label_name="label"):
+    """
+    Write polygons to a file. Files ending in .fits or .h5 get a
+    binary table with ra and dec columns of the 4 corners,
+    otherwise the Mangle vertices format is written
+
+    Parameters
+    ----------
+    output_fn : str
+        the output file
+    polys : array
+        (N, 8) array of ra1, dec1, ..., ra4, dec4
+    labels : array
+        a label for each polygon, e.g. the shotid or amp
+    label_name : str
+        column name of the labels in binary tables
+    """
+
+    polys = np.asarray(polys, dtype=float).reshape(-1, 8)
+    ext = splitext(output_fn)[1].lower()
+
+    if ext in [".fits", ".h5", ".hdf5"]:
+        table = Table()
+        table["ra"] = polys[:, 0::2]
+        table["dec"] = polys[:, 1::2]
+        table[label_name] = array(labels)
+        if ext == ".fits":
+            table.write(output_fn, overwrite=True)
+        else:
+            table.write(output_fn, path="polygons", overwrite=True)
+    else:
+        fmt = "{:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {}\n"
+        with open(output_fn, "w") as fp:
+            for poly, label in zip(polys, labels):
+                fp.write(fmt.format(*poly, label))
+
+
+
 def generate_ifu_mask(output_fn, survey_hdf, badshots_file, ramin, ramax, decmin, decmax, specific_shot=None,
-                      xsize=25.0, ysize=25.0, other_cuts={}, specific_field=None):
+                      xsize=25.0, ysize=25.0, other_cuts={}, specific_field=None,
+                      fplane_dir="fplanes"):
     """
     Generate a mask of IFU corners from the survey HDF 
 
@@ -87,6 +309,11 @@ def generate_ifu_mask(output_fn, survey_hdf, badshots_file, ramin, ramax, decmin
         dictionary of shot property and a
         2 element list of minimum and maximum
         allowed value
+    fplane_dir : str
+        directory to keep the fplane files in
+
+    Output files ending in .fits or .h5 are written
+    as a binary table, see write_polygons()
     """
     # Read in the survey file
     survey_hdf = tb.open_file(survey_hdf)
@@ -108,48 +335,32 @@ def generate_ifu_mask(output_fn, survey_hdf, badshots_file, ramin, ramax, decmin
         print(query) 
         survey_ttable = survey_hdf.root.Survey.read_where(query)
 
-    # Loop over the datevshots and see if there are bad amps
+    # Transform the IFU corners of each good shot in one go
     polys = []
     shids = []
     for line in survey_ttable:
-        print(line)
         # skip bad shots
         if line["shotid"] in bad_shots:
             continue
 
-        date = line["date"]
+        fplane = load_fplane(line["date"], fplane_dir=fplane_dir)
+        tp = shot_tangent_plane(line["ra"], line["dec"], line["pa"])
 
-        rot = 360.0 - (line["pa"] + 90.)
-        tp = TangentPlane(line["ra"], line["dec"], rot)
-        fplane_fn = "fplanes/{:d}_fplane.txt".format(date)
-   
-        if not isfile(fplane_fn):
-           get_fplane(fplane_fn, datestr=str(date))
-           fplane = FPlane(fplane_fn)
-        else:
-           fplane = FPlane(fplane_fn) 
-
-        rect = [[-1.0*xsize, -1.0*xsize, xsize, xsize],
-                [-1.0*ysize, ysize, ysize, -1.0*ysize]]
-    
-        for ifu in fplane.ifus: 
-            x = array(rect[0]) + ifu.y  
-            y = array(rect[1]) + ifu.x
-            ra, dec = tp.xy2raDec(x, y)
-            polys.append([ra[0], dec[0], ra[1], dec[1], 
-                          ra[2], dec[2], ra[3], dec[3]])  
-            shids.append(line["shotid"])
- 
-    # Should now have a list of polygons to output
-    with open(output_fn, "w") as fp:
-        for poly, shid in zip(polys, shids):
-            fp.write("{:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:d}\n".format(*poly, shid))
+        shot_polys, ifuslots = ifu_polygons(fplane, tp, xsize=xsize, ysize=ysize)
+        polys.append(shot_polys)
+        shids.append(np.full(len(shot_polys), line["shotid"]))
 
+    survey_hdf.close()
 
+    # Should now have a list of polygons to output
+    if len(polys) > 0:
+        polys = np.concatenate(polys)
+        shids = np.concatenate(shids)
+    write_polygons(output_fn, polys, shids, label_name="shotid")
 
 
 def generate_bad_amp_mask_fits(output_fn, survey_hdf, badamps_fits, ramin, ramax, decmin, 
-                               decmax, specific_shot = None):
+                               decmax, specific_shot = None, fplane_dir="fplanes"):
     """
     Generate a Mangle-compatible list of ra/dec pairs corresponding
     to the corners of the bad amplifiers on the sky. The amplifiers
@@ -170,6 +381,8 @@ def generate_bad_amp_mask_fits(output_fn, survey_hdf, badamps_fits, ramin, ramax
         overides the ra and dec range
         and instead only outputs a bad
         mask only for te given shotid
+    fplane_dir : str
+        directory to keep the fplane files in
     """
     # Read in the survey file
     survey_hdf = tb.open_file(survey_hdf)
@@ -193,59 +406,32 @@ def generate_bad_amp_mask_fits(output_fn, survey_hdf, badamps_fits, ramin, ramax
     for line in survey_ttable:
         bad_amps_here = table_bad_amps[table_bad_amps["shotid"] == line["shotid"]]
 
-        # If any, grab the focal plane and generate 
+        # If any, grab the focal plane and generate
         # a tangent plane for the astrometry
         if len(bad_amps_here) > 0:
-            #print("{:d} has bad amps. Adding to mask".format(line["shotid"]))
-    
-            date = line["date"]
-            fplane_fn = "fplanes/{:d}_fplane.txt".format(date)
-
-            if not isfile(fplane_fn):
-               get_fplane(fplane_fn, datestr=str(date))
-            else:
-               fplane = FPlane(fplane_fn) 
-    
-
-            rot = 360.0 - (line["pa"] + 90.)
-            tp = TangentPlane(line["ra"], line["dec"], rot)
-                   
-            for bad_amp in bad_amps_here:
-                try:
-                    ifu = fplane.by_ifuslot("{:s}".format(bad_amp["IFUSLOT"]))
-                except NoIFUError:
-                    print("Warning. IFU {:s} not found for dateobs {:d}".format(bad_amp["IFUSLOT"], line["shotid"]))
-                    continue
-    
-                # Check if the amps in this IFU are swapped around
-                ampkey = "{:s}{:s}".format(bad_amp["IFUSLOT"], bad_amp["AMP"])
-                if ampkey in swapped_around_amps:
-                    amp = swapped_around_amps[ampkey]
-                else:
-                    amp = bad_amp["AMP"]
-                 
-                # coordinates of amplifier for default dither and IFU cen
-                rects_to_mask = amp_corners[amp]
-    
-                for rect in rects_to_mask:
-                    # Flip is correct
-                    x = array(rect[0]) + ifu.y  
-                    y = array(rect[1]) + ifu.x
-                    ra, dec = tp.xy2raDec(x, y)
-                    polys.append([ra[0], dec[0], ra[1], dec[1], 
-                                  ra[2], dec[2], ra[3], dec[3]])
-                   
-                    amps.append(bad_amp["AMP"])
-    
+
+            fplane = load_fplane(line["date"], fplane_dir=fplane_dir)
+            tp = shot_tangent_plane(line["ra"], line["dec"], line["pa"])
+
+            shot_polys, shot_amps = amp_polygons(fplane, tp, bad_amps_here["IFUSLOT"],
+                                                 bad_amps_here["AMP"],
+                                                 shotid=line["shotid"])
+            polys.append(shot_polys)
+            amps.append(shot_amps)
+
+    survey_hdf.close()
+
     # Should now have a list of polygons to output
-    with open(output_fn, "w") as fp:
-        for poly, amp in zip(polys, amps):
-            fp.write("{:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:s}\n".format(*poly, amp))
+    if len(polys) > 0:
+        polys = np.concatenate(polys)
+        amps = np.concatenate(amps)
+    write_polygons(output_fn, polys, amps, label_name="amp")
 
    
 
 def generate_bad_amp_mask(output_fn, survey_hdf, badamps_file, badshots_file, 
-                          ramin, ramax, decmin, decmax, specific_shot=None):
+                          ramin, ramax, decmin, decmax, specific_shot=None,
+                          fplane_dir="fplanes"):
 
     """
     Generate a Mangle-compatible list of ra/dec pairs corresponding
@@ -267,7 +453,8 @@ def generate_bad_amp_mask(output_fn, survey_hdf, badamps_file, badshots_file,
         overides the ra and dec range
         and instead only outputs a bad
         mask only for te given shotid
-
+    fplane_dir : str
+        directory to keep the fplane files in
     """
 
     # Read in the survey file
@@ -292,68 +479,37 @@ def generate_bad_amp_mask(output_fn, survey_hdf, badamps_file, badshots_file,
     for line in survey_ttable:
 
         date = line["date"]
-        fplane_fn = "fplanes/{:d}_fplane.txt".format(date)
+        fplane = load_fplane(date, fplane_dir=fplane_dir)
 
-        if not isfile(fplane_fn):
-           get_fplane(fplane_fn, datestr=str(date))
-        else:
-           fplane = FPlane(fplane_fn) 
- 
         if line["shotid"] in bad_shots:
             # if shot bad mask all IFUS
             print("Masking whole bad shot found {:d}".format(line["shotid"]))
-            bad_amps_here = Table()
-            bad_amps_here["IFUSLOT"] = [int(x) for x in fplane.ifuslots]
-            bad_amps_here["AMP"] = "AA"
+            ifuslots = ["{:03d}".format(int(x)) for x in fplane.ifuslots]
+            amps_here = ["AA"]*len(ifuslots)
         else:
             # otherwise just mask bad amps
-            sel = (table_bad_amps["start"] <= date) & (table_bad_amps["end"] >= date) 
-            bad_amps_here = table_bad_amps[sel]
-    
-        # If any, grab the focal plane and generate 
-        # a tangent plane for the astrometry
-        if len(bad_amps_here) > 0:
-           print("{:d} has bad amps. Adding to mask".format(line["shotid"]))
-    
-           rot = 360.0 - (line["pa"] + 90.)
-           tp = TangentPlane(line["ra"], line["dec"], rot)
-                  
-           for bad_amp in bad_amps_here:
-               try:
-                   ifu = fplane.by_ifuslot("{:03d}".format(bad_amp["IFUSLOT"]))
-               except NoIFUError:
-                   print("Warning. IFU {:d} not found for dateobs {:d}".format(bad_amp["IFUSLOT"], line["shotid"]))
-                   continue
-    
-               if bad_amp["AMP"] == "AA":
-                   # whole IFU with a little extra border
-                   rects_to_mask = [[[-30.0, -30.0, 30.0, 30.0],
-                                     [-30.0, 30.0, 30.0, -30.0]]]
-               else:
-                   # Check if the amps in this IFU are swapped around
-                   ampkey = "{:03d}{:s}".format(bad_amp["IFUSLOT"], bad_amp["AMP"])
-                   if ampkey in swapped_around_amps:
-                       amp = swapped_around_amps[ampkey]
-                   else:
-                       amp = bad_amp["AMP"]
-                    
-                   # coordinates of amplifier for default dither and IFU cen
-                   rects_to_mask = amp_corners[amp]
-    
-               for rect in rects_to_mask:
-                   # Flip is correct
-                   x = array(rect[0]) + ifu.y  
-                   y = array(rect[1]) + ifu.x
-                   ra, dec = tp.xy2raDec(x, y)
-                   polys.append([ra[0], dec[0], ra[1], dec[1], 
-                                 ra[2], dec[2], ra[3], dec[3]])
-                  
-                   amps.append(bad_amp["AMP"])
-    
+            sel = (table_bad_amps["start"] <= date) & (table_bad_amps["end"] >= date)
+            ifuslots = ["{:03d}".format(x) for x in table_bad_amps["IFUSLOT"][sel]]
+            amps_here = list(table_bad_amps["AMP"][sel])
+
+        # If any, generate a tangent plane for the astrometry
+        if len(ifuslots) > 0:
+            print("{:d} has bad amps. Adding to mask".format(line["shotid"]))
+
+            tp = shot_tangent_plane(line["ra"], line["dec"], line["pa"])
+
+            shot_polys, shot_amps = amp_polygons(fplane, tp, ifuslots, amps_here,
+                                                 shotid=line["shotid"])
+            polys.append(shot_polys)
+            amps.append(shot_amps)
+
+    survey_hdf.close()
+
     # Should now have a list of polygons to output
-    with open(output_fn, "w") as fp:
-        for poly, amp in zip(polys, amps):
-            fp.write("{:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:7.6f} {:s}\n".format(*poly, amp))
+    if len(polys) > 0:
+        polys = np.concatenate(polys)
+        amps = np.concatenate(amps)
+    write_polygons(output_fn, polys, amps, label_name="amp")
 
 
 
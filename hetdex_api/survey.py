@@ -18,6 +18,7 @@ import copy
 import astropy.units as u
 from astropy.coordinates import SkyCoord
 from astropy.table import Table, vstack
+from scipy.spatial import cKDTree
 
 import healpy as hp
 from hetdex_api.config import HDRconfig
@@ -29,6 +30,63 @@ except Exception as e:
     LATEST_HDR_NAME = "hdr2.1"
 
 
+def radec_to_unit_vectors(ra, dec):
+    """
+    Convert ra/dec in degrees to an (N, 3) array of
+    unit vectors on the sphere. Distances between these
+    vectors are chord lengths, so neighbours on the sky
+    can be found with a euclidean cKDTree
+
+    Parameters
+    ----------
+    ra, dec : array
+        coordinates in degrees
+
+    Returns
+    -------
+    xyz : array
+        (N, 3) array of cartesian unit vectors
+    """
+    ra_rad = np.deg2rad(np.atleast_1d(ra).astype(float))
+    dec_rad = np.deg2rad(np.atleast_1d(dec).astype(float))
+    cos_dec = np.cos(dec_rad)
+
+    return np.vstack(
+        (cos_dec * np.cos(ra_rad), cos_dec * np.sin(ra_rad), np.sin(dec_rad))
+    ).T
+
+
+def angle_to_chord(angle):
+    """
+    Convert an on-sky angular separation into the
+    chord length between two unit vectors
+
+    Parameters
+    ----------
+    angle : astropy Quantity
+        an angular separation
+
+    Returns
+    -------
+    chord : float or array
+        the chord length on the unit sphere
+    """
+    return 2.0 * np.sin(0.5 * angle.to(u.radian).value)
+
+
+def _parse_radius(radius):
+    """
+    Return radius as an angular Quantity, assuming degrees
+    if it has no units
+    """
+    radius = u.Quantity(radius)
+    if radius.unit == u.dimensionless_unscaled:
+        print("Assuming radius in degrees")
+        radius = radius.value * u.degree
+
+    return radius
+
+
 class Survey:
     def __init__(self, survey=LATEST_HDR_NAME):
         """
@@ -110,6 +168,10 @@ class Survey:
                 setattr(p, attrname, getattr(self, attrname)[indx])
             except:
                 setattr(p, attrname, getattr(self, attrname))
+
+        # the pointing index refers to the unsliced shots, rebuild on demand
+        p._shot_tree = None
+
         return p
 
     def slice(self):
@@ -151,11 +213,8 @@ class Survey:
         """
         global config
 
-        mask = np.zeros(np.size(self.shotid), dtype=bool)
         badshots = np.loadtxt(config.badshot, dtype=int)
-        for shot in badshots:
-            maskshot = self.shotid == shot
-            mask = mask | maskshot
+        mask = np.isin(self.shotid, badshots)
 
         notvalid = self.shotid < 20170000
         mask = mask | notvalid
@@ -202,11 +261,13 @@ class Survey:
             )
 
         if radius is not None:
-            try:
-                idx = self.coords.separation(coords) < radius
-            except:
-                print("Assuming radius in degrees")
-                idx = self.coords.separation(coords) < radius * u.degree
+            radius = _parse_radius(radius)
+            coords = SkyCoord(coords).reshape(1)
+            idx = self._get_shot_tree().query_ball_point(
+                radec_to_unit_vectors(coords.ra.deg, coords.dec.deg)[0],
+                angle_to_chord(radius),
+            )
+            idx = np.sort(np.array(idx, dtype=int))
         else:
             try:
                 idx1 = abs(self.ra - coords.ra.value) < width / 2.0
@@ -217,6 +278,69 @@ class Survey:
 
         return self.shotid[idx]
 
+    def get_shotlist_many(self, coords, radius):
+        """
+        Match many positions to the shots whose pointing
+        centre lies within radius of each position. This
+        uses the same pointing index as get_shotlist so
+        millions of positions can be matched in one call.
+
+        Parameters
+        ----------
+        self
+            Survey Class object
+        coords
+            astropy coordinate object holding an array of positions
+        radius
+            an astropy Quantity object, or a string that can be parsed
+            into one. Assumed to be in degrees if no units are given
+
+        Returns
+        -------
+        incidence
+            astropy table with one row per (source, shot) pair. The
+            'source_idx' column indexes coords, 'shot_idx' indexes
+            this Survey object and 'shotid' holds the matched shot.
+            Rows are sorted by source_idx then shotid.
+
+        Examples
+        --------
+        S = Survey('hdr2.1')
+        coords = SkyCoord(ra=ra_array * u.deg, dec=dec_array * u.deg)
+        incidence = S.get_shotlist_many(coords, radius=11.*u.arcmin)
+        """
+
+        radius = _parse_radius(radius)
+        coords = SkyCoord(coords).reshape(-1)
+        src_tree = cKDTree(radec_to_unit_vectors(coords.ra.deg, coords.dec.deg))
+
+        # sparse (source x shot) incidence matrix of all pairs inside radius
+        pairs = src_tree.sparse_distance_matrix(
+            self._get_shot_tree(), angle_to_chord(radius), output_type="ndarray"
+        )
+
+        source_idx = pairs["i"].astype(int)
+        shot_idx = pairs["j"].astype(int)
+
+        order = np.lexsort((self.shotid[shot_idx], source_idx))
+
+        incidence = Table()
+        incidence["source_idx"] = source_idx[order]
+        incidence["shot_idx"] = shot_idx[order]
+        incidence["shotid"] = self.shotid[shot_idx[order]]
+
+        return incidence
+
+    def _get_shot_tree(self):
+        """
+        Return a cKDTree over the unit vectors of the shot
+        pointings, building it on the first call
+        """
+        if getattr(self, "_shot_tree", None) is None:
+            self._shot_tree = cKDTree(radec_to_unit_vectors(self.ra, self.dec))
+
+        return self._shot_tree
+
     def return_astropy_table(self, return_good=True):
         """
         Function to return an astropy table that is machine readable
@@ -432,6 +556,26 @@ class FiberIndex:
         else:
             return None
 
+    def get_shot_fibers(self, shotid):
+        """
+        Function to retrieve all fibers in a shot in one read,
+        e.g. to look up many positions in the same shot
+
+        Parameters
+        ----------
+        self
+            the FiberIndex class for a specific survey
+        shotid
+            Specific shotid (dtype=int) you want
+
+        Returns
+        -------
+        An astropy table of Fiber information for the shot
+        """
+        sid = int(shotid)
+
+        return Table(self.hdfile.root.FiberIndex.read_where("shotid == sid"))
+
     def close(self):
         """
         Close the hdfile when done
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the read throughput of sensitivity cube HDF5
+containers written with different chunk layouts and codecs
+
+python benchmark_flim_layout.py 20190201v012_sensitivity_cube.h5
+
+The input file is rewritten with each layout and codec with
+hetdex_api.flux_limits.hdf5_sensitivity_cubes.rewrite_sensitivity_hdf5()
+and three access patterns are timed on every copy:
+
+slice     one full wavelength slice of each IFU
+spectrum  all wavelengths at one pixel of each IFU
+point     single random (z, y, x) values
+
+The file is reopened for every pattern so earlier reads are not
+served from the HDF5 chunk cache.
+
+"""
+
+from __future__ import print_function
+
+import os
+import os.path as op
+import tempfile
+import time
+import argparse as ap
+
+import numpy as np
+import tables as tb
+from astropy.table import Table
+
+from hetdex_api.flux_limits.hdf5_sensitivity_cubes import rewrite_sensitivity_hdf5
+
+PATTERNS = ["slice", "spectrum", "point"]
+
+
+def _cube_nodes(fileh):
+    """ Return all the IFU cubes in an open container """
+    return [node for node in fileh.walk_nodes(fileh.root, classname="CArray")]
+
+
+def time_access(filename, pattern, nread=200, seed=0):
+    """
+    Time one access pattern on a container
+
+    Parameters
+    ----------
+    filename : str
+        the HDF5 container of sensitivity cubes
+    pattern : str
+        one of 'slice', 'spectrum' or 'point'
+    nread : int
+        number of reads
+    seed : int
+        seed of the random positions
+
+    Returns
+    -------
+    seconds : float
+        total time of the reads
+    nbytes : int
+        number of bytes returned by the reads
+    """
+
+    rng = np.random.default_rng(seed)
+    nbytes = 0
+
+    with tb.open_file(filename, "r") as fileh:
+        nodes = _cube_nodes(fileh)
+        inodes = rng.integers(0, len(nodes), nread)
+
+        start = time.perf_counter()
+        for inode in inodes:
+            node = nodes[inode]
+            nz, ny, nx = node.shape
+            if pattern == "slice":
+                data = node[rng.integers(nz)]
+            elif pattern == "spectrum":
+                data = node[:, rng.integers(ny), rng.integers(nx)]
+            elif pattern == "point":
+                data = node[rng.integers(nz), rng.integers(ny), rng.integers(nx)]
+            else:
+                raise ValueError("Unknown access pattern {:s}".format(pattern))
+            nbytes += np.asarray(data).nbytes
+        seconds = time.perf_counter() - start
+
+    return seconds, nbytes
+
+
+def benchmark_layouts(filename, layouts=(None, "slice", "spectrum"),
+                      complibs=("zlib", "blosc:lz4"), complevel=4, nread=200,
+                      tmpdir=None):
+    """
+    Rewrite a container with each layout and codec and
+    time the access patterns
+
+    Parameters
+    ----------
+    filename : str
+        the HDF5 container of sensitivity cubes
+    layouts : list
+        chunk layouts to try, see
+        hdf5_sensitivity_cubes.cube_chunkshape()
+    complibs : list
+        compression libraries to try
+    complevel : int
+        compression level
+    nread : int
+        number of reads per access pattern
+    tmpdir : str (optional)
+        directory for the rewritten files
+
+    Returns
+    -------
+    results : astropy.table.Table
+        file size and, for each access pattern,
+        reads per second and MB/s returned
+    """
+
+    rows = []
+    workdir = tempfile.mkdtemp(dir=tmpdir)
+
+    try:
+        for complib in complibs:
+            for layout in layouts:
+                outfile = op.join(workdir, "{:s}_{:s}.h5".format(complib.replace(":", "_"),
+                                                                 str(layout)))
+                rewrite_sensitivity_hdf5(filename, outfile, complib=complib,
+                                         complevel=complevel, chunk_layout=layout)
+
+                row = [complib, str(layout), os.stat(outfile).st_size/1e6]
+                for pattern in PATTERNS:
+                    seconds, nbytes = time_access(outfile, pattern, nread=nread)
+                    row.extend([nread/seconds, nbytes/1e6/seconds])
+                rows.append(row)
+
+                os.remove(outfile)
+    finally:
+        os.rmdir(workdir)
+
+    names = ["complib", "layout", "size_MB"]
+    for pattern in PATTERNS:
+        names.extend([pattern + "_per_s", pattern + "_MB_per_s"])
+
+    return Table(rows=rows, names=names)
+
+
+def get_parser():
+    """ function that returns a parser from argparse """
+
+    parser = ap.ArgumentParser(
+        description="""Benchmark chunk layouts and codecs of sensitivity cube HDF5 files""",
+        add_help=True,
+    )
+
+    parser.add_argument("filename", type=str,
+                        help="""A *_sensitivity_cube.h5 file""")
+
+    parser.add_argument("--complibs", type=str, nargs="+",
+                        default=["zlib", "blosc:lz4"],
+                        help="""Compression libraries to compare""")
+
+    parser.add_argument("--complevel", type=int, default=4,
+                        help="""Compression level""")
+
+    parser.add_argument("-n", "--nread", type=int, default=200,
+                        help="""Number of reads per access pattern""")
+
+    parser.add_argument("--tmpdir", type=str, default=None,
+                        help="""Directory for the rewritten files""")
+
+    return parser
+
+
+def main(argv=None):
+
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    results = benchmark_layouts(args.filename, complibs=args.complibs,
+                                complevel=args.complevel, nread=args.nread,
+                                tmpdir=args.tmpdir)
+
+    for col in results.colnames[2:]:
+        results[col].format = "{:.3g}"
+
+    results.pprint(max_width=-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
 import random
 import numpy as np
+import tables as tb
 import time
+from multiprocessing import Pool
 from astropy.io import ascii
 from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from astropy.table import Table
 
 
@@ -33,7 +37,25 @@ def mktree(x, y, z, dsky=3.0, dwave=5.0, euclidean=False):
    '''
    # construct a kd-tree in normalized coordinates and calculate the linking length in that system
    # return cKDTree, r
+   data, r = tree_coords(x, y, z, dsky=dsky, dwave=dwave, euclidean=euclidean)
+   kd = cKDTree(data)
+
+   return kd, r
+
+
+def tree_coords(x, y, z, dsky=3.0, dwave=5.0, euclidean=False):
+   '''
+   Transform coordinates to the normalized system used by mktree() and
+   calculate the linking length in that system
+
+   Parameters
+   ----------
+      see mktree()
 
+   Returns
+   -------
+      data, r : (N, 3) numpy array of coordinates, linking length
+   '''
    if euclidean==True:
       x_tree = x
       y_tree = y
@@ -47,9 +69,8 @@ def mktree(x, y, z, dsky=3.0, dwave=5.0, euclidean=False):
       dsky = np.deg2rad(dsky/3600.0) # convert from arcsec to radians
 
    data = np.vstack((x_tree, y_tree, z_tree)).T
-   kd = cKDTree(data)
 
-   return kd, dsky
+   return data, dsky
 
 
 def frinds_of_friends(kdtree, r, Nmin=3):
@@ -101,7 +122,7 @@ def frinds_of_friends(kdtree, r, Nmin=3):
          The list is sorted by group size, with the largest group first.
    '''
    # make a set with all particles, makes set ops below much faster
-   id_lst = set(range(0, kdtree.n-1))
+   id_lst = set(range(0, kdtree.n))
    group_lst = []
    # iterate over all particles
    while len(id_lst) > 0:
@@ -139,6 +160,104 @@ def frinds_of_friends(kdtree, r, Nmin=3):
    return group_lst
 
 
+def friends_of_friends_sparse(kdtree, r, Nmin=3):
+   '''
+   Friends of Friends group finder using a sparse graph
+
+   Finds all pairs of particles within the linking length with a single
+   kdtree.query_pairs() call and labels the groups as the connected
+   components of that graph. This gives the same groups as
+   frinds_of_friends(), but is much faster and uses less memory for large
+   catalogs.
+
+   Example
+   -------
+      kdtree, r = mktree(x,y,z)
+      group_lst = friends_of_friends_sparse(kdtree, r, Nmin=3)
+
+   Parameters
+   ----------
+      kdtree : scipy.spatial.cKDTree
+         KD-Tree containing the coordinates of all the particles
+
+      r : float
+         linking length
+
+      Nmin : int
+         minimal number of members for a group
+
+   Returns
+   -------
+      group_lst : list of numpy arrays
+         List of the groups, where each group is an array of the indices
+         of all its members, sorted in ascending order. The list is sorted
+         by group size, with the largest group first, as in frinds_of_friends().
+         Groups of the same size are ordered by their lowest index member
+         (frinds_of_friends() leaves this to the iteration order of a set).
+   '''
+   return labels_to_group_list(fof_labels(kdtree, r), Nmin=Nmin)
+
+
+def labels_to_group_list(labels, Nmin=3):
+   '''
+   Convert a label array (e.g. from fof_labels()) to a group list
+
+   Parameters
+   ----------
+      labels : numpy array
+         group label of each particle
+
+      Nmin : int
+         minimal number of members for a group
+
+   Returns
+   -------
+      group_lst : list of numpy arrays
+         see friends_of_friends_sparse()
+   '''
+   counts = np.bincount(labels)
+
+   # members ordered by group, ascending index within each group
+   order = np.argsort(labels, kind='stable')
+   group_lst = np.split(order, np.cumsum(counts)[:-1])
+
+   # components are labelled in order of their lowest index member,
+   # sort by size (largest first) and then by label
+   keep = np.where(counts >= Nmin)[0]
+   keep = keep[np.lexsort((keep, -counts[keep]))]
+
+   return [group_lst[i] for i in keep]
+
+
+def fof_labels(kdtree, r):
+   '''
+   Label every particle with its friends of friends group
+
+   Parameters
+   ----------
+      kdtree : scipy.spatial.cKDTree
+         KD-Tree containing the coordinates of all the particles
+
+      r : float
+         linking length
+
+   Returns
+   -------
+      labels : numpy array
+         group label of each particle. Labels run from 0 to the number of
+         groups - 1, in order of the lowest index member of each group.
+         Isolated particles get a group of their own.
+   '''
+   pairs = kdtree.query_pairs(r, output_type='ndarray')
+
+   graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:,0], pairs[:,1])),
+                      shape=(kdtree.n, kdtree.n))
+
+   ngroups, labels = connected_components(graph, directed=False)
+
+   return labels
+
+
 def evaluate_group(x, y, z, f, euclidean=False):
    '''
    Calculate group properties from a list of it's members
@@ -250,6 +369,327 @@ def process_group_list(group_lst, detectid, x, y, z, f):
    return group_list_to_table(rows)
    
 
+def _tile_labels(args):
+   '''
+   Friends of friends labels of the particles in one tile
+   '''
+   data, r = args
+   return fof_labels(cKDTree(data), r)
+
+
+def _tile_members(x, y, tile_size, margin):
+   '''
+   Split particles into square tiles of tile_size, where each tile also
+   holds the particles within margin of its edges
+
+   Returns
+   -------
+      list of numpy arrays with the particle indices of each tile
+   '''
+   if tile_size < 2.0*margin:
+      raise ValueError('tile_size must be at least twice the linking length')
+
+   x0 = np.min(x) - margin
+   y0 = np.min(y) - margin
+   nty = int(np.floor((np.max(y) + margin - y0)/tile_size)) + 1
+
+   ix_lo = np.floor((x - margin - x0)/tile_size).astype(np.int64)
+   ix_hi = np.floor((x + margin - x0)/tile_size).astype(np.int64)
+   iy_lo = np.floor((y - margin - y0)/tile_size).astype(np.int64)
+   iy_hi = np.floor((y + margin - y0)/tile_size).astype(np.int64)
+
+   # a particle lies in at most 2x2 tiles including the margins
+   idx = []
+   tiles = []
+   for dx in (0, 1):
+      for dy in (0, 1):
+         sel = np.where((ix_lo + dx <= ix_hi) & (iy_lo + dy <= iy_hi))[0]
+         idx.append(sel)
+         tiles.append((ix_lo[sel] + dx)*nty + iy_lo[sel] + dy)
+
+   idx = np.concatenate(idx)
+   tiles = np.concatenate(tiles)
+
+   order = np.argsort(tiles, kind='stable')
+   idx = idx[order]
+   tiles = tiles[order]
+
+   splits = np.where(np.diff(tiles) != 0)[0] + 1
+
+   return np.split(idx, splits)
+
+
+def fof_labels_tiled(x, y, z, dsky=3.0, dwave=5.0, euclidean=False, tile_size=1.0, nproc=1):
+   '''
+   Friends of friends labels for large catalogs, found tile by tile
+
+   The sky is split into square tiles that overlap by the linking length.
+   Groups are found in each tile in a process pool, and groups that share
+   particles in the overlaps are joined. Every linked pair lies together
+   in at least one tile, so the labels are the same as from fof_labels()
+   on one tree of the full catalog.
+
+   Example
+   -------
+      labels = fof_labels_tiled(ra, dec, wave, tile_size=2.0, nproc=16)
+      group_lst = labels_to_group_list(labels, Nmin=3)
+
+   Parameters
+   ----------
+      x,y,z : numpy.array
+         coordinates RA, DEC in degrees, WAVELENGTH in Angstroms
+      dksy : float
+         linking length on sky in arcsec, defaults to 3.0"
+      dwave : float
+         linking length in wavelength in Angstrom, defaults to 5A
+      euclidean : bool
+         coordinates are euclidean, not spherical, do not transform.
+         defaults to False
+      tile_size : float
+         size of the tiles in x and y, in degrees (or in the units of
+         x and y if euclidean). Defaults to 1 degree
+      nproc : int
+         number of processes
+
+   Returns
+   -------
+      labels : numpy array
+         group label of each particle, see fof_labels()
+   '''
+   data, r = tree_coords(x, y, z, dsky=dsky, dwave=dwave, euclidean=euclidean)
+
+   if not euclidean:
+      tile_size = np.deg2rad(tile_size)
+
+   tile_members = _tile_members(data[:,0], data[:,1], tile_size, r)
+   tasks = [(data[m], r) for m in tile_members]
+
+   if nproc > 1:
+      with Pool(nproc) as pool:
+         tile_labels = pool.map(_tile_labels, tasks)
+   else:
+      tile_labels = [_tile_labels(task) for task in tasks]
+
+   # stitch the tiles: link every particle to the first particle of its
+   # group in the tile, then find the connected components of all links
+   src = []
+   dst = []
+   for m, labels in zip(tile_members, tile_labels):
+      ulabels, first = np.unique(labels, return_index=True)
+      src.append(m)
+      dst.append(m[first][np.searchsorted(ulabels, labels)])
+
+   src = np.concatenate(src)
+   dst = np.concatenate(dst)
+
+   n = len(data)
+   graph = coo_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(n, n))
+   ngroups, labels = connected_components(graph, directed=False)
+
+   return labels
+
+
+def friends_of_friends_tiled(x, y, z, dsky=3.0, dwave=5.0, euclidean=False, Nmin=3,
+                             tile_size=1.0, nproc=1):
+   '''
+   Tiled, parallel version of friends_of_friends_sparse() working directly
+   on the coordinates, see fof_labels_tiled()
+
+   Returns
+   -------
+      group_lst : list of numpy arrays
+         see friends_of_friends_sparse()
+   '''
+   labels = fof_labels_tiled(x, y, z, dsky=dsky, dwave=dwave, euclidean=euclidean,
+                             tile_size=tile_size, nproc=nproc)
+
+   return labels_to_group_list(labels, Nmin=Nmin)
+
+
+def group_list_to_labels(group_lst, n):
+   '''
+   Convert a group list (output of frinds_of_friends()) to a label array
+
+   Parameters
+   ----------
+      group_lst : list of lists
+         group list returned by frinds_of_friends()
+
+      n : int
+         number of particles
+
+   Returns
+   -------
+      labels : numpy array
+         index of the group in group_lst of each particle, -1 for
+         particles in no group
+   '''
+   labels = np.full(n, -1, dtype=int)
+   for i, m in enumerate(group_lst):
+      labels[m] = i
+
+   return labels
+
+
+def _axes(ixx, iyy, ixy):
+   '''
+   Semi-major and semi-minor axes and position angle (degrees) from
+   second-order moments, vectorized version of the steps in evaluate_group()
+   '''
+   a_ = 0.5*(ixx+iyy)
+   c_ = np.sqrt(0.25*np.square(ixx-iyy) + np.square(ixy))
+   a = np.sqrt(a_+c_)
+   b = np.where(a_-c_ > 0, np.sqrt(np.clip(a_-c_, 0, None)), a_)
+
+   with np.errstate(invalid='ignore'):
+      pa = np.where(ixx-iyy != 0.0, 0.5*np.arctan2(2.0*ixy, ixx-iyy), np.pi/4.)
+   pa *= 180./np.pi
+
+   return a, b, pa
+
+
+def evaluate_groups(labels, x, y, z, f, euclidean=False):
+   '''
+   Calculate the properties of all groups at once from a label array,
+   using np.bincount for the per-group sums. Gives the same values as
+   calling evaluate_group() on each group.
+
+   Parameters
+   ----------
+      labels : numpy array
+         group label of each particle, from 0 to the number of groups - 1.
+         Particles with a negative label are ignored.
+
+      x, y, z, f : array like
+         coordinates and flux (or weight) of the particles
+
+      euclidean : bool
+         coordinates are euclidean, do not apply the cos-dec factor
+
+   Returns
+   -------
+      dict of numpy arrays with one entry per label and the keys
+         'size', 'lum', 'icx', 'icy', 'icz', 'ixx', 'iyy', 'ixy', 'izz',
+         'a', 'b', 'pa', 'a2', 'b2', 'pa2'
+      As in evaluate_group(), izz is the non-weighted second order moment
+      along the third dimension.
+   '''
+   labels = np.asarray(labels)
+   sel = labels >= 0
+   lab = labels[sel]
+   x = np.asarray(x, dtype=float)[sel]
+   y = np.asarray(y, dtype=float)[sel]
+   z = np.asarray(z, dtype=float)[sel]
+   f = np.asarray(f, dtype=float)[sel]
+
+   ngroups = lab.max() + 1 if len(lab) > 0 else 0
+
+   def gsum(w):
+      return np.bincount(lab, weights=w, minlength=ngroups)
+
+   size = np.bincount(lab, minlength=ngroups)
+
+   # first and second order flux-weighed moments
+   lum = gsum(f)
+   icy = gsum(f*y)/lum
+   c = np.ones(ngroups) if euclidean else np.cos(np.deg2rad(icy))   # cos-dec
+   icx = gsum(f*x)/lum
+   icz = gsum(f*z)/lum
+   dx = (x-icx[lab])*c[lab]
+   dy = y-icy[lab]
+   dz = z-icz[lab]
+   ixx = gsum(f*np.square(dx))/lum
+   iyy = gsum(f*np.square(dy))/lum
+   ixy = gsum(f*dx*dy)/lum
+
+   a, b, pa = _axes(ixx, iyy, ixy)
+
+   # non-weighted second order moments
+   ixx2 = gsum(np.square(dx))/size
+   iyy2 = gsum(np.square(dy))/size
+   ixy2 = gsum(dx*dy)/size
+   izz2 = gsum(np.square(dz))/size
+
+   a2, b2, pa2 = _axes(ixx2, iyy2, ixy2)
+
+   return {'size': size, 'lum': lum, 'icx': icx, 'icy': icy, 'icz': icz,
+           'ixx': ixx, 'iyy': iyy, 'ixy': ixy, 'izz': izz2,
+           'a': a, 'b': b, 'pa': pa, 'a2': a2, 'b2': b2, 'pa2': pa2}
+
+
+def process_group_labels(labels, detectid, x, y, z, f, Nmin=3, euclidean=False):
+   '''
+   Vectorized version of process_group_list() working on a label array,
+   e.g. from fof_labels(). Returns a columnar table of the groups and
+   their members in compressed sparse row form instead of one
+   object array per row.
+
+   Parameters
+   ----------
+      labels : numpy array
+         group label of each particle, negative labels are ignored
+
+      detectid : array like
+         detect_ids corresponding to the x,y,z inputs
+
+      x,y,z : array like
+         coordinates corresponding to the detect-ids
+
+      f : array like
+         flux (or broadly the weight) of the points x,y,z
+
+      Nmin : int
+         minimal number of members for a group
+
+      euclidean : bool
+         coordinates are euclidean, do not apply the cos-dec factor
+
+   Returns
+   -------
+      gtable : astropy.Table
+         one row per group with the fields
+         ['id', 'size', 'lum', 'icx', 'icy', 'icz', 'ixx', 'iyy', 'ixy', 'izz',
+          'a', 'b', 'pa', 'a2', 'b2', 'pa2'], sorted by size, largest first,
+         and then by label
+
+      members : numpy array
+         detectids of the members of all groups, concatenated in table order
+
+      offsets : numpy array
+         the members of group i are members[offsets[i]:offsets[i+1]]
+   '''
+   labels = np.asarray(labels)
+   detectid = np.asarray(detectid)
+
+   size = np.bincount(labels[labels >= 0])
+
+   # keep groups with at least Nmin members, largest first
+   keep = np.where(size >= Nmin)[0]
+   keep = keep[np.lexsort((keep, -size[keep]))]
+
+   newlabel = np.full(len(size), -1, dtype=int)
+   newlabel[keep] = np.arange(len(keep))
+   glabels = np.full(len(labels), -1, dtype=int)
+   sel = labels >= 0
+   glabels[sel] = newlabel[labels[sel]]
+
+   props = evaluate_groups(glabels, x, y, z, f, euclidean=euclidean)
+
+   gtable = Table()
+   gtable['id'] = np.arange(len(keep))
+   for name in ['size', 'lum', 'icx', 'icy', 'icz', 'ixx', 'iyy', 'ixy', 'izz',
+                'a', 'b', 'pa', 'a2', 'b2', 'pa2']:
+      gtable[name] = props[name]
+
+   # members ordered by group, ascending index within each group
+   idx = np.where(glabels >= 0)[0]
+   idx = idx[np.argsort(glabels[idx], kind='stable')]
+   members = detectid[idx]
+   offsets = np.concatenate(([0], np.cumsum(props['size'])))
+
+   return gtable, members, offsets
+
+
 def print_groups(group_lst):
    '''
    Print a summary of the groups found by friend_of_friends().
@@ -294,10 +734,17 @@ def table_to_group_list(table):
    return [[x for x in table[i]] for i in range(len(table))]
 
 
+def _is_hdf5(fname):
+   return fname.lower().endswith(('.h5', '.hdf5'))
+
+
 def save_groups(fname, gtable):
    '''
    Save an astropy.Table with group data
 
+   File names ending in .h5 or .hdf5 are written with save_groups_hdf5(),
+   which does not need pickle and allows partial reads.
+
    Parameters
    ----------
    fname : string
@@ -306,7 +753,10 @@ def save_groups(fname, gtable):
    gtable : astropy.Table
       table of groups
    '''
-   np.save(fname, table_to_group_list(gtable))
+   if _is_hdf5(fname):
+      save_groups_hdf5(fname, gtable)
+   else:
+      np.save(fname, np.array(table_to_group_list(gtable), dtype=object))
 
 
 
@@ -324,7 +774,84 @@ def load_groups(fname):
    gtable : astropy.Table
       table of groups
    '''
-   return group_list_to_table(np.load(fname))
+   if _is_hdf5(fname):
+      gtable, members, offsets = load_groups_hdf5(fname)
+      gtable['members'] = np.split(members, offsets[1:-1]) if len(gtable) > 0 else []
+      return gtable
+
+   return group_list_to_table(np.load(fname, allow_pickle=True))
+
+
+def save_groups_hdf5(fname, gtable, members=None, offsets=None):
+   '''
+   Save groups to an HDF5 file. The group properties are stored as
+   columns of the table /Groups and the memberships as one flat array
+   /members, where the members of group i are
+   members[offsets[i]:offsets[i+1]] with offsets in /offsets.
+
+   Parameters
+   ----------
+   fname : string
+      file name
+
+   gtable : astropy.Table
+      table of groups, from process_group_list() or process_group_labels()
+
+   members, offsets : numpy array (optional)
+      memberships in the form returned by process_group_labels(). If not
+      given they are taken from the 'members' column of gtable
+   '''
+   if members is None:
+      member_lst = [np.asarray(m) for m in gtable['members']]
+      sizes = np.array([len(m) for m in member_lst], dtype=np.int64)
+      members = np.concatenate(member_lst) if len(member_lst) > 0 else np.zeros(0, dtype=np.int64)
+      offsets = np.concatenate(([0], np.cumsum(sizes)))
+
+   columns = [c for c in gtable.colnames if c != 'members']
+   members = np.asarray(members)
+
+   with tb.open_file(fname, mode='w') as fileh:
+      fileh.create_table(fileh.root, 'Groups', obj=gtable[columns].as_array(),
+                         title='Friends of friends groups')
+      # extendable, so that zero members can be stored
+      earray = fileh.create_earray(fileh.root, 'members', atom=tb.Atom.from_dtype(members.dtype),
+                                   shape=(0,), expectedrows=max(len(members), 1),
+                                   filters=tb.Filters(complevel=4, complib='zlib'))
+      earray.append(members)
+      fileh.create_array(fileh.root, 'offsets', obj=np.asarray(offsets, dtype=np.int64))
+
+
+def load_groups_hdf5(fname, start=0, stop=None):
+   '''
+   Load groups saved with save_groups_hdf5(), optionally only the groups
+   with row numbers start to stop - 1
+
+   Parameters
+   ----------
+   fname : string
+      file name
+
+   start, stop : int (optional)
+      range of groups to read, defaults to all groups
+
+   Returns
+   -------
+   gtable : astropy.Table
+      table of group properties
+
+   members, offsets : numpy array
+      the members of group i in gtable are members[offsets[i]:offsets[i+1]]
+   '''
+   with tb.open_file(fname, mode='r') as fileh:
+      ngroups = fileh.root.Groups.nrows
+      start, stop, step = slice(start, stop).indices(ngroups)
+      stop = max(start, stop)
+
+      gtable = Table(fileh.root.Groups.read(start=start, stop=stop))
+      offsets = fileh.root.offsets[start:stop+1]
+      members = fileh.root.members[offsets[0]:offsets[-1]]
+
+   return gtable, members, offsets - offsets[0]
 
 
 
@@ -35,6 +35,10 @@ from regions import CircleSkyRegion, CirclePixelRegion
 from regions import LineSkyRegion, LinePixelRegion
 from regions import PixCoord
 
+from scipy.spatial import cKDTree
+
+from hetdex_api.survey import radec_to_unit_vectors, angle_to_chord
+
 
 # # Usage cases for galmask.py
 # 
@@ -269,8 +273,8 @@ def create_dummy_wcs(c1):
     ra_cen = c1.ra.deg
     dec_cen = c1.dec.deg
    
-    ndim = np.int(2 * gridsize / gridstep + 1)
-    center = np.int(ndim / 2)
+    ndim = int(2 * gridsize / gridstep + 1)
+    center = int(ndim / 2)
     w = wcs.WCS(naxis=2)
     w.wcs.crval = [ra_cen, dec_cen]
     w.wcs.crpix = [center, center]
@@ -339,6 +343,8 @@ def gals_flag_from_coords(coords, t, d25scale=1.0, nmatches=1):
         
     nmatches - the closest nmatches are searched for.  nmatches = 1 means search 
     the closest coordinate only.  nmatches = 3 is recommended
+
+    coords may hold an array of positions, in which case arrays are returned
     
     Returns
     -------
@@ -352,30 +358,39 @@ def gals_flag_from_coords(coords, t, d25scale=1.0, nmatches=1):
 
     """
 
-    gal_coords = SkyCoord(t['Coords'])
-    
-    # calculate angular distances to all of the sources, and pick out the n closest ones
-    d2d = coords.separation(gal_coords) 
-    ind1 = np.argsort(d2d)                # sort from closest to farthest away
-    id_close = ind1[0:nmatches]
-    
-    # create fake WCS for regions use
-    mywcs = create_dummy_wcs(coords)
+    gal_ra, gal_dec = _gal_radec(t)
+    nmatches = min(nmatches, len(t))
+
+    ra = np.atleast_1d(coords.ra.deg)
+    dec = np.atleast_1d(coords.dec.deg)
+
+    # find the n closest galaxies of every source
+    tree = cKDTree(radec_to_unit_vectors(gal_ra, gal_dec))
+    dist, id_close = tree.query(radec_to_unit_vectors(ra, dec), k=nmatches)
+    id_close = np.reshape(id_close, (len(ra), nmatches))
+
+    inside = ellipse_radius(ra[:, None], dec[:, None], gal_ra[id_close], gal_dec[id_close],
+                            np.asarray(t['SemiMajorAxis'], dtype=float)[id_close] * d25scale,
+                            np.asarray(t['SemiMinorAxis'], dtype=float)[id_close] * d25scale,
+                            np.asarray(t['PositionAngle'], dtype=float)[id_close]) <= 1.
+
+    # the farthest of the matching galaxies is reported
+    flag = np.any(inside, axis=1)
+    last = nmatches - 1 - np.argmax(inside[:, ::-1], axis=1)
+    idmatch = id_close[np.arange(len(ra)), last]
+
+    if coords.isscalar:
+        if flag[0]:
+            return (True, t['PGC'][idmatch[0]], t['NEDRedshift'][idmatch[0]])
+        else:
+            return (False, None, None)
+
+    source_name = np.where(flag, np.asarray(t['PGC'], dtype=object)[idmatch], None)
+    source_redshift = np.where(flag, np.asarray(t['NEDRedshift'], dtype=object)[idmatch], None)
 
-    flag            = False
-    source_name     = None
-    source_redshift = None
-    
-    for idnum in id_close:
-        ellipse = create_ellreg(t, idnum, d25scale = d25scale)
-        if (ellipse.contains(coords, mywcs)):
-            flag = True
-            source_name = t['PGC'][idnum]
-            source_redshift = t['NEDRedshift'][idnum]
-        
     return (flag, source_name, source_redshift)
 
-def show_ellipse_ring_source(t, index, coords, rings, outname, \ 
+def show_ellipse_ring_source(t, index, coords, rings, outname, \
 	image_survey='SDSSg', save_file=True, show_notebook=False): 
     
     '''For a single HETDEX near a galaxy, overplot the ellipsoidal rings from the RC3, along
@@ -730,57 +745,135 @@ def show_ellipse_ring_detect(t, index, tdetect, rings, outname, image_survey='SD
     plt.close()
 
 def check_all_large_gal(tboth, tdetect, scale, verbose=False):
-    
-    # Set up output arrays
-    ndetect = len(tdetect)
-    outTest = np.zeros(ndetect, dtype=bool)        # Set all to False intially
-    outRedshift = np.zeros(ndetect)
-    tempNames = []
-    for i in range(0,ndetect):
-        tempNames.append('NoGalaxy')
+    """ Check every source in tdetect against every galaxy ellipse in tboth.
+
+    tboth - a table of galaxy regions, similar to that found in read_rc3_tables
+    tdetect - a table of detections with detectid, ra and dec columns
+    scale - the scaling of the ellipses, 1.0 means use the D25 isophote
+
+    Returns (outTest, outNames, outRedshift), see large_gal_flags()
+    """
 
     # Safety margin - this can probably be reduced further, once we check things
     margin = 1.1
-    nprint = 50    # Number to print progress
-    
-    # Create skyCoord of detections
-    catalog = SkyCoord(tdetect['ra'], tdetect['dec'], unit = (u.deg, u.deg))
 
-    # Loop over each galaxy.  Create a subset of objects that are close to the galaxy, and then
-    # see if they fall within the ellipse. Close is defined as a fraction larger than the semi-major axis.
-        
-    ngals = len(tboth)
-    for i in range(0, ngals):
-        if (verbose):
-            if ((i % nprint) == 0):
-                print('Checking Galaxy: ', i, tboth['PGC'][i], tboth['Name1'][i])
-        c1 = SkyCoord(tboth['Coords'][i],frame='icrs')
-        rlimit = tboth['SemiMajorAxis'][i] * scale * margin * u.arcmin
-            
-        d2d = c1.separation(catalog)   # Find all of separations to the objects
-        catalogmsk = d2d < rlimit      # Create Boolean mask of objects inside of this rlimit value
-        if (len(catalogmsk) == 0):     # If there are no close sources, go on to the next galaxy
-            break
-        else:                          # Otherwise, loop over the sources, and look at the ellipses
-            near_sources = catalog[catalogmsk]
-            id_near_sources = tdetect['detectid'][catalogmsk]
-            for j in range(0, len(near_sources)):
-                coords = near_sources[j]
-                idtest = id_near_sources[j]
-                isclose, name, zgal = onegal_flag_from_coords(coords, tboth, i, d25scale = scale)
-                
-                if (isclose):
-                    ind2 = np.int(np.where(tdetect['detectid'] == idtest)[0])
-                    outTest[ind2]     = True
-                    tempNames[ind2]   = name
-                    outRedshift[ind2] = zgal
+    if (verbose):
+        print('Checking', len(tboth), 'galaxies against', len(tdetect), 'sources')
+
+    return large_gal_flags(np.asarray(tdetect['ra'], dtype=float),
+                           np.asarray(tdetect['dec'], dtype=float),
+                           tboth, d25scale=scale, margin=margin)
+
+
+def _gal_radec(t):
+    """
+    Return the ra/dec in degrees of the galaxy centres in t
+    """
+    gal_coords = SkyCoord(t['Coords'], frame='icrs')
+    return gal_coords.ra.deg, gal_coords.dec.deg
 
-                    
-    outNames = np.array(tempNames, dtype=object)
-    
-    return (outTest, outNames, outRedshift)       
 
+def ellipse_radius(ra, dec, gal_ra, gal_dec, semimajor, semiminor, pa):
+    """
+    Elliptical radius of positions relative to galaxy ellipses,
+    evaluated analytically in the tangent plane of each galaxy.
+    A value <= 1 means the position lies inside the ellipse.
+    All inputs broadcast against each other.
+
+    ra, dec - positions in degrees
+    gal_ra, gal_dec - galaxy centres in degrees
+    semimajor, semiminor - ellipse semi-axes in arcmin
+    pa - position angle of the major axis, north through east, in degrees
+    """
+
+    ra = np.deg2rad(ra)
+    dec = np.deg2rad(dec)
+    gal_ra = np.deg2rad(gal_ra)
+    gal_dec = np.deg2rad(gal_dec)
+    pa = np.deg2rad(pa)
+
+    # gnomonic projection about the galaxy centre, xi to the east
+    dra = ra - gal_ra
+    cosc = np.sin(gal_dec) * np.sin(dec) + np.cos(gal_dec) * np.cos(dec) * np.cos(dra)
+    xi = np.cos(dec) * np.sin(dra) / cosc
+    eta = (np.cos(gal_dec) * np.sin(dec) - np.sin(gal_dec) * np.cos(dec) * np.cos(dra)) / cosc
+
+    xi = np.rad2deg(xi) * 60.
+    eta = np.rad2deg(eta) * 60.
+
+    along_major = xi * np.sin(pa) + eta * np.cos(pa)
+    along_minor = xi * np.cos(pa) - eta * np.sin(pa)
+
+    return np.sqrt((along_major / semimajor)**2 + (along_minor / semiminor)**2)
+
+
+def large_gal_pairs(ra, dec, t, d25scale=1.0, margin=1.1):
+    """ Find all (galaxy, source) pairs where the source lies inside the
+    scaled ellipse of the galaxy.  Candidate pairs within margin times the
+    scaled semi-major axis are found with a KD tree of the sources, and
+    then tested with the analytic ellipse_radius().
+
+    ra, dec - source positions in degrees
+    t - a table of galaxy regions, similar to that found in read_rc3_tables
+    d25scale - the scaling of the ellipses, 1.0 means use the D25 isophote
+    margin - safety margin on the search radius
+
+    Returns arrays of galaxy indices and source indices, sorted by galaxy.
+    """
+
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+    dec = np.atleast_1d(np.asarray(dec, dtype=float))
+
+    if len(t) == 0 or len(ra) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    gal_ra, gal_dec = _gal_radec(t)
+    semimajor = np.asarray(t['SemiMajorAxis'], dtype=float) * d25scale
+    semiminor = np.asarray(t['SemiMinorAxis'], dtype=float) * d25scale
+    pa = np.asarray(t['PositionAngle'], dtype=float)
 
+    tree = cKDTree(radec_to_unit_vectors(ra, dec))
+    rlimit = angle_to_chord(semimajor * margin * u.arcmin)
+    near = tree.query_ball_point(radec_to_unit_vectors(gal_ra, gal_dec), rlimit)
+
+    nnear = np.array([len(n) for n in near], dtype=int)
+    gal_idx = np.repeat(np.arange(len(t)), nnear)
+    src_idx = np.concatenate([np.asarray(n, dtype=int) for n in near] + [np.zeros(0, dtype=int)])
+
+    inside = ellipse_radius(ra[src_idx], dec[src_idx], gal_ra[gal_idx], gal_dec[gal_idx],
+                            semimajor[gal_idx], semiminor[gal_idx], pa[gal_idx]) <= 1.
+
+    return gal_idx[inside], src_idx[inside]
+
+
+def large_gal_flags(ra, dec, t, d25scale=1.0, margin=1.1):
+    """ Vectorized large galaxy mask for arrays of positions.
+
+    ra, dec - source positions in degrees
+    t - a table of galaxy regions, similar to that found in read_rc3_tables
+    d25scale - the scaling of the ellipses, 1.0 means use the D25 isophote
+    margin - safety margin on the search radius
+
+    Returns (flag, names, redshifts).  flag is True for sources inside any
+    galaxy ellipse, names holds the t['PGC'] of the matched galaxy (or
+    'NoGalaxy') and redshifts its t['NEDRedshift'] (or 0).  If a source
+    lies in several ellipses the galaxy latest in t is reported.
+    """
+
+    ra = np.atleast_1d(np.asarray(ra, dtype=float))
+
+    flag = np.zeros(len(ra), dtype=bool)
+    names = np.array(['NoGalaxy'] * len(ra), dtype=object)
+    redshifts = np.zeros(len(ra))
+
+    gal_idx, src_idx = large_gal_pairs(ra, dec, t, d25scale=d25scale, margin=margin)
+
+    # pairs are sorted by galaxy, so later galaxies overwrite earlier ones
+    flag[src_idx] = True
+    names[src_idx] = np.asarray(t['PGC'])[gal_idx]
+    redshifts[src_idx] = np.asarray(t['NEDRedshift'])[gal_idx]
+
+    return (flag, names, redshifts)
 
 
 # Test cases here- change to True, if you want to run the tests.
@@ -793,8 +886,9 @@ test5  = False   # test5 - create an elliptical region from the galaxy table, an
 test6  = False   # test6 - test to see if we find objects near a specific galaxy, using the coordinates alone.
 test7  = False   # test7 - Look over the entire catalog to see if we find objects near a galaxy, using the coordinates alone.  
 test8  = False   # test8 - Plot a single source, overlaid on the ellipsoidal rings of a specific galaxy
-test9  = True    # test9 - Plot all the HETDEX sources around a particular galaxy 
-test10 = True    # test10 - search the entire detect list against the entire galaxy list
+test9  = False   # test9 - Plot all the HETDEX sources around a particular galaxy 
+test10 = False   # test10 - search the entire detect list against the entire galaxy list
+
 
 
 if (test1):
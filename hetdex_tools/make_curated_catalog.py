@@ -14,7 +14,23 @@ config = HDRconfig()
 # Note because refine is constantly updated, it isn't possible to
 # truly replicate older catalogs. TODO for HDR3
 
-detects = Detections(survey='hdr2.1', catalog_type='lines').refine()
+fields = ['cosmos', 'dex-fall', 'dex-spring', 'egs', 'goods-n']
+
+# push the row cuts shared by each version into the HDF5 read so only
+# candidate detections are loaded. The limits are a touch looser than the
+# exact selection below so float32 rounding in the scan never drops a row
+if version == '2.1.1':
+    query = '(chi2 < 1.201) & (wave > 3509.9) & (wave < 5490.1) & (linewidth < 6.001) ' \
+            '& (continuum > -3.001) & (sn > 4.799) & (chi2fib < 4.501)'
+elif version == '2.1.2':
+    query = '(chi2 < 1.201) & (wave > 3509.9) & (wave < 5490.1) & (linewidth < 14.001) ' \
+            '& (continuum > -3.001) & (sn > 4.799) & (chi2fib < 4.501)'
+else:
+    print("Provide a version : eg. 2.1.2")
+    sys.exit()
+
+detects = Detections(survey='hdr2.1', catalog_type='lines',
+                     query=query, field=fields).refine()
 
 sel_field = (detects.field == 'cosmos') |(detects.field == 'dex-fall') | (detects.field == 'dex-spring') | (detects.field == 'egs') | (detects.field == 'goods-n')
 
@@ -49,10 +65,6 @@ elif version == '2.1.2':
 
     sel_cat = sel1 | sel2
 
-else:
-    print("Provide a version : eg. 2.1.2")
-    sys.exit()
-
 det_table = detects.return_astropy_table()
 
 det_table[sel_cat].write('detect_hdr{}.tab'.format(version),
@@ -44,8 +44,8 @@ def get_regions_from_flim(shotid):
     ifu_dec = []
     ifuregions = []
 
-    for ifu_name, tscube in hdfcont.itercubes():
-        shape = tscube.sigmas.shape
+    for ifu_name, tscube in hdfcont.itercubes(lazy=True):
+        shape = tscube.shape
         ra, dec, lambda_ = tscube.wcs.all_pix2world(
             shape[2] / 2.0, shape[1] / 2.0, shape[0] / 2.0, 0
         )
@@ -64,12 +64,13 @@ ifu_dec = []
 
 sncut=6
 
-for ifu_name, tscube in hdfcont_hdr2.itercubes():
-    slice_ = tscube.f50_from_noise(tscube.sigmas[sel_slice, :, :], sncut)
+# only read the plotted slice of each IFU
+for ifu_name, tscube in hdfcont_hdr2.itercubes(lazy=True):
+    slice_ = tscube.f50_from_noise(tscube.get_slice(wave[sel_slice]), sncut)
     hdus.append( fits.PrimaryHDU( slice_*1e17, header=tscube.wcs.celestial.to_header()))
     hdus_mask.append( fits.PrimaryHDU( slice_.mask.astype(int), header=tscube.wcs.celestial.to_header()))
 
-    shape = tscube.sigmas.shape
+    shape = tscube.shape
     ra, dec, lambda_ = tscube.wcs.all_pix2world(shape[2]/2., shape[1]/2., shape[0]/2., 0)
     ifu_name_list.append(ifu_name)
     ifu_ra.append(ra)
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Regenerate the flux limit masks for a list of shots on one node
+
+hetdex_regenerate_flim_masks --shotlist shots.txt --outdir masks --nproc 24
+
+Each shot is masked with hetdex_api.mask.write_flim_mask() in a
+local process pool. The amp flag lookup, meteor table and bad shot
+lists are read once and handed to every worker when it starts, and
+each worker keeps one read-only handle on the FiberIndex file.
+
+A hash of the inputs of each shot is stored in its output file, so
+shots whose inputs have not changed are skipped on later runs. Masks
+are written to a temporary file and moved into place, so an
+interrupted run never leaves a partial mask behind.
+
+"""
+
+from __future__ import print_function
+
+import os
+import os.path as op
+import hashlib
+import argparse as ap
+from multiprocessing import Pool
+
+import numpy as np
+import tables as tb
+from astropy.table import Table
+
+from hetdex_api.config import HDRconfig
+from hetdex_api.mask import load_amp_flag_lookup, write_flim_mask, amp_flag_shot_slice
+from hetdex_api.flux_limits.hdf5_sensitivity_cubes import (SensitivityCubeHDF5Container,
+                                                           return_sensitivity_hdf_path,
+                                                           NoFluxLimsAvailable)
+
+# bump to force all masks to be remade
+FLIM_MASK_VERSION = 1
+
+# read-only inputs of each worker, set by _init_worker()
+_worker = {}
+
+
+def datevshot_from_shotid(shotid):
+    """ Convert a shotid like 20190201012 to 20190201v012 """
+    shotid = str(shotid)
+    return shotid[0:8] + "v" + shotid[8:].zfill(3)
+
+
+def shot_input_hash(shotid, flim_filename, lookup, met_tab, badshot):
+    """
+    Hash the inputs of one shot's mask: the flux limit file, the
+    amp flags and meteors of the shot and whether it is a bad shot
+
+    Parameters
+    ----------
+    shotid : int
+        the shot
+    flim_filename : str
+        path to the sensitivity cube HDF5 of the shot
+    lookup : dict
+        amp flag lookup from load_amp_flag_lookup()
+    met_tab : astropy.table.Table
+        meteor table
+    badshot : bool
+        whether the shot is masked completely
+
+    Returns
+    -------
+    hash : str
+    """
+
+    stat = os.stat(flim_filename)
+    sha = hashlib.sha1(
+        "{:d} {:d} {:s} {:d} {:d} {:d}".format(
+            FLIM_MASK_VERSION, shotid, op.abspath(flim_filename),
+            stat.st_size, stat.st_mtime_ns, int(badshot),
+        ).encode()
+    )
+
+    nmf = len(lookup["multiframes"])
+    if nmf > 0:
+        sl = amp_flag_shot_slice(lookup, shotid)
+        for mf in lookup["multiframes"][lookup["keys"][sl] % nmf]:
+            sha.update(mf.encode())
+        sha.update(lookup["flags"][sl].tobytes())
+
+    sel = np.asarray(met_tab["shotid"]) == shotid
+    sha.update(np.asarray(met_tab["a"], dtype=float)[sel].tobytes())
+    sha.update(np.asarray(met_tab["b"], dtype=float)[sel].tobytes())
+
+    return sha.hexdigest()
+
+
+def stored_input_hash(filename):
+    """
+    Return the input hash stored in a mask file, None if the file
+    does not exist or has no hash
+    """
+    if not op.isfile(filename):
+        return None
+
+    try:
+        with tb.open_file(filename, "r") as fileh:
+            return getattr(fileh.root._v_attrs, "input_hash", None)
+    except (tb.HDF5ExtError, OSError):
+        return None
+
+
+def _init_worker(lookup, met_tab, badshots, fiberindex_fn, release):
+    """
+    Keep the shared read-only inputs in the worker
+    """
+    _worker["lookup"] = lookup
+    _worker["met_tab"] = met_tab
+    _worker["badshots"] = badshots
+    _worker["release"] = release
+    _worker["fiberindex"] = tb.open_file(fiberindex_fn, mode="r")
+
+
+def _make_shot_mask(args):
+    """
+    Make the mask of one shot in a worker
+
+    Returns
+    -------
+    shotid : int
+    status : str
+        one of 'written', 'skipped', 'no flux limits' or an
+        error message
+    """
+
+    shotid, outdir, flim_filename, overwrite = args
+    datevshot = datevshot_from_shotid(shotid)
+
+    try:
+        if flim_filename is None:
+            flim_filename = return_sensitivity_hdf_path(datevshot,
+                                                        release=_worker["release"])
+    except NoFluxLimsAvailable:
+        return shotid, "no flux limits"
+
+    outfile = op.join(outdir, datevshot + "_mask.h5")
+    tmpfile = outfile + ".tmp{:d}".format(os.getpid())
+
+    try:
+        badshot = shotid in _worker["badshots"]
+        input_hash = shot_input_hash(shotid, flim_filename, _worker["lookup"],
+                                     _worker["met_tab"], badshot)
+
+        if not overwrite and stored_input_hash(outfile) == input_hash:
+            return shotid, "skipped"
+
+        sid = int(shotid)
+        fiber_table = Table(_worker["fiberindex"].root.FiberIndex.read_where("shotid == sid"))
+
+        flimhdf = SensitivityCubeHDF5Container(filename=flim_filename,
+                                               aper_corr=1.0,
+                                               flim_model="hdr2pt1")
+        try:
+            write_flim_mask(shotid, flimhdf, tmpfile, fiber_table,
+                            bad_amps_table=_worker["lookup"],
+                            met_tab=_worker["met_tab"],
+                            badshot=badshot)
+        finally:
+            flimhdf.close()
+
+        with tb.open_file(tmpfile, "a") as fileh:
+            fileh.root._v_attrs.input_hash = input_hash
+
+        os.replace(tmpfile, outfile)
+
+    except Exception as e:
+        if op.isfile(tmpfile):
+            os.remove(tmpfile)
+        return shotid, "failed: {}".format(e)
+
+    return shotid, "written"
+
+
+def regenerate_flim_masks(shotids, outdir, nproc=1, release=None,
+                          flim_filenames=None, badamp=None, meteor=None,
+                          badshots=None, fiberindex_fn=None, overwrite=False):
+    """
+    Make the flux limit masks of many shots in a process pool
+
+    Parameters
+    ----------
+    shotids : list of int
+        shots to mask
+    outdir : str
+        directory for the {datevshot}_mask.h5 files
+    nproc : int
+        number of worker processes
+    release : str (optional)
+        data release, default is HDRconfig.LATEST_HDR_NAME
+    flim_filenames : dict (optional)
+        sensitivity cube file of each shotid, default is
+        return_sensitivity_hdf_path()
+    badamp, meteor, fiberindex_fn : str (optional)
+        amp flag, meteor and FiberIndex files, default from HDRconfig
+    badshots : array (optional)
+        shots to mask completely, default is config.badshot
+        and config.lowtpshots
+    overwrite : bool
+        remake masks even if their inputs are unchanged
+
+    Returns
+    -------
+    status : astropy.table.Table
+        shotid and status of each shot
+    """
+
+    if release is None:
+        release = HDRconfig.LATEST_HDR_NAME
+
+    config = HDRconfig(release)
+
+    if badamp is None:
+        badamp = config.badamp
+    if meteor is None:
+        meteor = config.meteor
+    if fiberindex_fn is None:
+        fiberindex_fn = config.fiberindexh5
+    if badshots is None:
+        badshots = np.concatenate(
+            (np.loadtxt(config.badshot, dtype=int, ndmin=1),
+             np.loadtxt(config.lowtpshots, dtype=int, ndmin=1))
+        )
+    if flim_filenames is None:
+        flim_filenames = {}
+
+    if not op.isdir(outdir):
+        os.makedirs(outdir)
+
+    # read the inputs afresh, as they decide which masks are remade
+    initargs = (load_amp_flag_lookup(badamp, reload=True),
+                Table.read(meteor, format="ascii"),
+                frozenset(int(s) for s in badshots), fiberindex_fn, release)
+
+    tasks = [(int(shotid), outdir, flim_filenames.get(int(shotid)), overwrite)
+             for shotid in shotids]
+
+    results = []
+    if nproc > 1:
+        with Pool(nproc, initializer=_init_worker, initargs=initargs) as pool:
+            for result in pool.imap_unordered(_make_shot_mask, tasks):
+                print(*result)
+                results.append(result)
+    else:
+        _init_worker(*initargs)
+        try:
+            for task in tasks:
+                result = _make_shot_mask(task)
+                print(*result)
+                results.append(result)
+        finally:
+            _worker.pop("fiberindex").close()
+
+    results.sort()
+
+    return Table(rows=results, names=["shotid", "status"],
+                 dtype=[np.int64, str])
+
+
+def get_parser():
+    """ function that returns a parser from argparse """
+
+    parser = ap.ArgumentParser(
+        description="""Regenerate flux limit masks for a list of shots""",
+        add_help=True,
+    )
+
+    parser.add_argument(
+        "-s",
+        "--shotlist",
+        help="""Text file with one shotid per line, e.g. 20190201012""",
+        type=str,
+        required=True,
+    )
+
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        help="""Directory to write the masks to""",
+        type=str,
+        default=".",
+    )
+
+    parser.add_argument(
+        "-n",
+        "--nproc",
+        help="""Number of processes""",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--release",
+        help="""Data release, e.g. hdr2.1""",
+        type=str,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--overwrite",
+        help="""Remake masks even if their inputs are unchanged""",
+        action="store_true",
+    )
+
+    return parser
+
+
+def main(argv=None):
+
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    shotids = np.loadtxt(args.shotlist, dtype=int, ndmin=1)
+
+    status = regenerate_flim_masks(shotids, args.outdir, nproc=args.nproc,
+                                   release=args.release, overwrite=args.overwrite)
+
+    for value in np.unique(status["status"]):
+        print("{:s}: {:d}".format(value, np.sum(status["status"] == value)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+
+Test the vectorized amplifier classification
+
+"""
+import pytest
+import numpy as np
+from hetdex_api.mask_tools.amplifier_positions import (amp_corners, amp_from_ifu_xy,
+                                                       ifu_amp_from_fplane_xy)
+
+
+class _IFU(object):
+    def __init__(self, ifuslot, x, y):
+        self.ifuslot = ifuslot
+        self.x = x
+        self.y = y
+
+
+class _FPlane(object):
+    def __init__(self, ifus):
+        self.ifus = ifus
+
+
+def test_amp_from_ifu_xy_rectangle_centres():
+    """ The centre of every rectangle is assigned to its amp """
+
+    x = []
+    y = []
+    expected = []
+    for amp, rects in amp_corners.items():
+        for rect in rects:
+            x.append(np.mean(rect[0]))
+            y.append(np.mean(rect[1]))
+            expected.append(amp)
+
+    assert np.array_equal(amp_from_ifu_xy(x, y), expected)
+
+
+@pytest.mark.parametrize("ifuslot, x, y, expected", [
+                                   ("063", 20.0, 5.0, "RL"),
+                                   ("095", 20.0, -5.0, "RU"),
+                                   ("095", -20.0, 20.0, "LU"),
+                                   ("046", -20.0, 20.0, "RL"),
+                                   (46, -20.0, 20.0, "RL"),
+                                   ("046", 20.0, 5.0, "RU"),
+                                   ("063", 40.0, 0.0, ""),
+                                  ])
+def test_amp_from_ifu_xy_swapped(ifuslot, x, y, expected):
+    """ Swapped around amps are reported by their real name """
+    assert amp_from_ifu_xy(x, y, ifuslot=ifuslot) == expected
+
+
+def test_ifu_amp_from_fplane_xy():
+    """ Positions are assigned to the IFU they fall on """
+
+    fplane = _FPlane([_IFU("063", 0.0, 0.0), _IFU("095", 100.0, 0.0)])
+
+    # the IFU axes are flipped with respect to the tangent plane
+    x = np.array([20.0, 20.0, 50.0])
+    y = np.array([-5.0, 95.0, 50.0])
+
+    ifuslot, amp = ifu_amp_from_fplane_xy(x, y, fplane)
+
+    assert list(ifuslot) == ["063", "095", ""]
+    assert list(amp) == ["LL", "RU", ""]
@@ -0,0 +1,176 @@
+"""
+
+Tests for the Detections class helpers
+
+"""
+import pytest
+import numpy as np
+import tables as tb
+from hetdex_api.detections import Detections, query_string_from_limits
+
+
+class Limits(object):
+    """ A Det_limits style object with nothing set """
+    def __init__(self, **kwargs):
+        for name in ["wave", "flux", "linewidth", "sn", "chi2", "cont"]:
+            setattr(self, name + "_low", None)
+            setattr(self, name + "_high", None)
+        self.aperture_flag = False
+        self.ra = None
+        self.dec = None
+        self.rad = None
+        self.field = ["all"]
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+
+@pytest.fixture(scope="function")
+def detects_table(tmpdir):
+    """ A small detections table with values on the limits """
+    rng = np.random.RandomState(7)
+    n = 200
+
+    data = np.zeros(n, dtype=[("detectid", "i8"), ("wave", "f4"), ("flux", "f4"),
+                              ("linewidth", "f4"), ("sn", "f4"), ("chi2", "f4"),
+                              ("continuum", "f4")])
+    data["detectid"] = np.arange(n)
+    data["wave"] = rng.choice([3500.0, 4000.1, 4500.0, 5000.2, 5500.0], n)
+    data["flux"] = rng.choice([3.3, 5.0, 10.7, 20.0], n)
+    data["linewidth"] = rng.choice([1.7, 2.0, 6.0, 9.9], n)
+    data["sn"] = rng.choice([4.8, 5.5, 6.1, 7.0], n)
+    data["chi2"] = rng.choice([0.9, 1.2, 3.0], n)
+    data["continuum"] = rng.choice([-1.0, 0.1, 2.5], n)
+
+    fn = tmpdir.join("detect.h5").strpath
+    with tb.open_file(fn, "w") as fileh:
+        fileh.create_table(fileh.root, "Detections", obj=data)
+
+    return fn
+
+
+@pytest.mark.parametrize("kwargs", [
+    dict(wave_low=4000.1, wave_high=5000.2),
+    dict(flux_low=3.3, flux_high=20.0, sn_low=5.5, sn_high=7.0),
+    dict(linewidth_low=1.7, linewidth_high=9.9, chi2_low=0.9, chi2_high=3.0),
+    dict(cont_low=-1.0, cont_high=2.5, wave_low=3500.0, wave_high=5500.0),
+])
+def test_query_string_from_limits(detects_table, kwargs):
+    """
+    Reading the rows selected by the condition and
+    applying query_by_dictionary() gives the same
+    detections as the cut on the full table
+    """
+    limits = Limits(**kwargs)
+    query = query_string_from_limits(limits)
+
+    full = Detections.__new__(Detections)
+    subset = Detections.__new__(Detections)
+    with tb.open_file(detects_table) as fileh:
+        table = fileh.root.Detections
+        rows = table.get_where_list(query)
+        for name in table.colnames:
+            setattr(full, name, table.col(name))
+            setattr(subset, name, table.read_coordinates(rows, field=name))
+
+    expected = full.detectid[full.query_by_dictionary(limits)]
+
+    # the condition keeps every detection of the cut
+    assert 0 < len(expected) < len(full.detectid)
+    assert np.all(np.isin(expected, subset.detectid))
+
+    detectid = subset.detectid[subset.query_by_dictionary(limits)]
+    assert np.array_equal(detectid, expected)
+
+
+def test_query_string_from_limits_string():
+    """
+    Strict inequalities, and numpy limits are
+    written as plain floats numexpr can parse
+    """
+    limits = Limits(wave_low=3500, sn_high=np.float32(6.1))
+    assert query_string_from_limits(limits) == \
+        "(wave > 3500.0) & (sn < 6.099999904632568)"
+
+
+def test_query_string_from_limits_nothing_set():
+    """ No condition without any limits """
+    assert query_string_from_limits(Limits()) is None
+
+
+def test_query_string_from_limits_aperture():
+    """ The aperture is reduced to a declination band """
+    limits = Limits(aperture_flag=True, ra=150.0, dec=2.0, rad=3.0)
+    assert query_string_from_limits(limits) == "(dec > 1.95) & (dec < 2.05)"
+
+
+@pytest.fixture(scope="function")
+def detects(tmpdir, datadir, monkeypatch):
+    """ Detections of the test shot, with the cube found by its datevshot """
+    from hetdex_api.flux_limits import selection_function
+
+    def return_sensitivity_hdf_path(datevshot, release=None, return_mask_fn=False):
+        return datadir.join("test_hdf.h5").strpath, None
+
+    monkeypatch.setattr(selection_function, "return_sensitivity_hdf_path",
+                        return_sensitivity_hdf_path)
+
+    rng = np.random.RandomState(3)
+    n = 20
+
+    data = np.zeros(n, dtype=[("detectid", "i8"), ("shotid", "i8"), ("ra", "f8"),
+                              ("dec", "f8"), ("wave", "f4"), ("flux", "f4"),
+                              ("ifuslot", "S3")])
+    data["detectid"] = np.arange(n)
+    data["shotid"] = 20181203013
+    data["ra"] = 161.4244 + rng.uniform(-0.015, 0.015, n)
+    data["dec"] = 50.8816 + rng.uniform(-0.015, 0.015, n)
+    data["wave"] = rng.uniform(3471.0, 3487.0, n)
+    data["flux"] = rng.uniform(1.0, 50.0, n)
+    data["ifuslot"] = b"063"
+
+    fn = tmpdir.join("detect.h5").strpath
+    with tb.open_file(fn, "w") as fileh:
+        fileh.create_table(fileh.root, "Detections", obj=data)
+
+    detects = Detections.__new__(Detections)
+    detects.survey = "hdr2.1"
+    detects.hdfile = tb.open_file(fn)
+    for name in data.dtype.names:
+        setattr(detects, name, detects.hdfile.root.Detections.col(name))
+    detects.ifuslot = detects.ifuslot.astype(str)
+    for name in ["fwhm", "throughput", "field", "n_ifu"]:
+        setattr(detects, name, np.zeros(n))
+
+    yield detects
+
+    detects.hdfile.close()
+
+
+def test_add_flux_limits(detects):
+    """
+    The flux limits of the detections are added,
+    and kept by slicing and in the output table
+    """
+    from hetdex_api.flux_limits.selection_function import detection_flux_limits
+
+    detects.add_flux_limits(sncut=5.0)
+
+    flims = detection_flux_limits(detects.shotid, detects.ra, detects.dec, detects.wave,
+                                  5.0, flux=1e-17*detects.flux.astype(float),
+                                  ifuslot=detects.ifuslot,
+                                  release="hdr2.1")
+
+    assert np.any(detects.f50 < 999)
+    assert np.array_equal(detects.f50, flims["f50"])
+    assert np.array_equal(detects.flim_sigma, flims["sigma"])
+    assert np.array_equal(detects.completeness, flims["completeness"])
+
+    sel = detects.flux > 20.0
+    sliced = detects[sel]
+    for name in ["f50", "flim_sigma", "completeness"]:
+        assert np.array_equal(getattr(sliced, name), getattr(detects, name)[sel])
+
+    table = sliced.return_astropy_table()
+    assert np.array_equal(table["detectid"], detects.detectid[sel])
+    for name in ["f50", "flim_sigma", "completeness"]:
+        assert np.array_equal(table[name], getattr(sliced, name))
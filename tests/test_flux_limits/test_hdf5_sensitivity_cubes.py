@@ -11,8 +11,10 @@ from shutil import copy
 from os.path import isfile
 import pytest
 from hetdex_api.flux_limits.hdf5_sensitivity_cubes import (SensitivityCubeHDF5Container, 
+                                                           SensitivityCubeCache,
                                                            add_sensitivity_cube_to_hdf5,
                                                            extract_sensitivity_cube,
+                                                           rewrite_sensitivity_hdf5,
                                                            return_sensitivity_hdf_path) 
 from hetdex_api.flux_limits.sensitivity_cube import SensitivityCube
 
@@ -142,6 +144,120 @@ def test_flim_model(datadir):
     assert abs(s1 - s2) > 1e-19
 
 
+def test_lazy_cube(hdf5_container, sensitivity_cube):
+    """
+    Test that lazily read cubes give the 
+    same results while reading less data
+    """
+    import numpy as np
+
+    hdf5_container.add_sensitivity_cube("shot_19690720v11", "ifuslot_000", 
+                                        sensitivity_cube)
+    scube = hdf5_container.extract_ifu_sensitivity_cube("ifuslot_000")
+    lcube = hdf5_container.extract_ifu_sensitivity_cube("ifuslot_000", lazy=True)
+    assert lcube.shape == scube.shape
+
+    ra, dec, wl = 161.4201, 50.8822, 3480.0
+    assert lcube.get_f50(ra, dec, wl, 5.0) == pytest.approx(scube.get_f50(ra, dec, wl, 5.0))
+
+    slice_ = lcube.get_slice(wl)
+    ix, iy, iz = scube.radecwltoxyz(ra, dec, wl)
+    assert np.array_equal(slice_, scube.sigmas[iz])
+
+    # one pixel and one slice read
+    assert lcube._lazy_sigmas.nread == 1 + scube.shape[1]*scube.shape[2]
+
+    slice_ = hdf5_container.get_slice("ifuslot_000", wl)
+    assert np.array_equal(slice_, scube.sigmas[iz])
+
+    compl = lcube.return_wlslice_completeness([1e-16, 5e-16], 3474.0, 3480.0, 5.0)
+    assert compl == pytest.approx(scube.return_wlslice_completeness([1e-16, 5e-16], 
+                                                                    3474.0, 3480.0, 5.0))
+
+    # whole cube read on first use of sigmas
+    assert np.array_equal(lcube.sigmas.filled(), scube.sigmas.filled())
+
+def test_cube_cache(datadir):
+    """
+    Test that extracted cubes are cached, and
+    shared between containers
+    """
+    import numpy as np
+
+    filename = datadir.join("test_hdf.h5").strpath
+
+    with SensitivityCubeHDF5Container(filename, cache_size=1) as hdcon:
+        scube1 = hdcon.extract_ifu_sensitivity_cube("ifuslot_063")
+        assert hdcon.extract_ifu_sensitivity_cube("ifuslot_063") is scube1
+
+        # lazy cube pushes the other out of the cache
+        lcube = hdcon.extract_ifu_sensitivity_cube("ifuslot_063", lazy=True)
+        assert hdcon.extract_ifu_sensitivity_cube("ifuslot_063", lazy=True) is lcube
+        assert hdcon.extract_ifu_sensitivity_cube("ifuslot_063") is not scube1
+
+    # off by default, so changing a cube doesn't change later ones
+    with SensitivityCubeHDF5Container(filename) as hdcon:
+        scube1 = hdcon.extract_ifu_sensitivity_cube("ifuslot_063")
+        sigmas = scube1.sigmas.data.copy()
+        scube1.apply_flux_recalibration(2.0)
+        scube2 = hdcon.extract_ifu_sensitivity_cube("ifuslot_063")
+        assert scube2 is not scube1
+        assert np.array_equal(scube2.sigmas.data, sigmas)
+
+    cache = SensitivityCubeCache(4)
+    with SensitivityCubeHDF5Container(filename, cube_cache=cache) as hdcon:
+        scube1 = hdcon.extract_ifu_sensitivity_cube("ifuslot_063")
+        hdcon.extract_ifu_sensitivity_cube("ifuslot_063", lazy=True)
+        assert len(cache) == 2
+
+    # lazy cubes are dropped when the file closes
+    assert len(cache) == 1
+
+    with SensitivityCubeHDF5Container(filename, cube_cache=cache) as hdcon:
+        assert hdcon.extract_ifu_sensitivity_cube("ifuslot_063") is scube1
+
+    with SensitivityCubeHDF5Container(filename, cube_cache=cache, flim_model="hdr1") as hdcon:
+        assert hdcon.extract_ifu_sensitivity_cube("ifuslot_063") is not scube1
+
+    # lazy cubes aren't shared between containers of the same file
+    hdcon1 = SensitivityCubeHDF5Container(filename, cube_cache=cache)
+    lcube1 = hdcon1.extract_ifu_sensitivity_cube("ifuslot_063", lazy=True)
+    with SensitivityCubeHDF5Container(filename, cube_cache=cache) as hdcon2:
+        lcube2 = hdcon2.extract_ifu_sensitivity_cube("ifuslot_063", lazy=True)
+        assert lcube2 is not lcube1
+
+        # and still work when the other container closes
+        hdcon1.close()
+        assert lcube2.get_slice(3480.0).shape == lcube2.shape[1:]
+        assert hdcon2.extract_ifu_sensitivity_cube("ifuslot_063", lazy=True) is lcube2
+
+
+@pytest.mark.parametrize("complib, layout, chunkshape", [("zlib", "slice", (8, 70, 70)),
+                                                          ("blosc:lz4", "spectrum", (10, 8, 8))])
+def test_rewrite_sensitivity_hdf5(tmpdir, datadir, complib, layout, chunkshape):
+    """
+    Test rewriting a container with a new
+    codec and chunk layout
+    """
+    import numpy as np
+
+    h5fn = datadir.join("test_hdf.h5").strpath
+    outfn = tmpdir.join("rewritten.h5").strpath
+
+    rewrite_sensitivity_hdf5(h5fn, outfn, complib=complib, chunk_layout=layout)
+
+    with SensitivityCubeHDF5Container(h5fn) as hdfin, \
+         SensitivityCubeHDF5Container(outfn) as hdfout:
+        node = hdfout.h5file.get_node("/virus_20181203v013/ifuslot_063")
+        assert node.chunkshape == chunkshape
+        assert node.filters.complib == complib
+
+        scube_in = hdfin.extract_ifu_sensitivity_cube("ifuslot_063")
+        scube_out = hdfout.extract_ifu_sensitivity_cube("ifuslot_063")
+        assert np.array_equal(scube_in.sigmas.filled(), scube_out.sigmas.filled())
+        assert scube_in.header == scube_out.header
+
+
 @pytest.mark.parametrize("datevshot", ["20181203v013", "20191023v024"])
 def test_return_sensitivity_hdf_path(datevshot):
     """ Test the correct path is returned """
@@ -0,0 +1,152 @@
+"""
+
+Tests for the survey-wide selection function
+
+"""
+import pytest
+import numpy as np
+from hetdex_api.flux_limits.hdf5_sensitivity_cubes import SensitivityCubeHDF5Container
+from hetdex_api.flux_limits.sensitivity_cube import SensitivityCube
+from hetdex_api.flux_limits.selection_function import (build_footprint_index,
+                                                       SurveySelectionFunction,
+                                                       detection_flux_limits)
+
+
+@pytest.fixture(scope="function")
+def two_shots(tmpdir, datadir):
+    """ Two shots covering the same IFU """
+    fn1 = datadir.join("test_hdf.h5").strpath
+    fn2 = tmpdir.join("test_shot2.h5").strpath
+
+    scube = SensitivityCube.from_file(datadir.join("test_sensitivity_cube.fits").strpath,
+                                      [3500.0, 5500.0], [-3.5, -3.5])
+    with SensitivityCubeHDF5Container(fn2, mode="w") as hdfcont:
+        hdfcont.add_sensitivity_cube("virus_20190101v001", "ifuslot_063", scube)
+
+    return {"20181203v013": fn1, "20190101v001": fn2}
+
+
+@pytest.mark.parametrize("combine", ["max", "any", "per_shot"])
+def test_selection_function(two_shots, combine):
+    """
+    Compare the survey selection function to the
+    completeness of each cube
+    """
+    footprints = build_footprint_index(list(two_shots), filenames=two_shots)
+    assert len(footprints) == 2
+
+    rng = np.random.default_rng(1)
+    n = 300
+    ra = footprints["ra"][0] + rng.uniform(-0.02, 0.02, n)
+    dec = footprints["dec"][0] + rng.uniform(-0.02, 0.02, n)
+    wave = rng.uniform(3471.0, 3487.0, n)
+    flux = rng.uniform(1e-17, 5e-16, n)
+
+    expected = []
+    for fn in two_shots.values():
+        with SensitivityCubeHDF5Container(fn) as hdfcont:
+            scube = hdfcont.extract_ifu_sensitivity_cube("ifuslot_063")
+            ix, iy, iz = scube.radecwltoxyz(ra, dec, wave)
+            inside = (ix >= 0) & (ix < scube.shape[2]) & (iy >= 0) & (iy < scube.shape[1])
+            expected.append(np.where(inside, scube.return_completeness(flux, ra, dec,
+                                                                       wave, 5.0), 0.0))
+
+    sfunc = SurveySelectionFunction(footprints, filenames=two_shots)
+    compl = sfunc.completeness(flux, ra, dec, wave, 5.0, combine=combine)
+
+    if combine == "max":
+        assert compl == pytest.approx(np.maximum(*expected))
+    elif combine == "any":
+        assert compl == pytest.approx(1.0 - (1.0 - expected[0])*(1.0 - expected[1]))
+    else:
+        for i, datevshot in enumerate(two_shots):
+            sel = compl["datevshot"] == datevshot
+            got = np.zeros(n)
+            got[compl["source"][sel]] = compl["completeness"][sel]
+            assert got == pytest.approx(expected[i])
+
+    # sources away from the footprints
+    assert np.all(sfunc.completeness(flux[:5], ra[:5] + 10.0, dec[:5], wave[:5], 5.0) == 0)
+
+
+@pytest.mark.parametrize("use_ifuslot", [True, False])
+def test_detection_flux_limits(two_shots, use_ifuslot):
+    """
+    Compare the batch flux limits of detections to
+    looking them up one cube at a time
+    """
+    rng = np.random.default_rng(2)
+    n = 200
+    shotid = rng.choice([20181203013, 20190101001, 20200101001], n)
+    ra = 161.4244 + rng.uniform(-0.015, 0.015, n)
+    dec = 50.8816 + rng.uniform(-0.015, 0.015, n)
+    wave = rng.uniform(3471.0, 3487.0, n)
+    flux = rng.uniform(1e-17, 5e-16, n)
+    ifuslot = np.full(n, "063") if use_ifuslot else None
+
+    flims = detection_flux_limits(shotid, ra, dec, wave, 5.0, flux=flux, ifuslot=ifuslot,
+                                  filenames=two_shots)
+
+    # no flux limits for the last shot
+    assert np.all(flims["f50"][shotid == 20200101001] == 999.0)
+
+    for sid, fn in zip([20181203013, 20190101001], two_shots.values()):
+        sel = shotid == sid
+        with SensitivityCubeHDF5Container(fn) as hdfcont:
+            scube = hdfcont.extract_ifu_sensitivity_cube("ifuslot_063")
+            f50 = scube.get_f50(ra[sel], dec[sel], wave[sel], 5.0)
+            compl = scube.return_completeness(flux[sel], ra[sel], dec[sel], wave[sel], 5.0)
+
+        inside = f50 < 999.0
+        assert 0 < inside.sum() < sel.sum()
+        assert flims["f50"][sel] == pytest.approx(f50)
+        assert flims["completeness"][sel][inside] == pytest.approx(compl[inside])
+        assert np.all(flims["ifuslot"][sel][inside] == "ifuslot_063")
+
+
+def test_selection_function_empty_index(two_shots):
+    """ An index without footprints covers no sources """
+    footprints = build_footprint_index([], filenames=two_shots)
+    assert len(footprints) == 0
+
+    sfunc = SurveySelectionFunction(footprints, filenames=two_shots)
+    isource, ifoot = sfunc.route([161.4244], [50.8816])
+    assert len(isource) == len(ifoot) == 0
+    assert np.all(sfunc.completeness([1e-16, 2e-16], [161.4244, 161.43], [50.8816, 50.88],
+                                     [3480.0, 3480.0], 5.0) == 0)
+
+
+@pytest.mark.parametrize("use_masks", [True, False])
+def test_selection_function_mask_filenames(tmpdir, two_shots, use_masks):
+    """ Shots given by filename are masked with mask_filenames """
+    import tables as tb
+
+    with SensitivityCubeHDF5Container(two_shots["20190101v001"]) as hdfcont:
+        ny, nx = hdfcont.extract_ifu_sensitivity_cube("ifuslot_063", lazy=True).shape[1:]
+
+    mask_fn = tmpdir.join("test_shot2_mask.h5").strpath
+    with tb.open_file(mask_fn, "w") as fileh:
+        group = fileh.create_group(fileh.root, "Mask")
+        fileh.create_array(group, "ifuslot_063", np.zeros((ny, nx), dtype=int))
+
+    footprints = build_footprint_index(list(two_shots), filenames=two_shots)
+    sfunc = SurveySelectionFunction(footprints, filenames=two_shots, use_masks=use_masks,
+                                    mask_filenames={"20190101v001": mask_fn})
+
+    rng = np.random.default_rng(3)
+    n = 50
+    ra = footprints["ra"][0] + rng.uniform(-0.005, 0.005, n)
+    dec = footprints["dec"][0] + rng.uniform(-0.005, 0.005, n)
+    compl = sfunc.completeness(np.full(n, 5e-16), ra, dec, np.full(n, 3480.0), 5.0,
+                               combine="per_shot")
+    unmasked = SurveySelectionFunction(footprints, filenames=two_shots).completeness(
+        np.full(n, 5e-16), ra, dec, np.full(n, 3480.0), 5.0, combine="per_shot")
+
+    # masked pixels have the noise of the fill value, 999
+    masked = compl["datevshot"] == "20190101v001"
+    assert compl["completeness"][~masked] == pytest.approx(unmasked["completeness"][~masked])
+    assert unmasked["completeness"][masked].max() > 0.5
+    if use_masks:
+        assert np.all(compl["completeness"][masked] < 1e-4)
+    else:
+        assert compl["completeness"][masked] == pytest.approx(unmasked["completeness"][masked])
@@ -84,3 +84,100 @@ def test_flux_calib_corr(datadir, plot=False):
     # Check something happened
     assert ratio != pytest.approx(1.0)
 
+
+
+@pytest.mark.parametrize("cd", [None, [[-2.7e-4, 1.1e-4], [0.9e-4, 2.5e-4]]])
+def test_world2pix_matches_wcs(datadir, cd):
+    """
+    Test the precomputed world to pixel mapping
+    against astropy's WCS
+    """
+    import numpy as np
+    from astropy.io import fits
+
+    filename = datadir.join("test_sensitivity_cube.fits").strpath
+    sigmas = fits.getdata(filename)
+    header = fits.getheader(filename)
+
+    if cd is not None:
+        header["CD1_1"], header["CD1_2"] = cd[0]
+        header["CD2_1"], header["CD2_2"] = cd[1]
+
+    scube = SensitivityCube(sigmas, header, [3500.0, 5500.0], [-3.5, -3.5])
+    assert scube._pixel_mapping is not None
+
+    rng = np.random.default_rng(2)
+    ra = header["CRVAL1"] + rng.uniform(-0.05, 0.05, 10000)
+    dec = header["CRVAL2"] + rng.uniform(-0.05, 0.05, 10000)
+    wl = rng.uniform(3470.0, 5500.0, 10000)
+
+    x, y, z = scube.world2pix(ra, dec, wl)
+    xw, yw, zw = scube.wcs.wcs_world2pix(ra, dec, wl, 0)
+
+    assert x == pytest.approx(xw, abs=1e-6)
+    assert y == pytest.approx(yw, abs=1e-6)
+    assert z == pytest.approx(zw, abs=1e-6)
+
+
+def test_mask_applied_at_lookup(datadir):
+    """
+    Test that the 2D mask gives the same noise
+    as filling the masked cube
+    """
+    import numpy as np
+    from astropy.io import fits
+
+    filename = datadir.join("test_sensitivity_cube.fits").strpath
+    sigmas = fits.getdata(filename)
+    header = fits.getheader(filename)
+
+    rng = np.random.default_rng(3)
+    mask = rng.uniform(size=sigmas.shape[1:]) > 0.3
+
+    scube = SensitivityCube(sigmas, header, [3500.0, 5500.0], [-3.5, -3.5],
+                            mask=mask)
+    filled = scube.sigmas.filled()
+
+    iz = rng.integers(0, sigmas.shape[0], 1000)
+    iy = rng.integers(0, sigmas.shape[1], 1000)
+    ix = rng.integers(0, sigmas.shape[2], 1000)
+
+    assert np.array_equal(scube.noise_at(ix, iy, iz), filled[iz, iy, ix])
+    assert np.array_equal(scube.noise_slice(10, 20), filled[10:20])
+
+
+@pytest.mark.parametrize("max_elements", [100000, 100])
+def test_wlslice_completeness_curves(datadir, max_elements):
+    """
+    Test the completeness curves of many slices
+    against a loop over fluxes
+    """
+    import numpy as np
+    from hetdex_api.flux_limits.sensitivity_cube import fleming_function
+
+    filename = datadir.join("test_sensitivity_cube.fits").strpath
+    scube = SensitivityCube.from_file(filename, [3500.0, 5500.0], [-3.5, -3.5])
+
+    flux = np.logspace(-17, -15, 30)
+    lambda_low = np.array([3470.0, 3474.0, 3480.0])
+    lambda_high = lambda_low + 4.0
+
+    curves = scube.return_wlslice_completeness_curves(flux, lambda_low, lambda_high, 5.0,
+                                                      max_elements=max_elements)
+    assert curves.shape == (3, 30)
+
+    for i in range(3):
+        compl = scube.return_wlslice_completeness(flux, lambda_low[i], lambda_high[i], 5.0,
+                                                  max_elements=max_elements)
+        assert curves[i] == pytest.approx(compl, rel=1e-12)
+
+        ix, iy, izlo = scube.radecwltoxyz(scube.wcs.wcs.crval[0], scube.wcs.wcs.crval[1],
+                                          lambda_low[i])
+        ix, iy, izhigh = scube.radecwltoxyz(scube.wcs.wcs.crval[0], scube.wcs.wcs.crval[1],
+                                            lambda_high[i])
+        noise = scube.sigmas.filled()[izlo:(izhigh + 1)]
+        f50s = scube.f50_from_noise(noise[(noise < 1e-16) & np.isfinite(noise)], 5.0)
+        alpha = scube.alpha_func(0.5*(lambda_low[i] + lambda_high[i]))
+
+        expected = [np.mean(np.nan_to_num(fleming_function(f, f50s, alpha))) for f in flux]
+        assert curves[i] == pytest.approx(expected, rel=1e-12)
@@ -0,0 +1,140 @@
+"""
+
+Test the friends of friends group finders
+
+"""
+import numpy as np
+from hetdex_tools.fof_kdtree import mktree, frinds_of_friends, friends_of_friends_sparse
+
+
+def test_sparse_fof_matches_fof():
+    """ Both group finders find the same groups in the same size order """
+
+    rng = np.random.default_rng(42)
+    x = rng.uniform(0, 500, 5000)
+    y = rng.uniform(0, 500, 5000)
+    z = np.zeros_like(x)
+
+    kdtree, r = mktree(x, y, z, dsky=3.0, euclidean=True)
+
+    group_lst = frinds_of_friends(kdtree, r, Nmin=2)
+    group_lst_sparse = friends_of_friends_sparse(kdtree, r, Nmin=2)
+
+    assert [len(g) for g in group_lst] == [len(g) for g in group_lst_sparse]
+    assert (set(tuple(sorted(g)) for g in group_lst)
+            == set(tuple(g) for g in group_lst_sparse))
+
+
+def test_sparse_fof_includes_last_particle():
+    """ The last particle can be part of a group """
+
+    x = np.array([0.0, 100.0, 200.0, 201.0])
+    y = np.zeros_like(x)
+
+    kdtree, r = mktree(x, y, y, dsky=3.0, euclidean=True)
+    group_lst = friends_of_friends_sparse(kdtree, r, Nmin=2)
+
+    assert len(group_lst) == 1
+    assert list(group_lst[0]) == [2, 3]
+
+
+def test_process_group_labels_matches_process_group_list():
+    """ The vectorized group properties agree with evaluate_group() """
+    from hetdex_tools.fof_kdtree import fof_labels, process_group_list, process_group_labels
+
+    rng = np.random.default_rng(1)
+    ra = rng.uniform(150.0, 150.2, 5000)
+    dec = rng.uniform(50.0, 50.2, 5000)
+    wave = rng.uniform(3500.0, 5500.0, 5000)
+    flux = rng.uniform(1.0, 5.0, 5000)
+    detectid = np.arange(5000) + 2100000000
+
+    kdtree, r = mktree(ra, dec, wave, dsky=15.0, dwave=300.0)
+
+    group_table = process_group_list(friends_of_friends_sparse(kdtree, r),
+                                     detectid, ra, dec, wave, flux)
+    gtable, members, offsets = process_group_labels(fof_labels(kdtree, r),
+                                                    detectid, ra, dec, wave, flux)
+
+    assert len(gtable) == len(group_table) > 0
+    for name in gtable.colnames:
+        assert np.allclose(gtable[name], np.asarray(group_table[name], dtype=float))
+    for i in range(len(gtable)):
+        assert np.array_equal(members[offsets[i]:offsets[i + 1]], group_table['members'][i])
+
+
+def test_tiled_fof_matches_single_tree():
+    """ Stitching the tiles gives the labels of one tree """
+    from hetdex_tools.fof_kdtree import fof_labels, fof_labels_tiled
+
+    rng = np.random.default_rng(7)
+    x = rng.uniform(0, 1000, 20000)
+    y = rng.uniform(0, 1000, 20000)
+    z = np.zeros_like(x)
+
+    kdtree, r = mktree(x, y, z, dsky=3.0, euclidean=True)
+
+    labels = fof_labels_tiled(x, y, z, dsky=3.0, euclidean=True, tile_size=100.0)
+
+    assert np.array_equal(fof_labels(kdtree, r), labels)
+
+
+def test_groups_hdf5_roundtrip(tmp_path):
+    """ Groups saved to HDF5 load back completely and by range """
+    from hetdex_tools.fof_kdtree import (fof_labels, process_group_labels,
+                                         save_groups_hdf5, load_groups_hdf5)
+
+    rng = np.random.default_rng(3)
+    x = rng.uniform(0, 300, 5000)
+    y = rng.uniform(0, 300, 5000)
+    z = np.zeros_like(x)
+
+    kdtree, r = mktree(x, y, z, dsky=3.0, euclidean=True)
+    gtable, members, offsets = process_group_labels(fof_labels(kdtree, r), np.arange(5000),
+                                                    x, y, z, np.ones_like(x), Nmin=2,
+                                                    euclidean=True)
+    assert len(gtable) > 20
+
+    fname = str(tmp_path / "groups.h5")
+    save_groups_hdf5(fname, gtable, members, offsets)
+
+    gtable2, members2, offsets2 = load_groups_hdf5(fname)
+    assert np.array_equal(gtable2['size'], gtable['size'])
+    assert np.array_equal(members2, members)
+    assert np.array_equal(offsets2, offsets)
+
+    gtable3, members3, offsets3 = load_groups_hdf5(fname, start=10, stop=20)
+    assert np.array_equal(gtable3['id'], gtable['id'][10:20])
+    assert np.array_equal(members3, members[offsets[10]:offsets[20]])
+    assert np.array_equal(offsets3, offsets[10:21] - offsets[10])
+
+
+def test_groups_hdf5_roundtrip_empty(tmp_path):
+    """ A friends of friends result without groups can be saved and loaded """
+    from hetdex_tools.fof_kdtree import (fof_labels, process_group_labels, process_group_list,
+                                         save_groups, load_groups, save_groups_hdf5,
+                                         load_groups_hdf5)
+
+    x = np.array([0.0, 100.0, 200.0])
+    y = np.zeros_like(x)
+
+    kdtree, r = mktree(x, y, y, dsky=3.0, euclidean=True)
+    gtable, members, offsets = process_group_labels(fof_labels(kdtree, r), np.arange(3),
+                                                    x, y, y, np.ones_like(x), Nmin=2,
+                                                    euclidean=True)
+    assert len(gtable) == 0
+
+    fname = str(tmp_path / "groups.h5")
+    save_groups_hdf5(fname, gtable, members, offsets)
+
+    gtable2, members2, offsets2 = load_groups_hdf5(fname)
+    assert len(gtable2) == 0
+    assert len(members2) == 0
+    assert np.array_equal(offsets2, [0])
+
+    fname = str(tmp_path / "groups_table.h5")
+    gtable = process_group_list(friends_of_friends_sparse(kdtree, r), np.arange(3),
+                                x, y, y, np.ones_like(x))
+    assert len(gtable) == 0
+    save_groups(fname, gtable)
+    assert len(load_groups(fname)) == 0
@@ -0,0 +1,90 @@
+"""
+
+Test the vectorized large galaxy mask against the
+one source at a time check with astropy regions
+
+"""
+import pytest
+import numpy as np
+from astropy.table import Table
+from astropy.coordinates import SkyCoord
+
+pytest.importorskip("regions")
+pytest.importorskip("astroquery")
+
+from hetdex_tools.galmask import (onegal_flag_from_coords, ellipse_radius,
+                                  large_gal_pairs, large_gal_flags,
+                                  check_all_large_gal)
+
+
+@pytest.fixture(scope="module")
+def galaxies():
+    """ A small table of galaxies, two of them overlapping """
+    ra = [150.0, 150.02, 210.0, 30.0]
+    dec = [2.0, 2.01, 55.0, -20.0]
+    coords = SkyCoord(ra, dec, unit="deg").to_string("hmsdms")
+
+    return Table([coords, [1.2, 0.8, 2.5, 0.6], [0.4, 0.5, 1.0, 0.5],
+                  [30.0, 100.0, 160.0, 0.0], [101, 102, 103, 104],
+                  [0.01, 0.02, 0.003, 0.005]],
+                 names=["Coords", "SemiMajorAxis", "SemiMinorAxis",
+                        "PositionAngle", "PGC", "NEDRedshift"])
+
+
+@pytest.fixture(scope="module")
+def sources(galaxies):
+    """ Sources scattered around the galaxies """
+    rng = np.random.default_rng(3)
+    gal = SkyCoord(galaxies["Coords"])
+    igal = rng.integers(0, len(galaxies), 400)
+    ra = gal.ra.deg[igal] + rng.uniform(-1.5, 1.5, 400)/60.0/np.cos(gal.dec.rad[igal])
+    dec = gal.dec.deg[igal] + rng.uniform(-1.5, 1.5, 400)/60.0
+
+    return Table([np.arange(400) + 2100000000, ra, dec], names=["detectid", "ra", "dec"])
+
+
+@pytest.mark.parametrize("d25scale", [1.0, 1.5])
+def test_large_gal_flags(galaxies, sources, d25scale):
+    """ Compare to onegal_flag_from_coords() for every source and galaxy """
+
+    coords = SkyCoord(sources["ra"], sources["dec"], unit="deg")
+    gal = SkyCoord(galaxies["Coords"])
+
+    # the dummy WCS only works close to the galaxy, as in check_all_large_gal()
+    inside = np.zeros((len(galaxies), len(sources)), dtype=bool)
+    for i in range(len(galaxies)):
+        for j in np.flatnonzero(gal[i].separation(coords).arcmin < 10.0):
+            inside[i, j] = onegal_flag_from_coords(coords[j], galaxies, i,
+                                                   d25scale=d25scale)[0]
+
+    assert 0 < inside.sum() < len(sources)
+    assert inside.sum(axis=0).max() > 1
+
+    # elliptical radius
+    radius = ellipse_radius(sources["ra"][None, :], sources["dec"][None, :],
+                            gal.ra.deg[:, None], gal.dec.deg[:, None],
+                            galaxies["SemiMajorAxis"][:, None]*d25scale,
+                            galaxies["SemiMinorAxis"][:, None]*d25scale,
+                            galaxies["PositionAngle"][:, None])
+    assert np.array_equal(radius <= 1.0, inside)
+
+    # pairs
+    gal_idx, src_idx = large_gal_pairs(sources["ra"], sources["dec"], galaxies,
+                                       d25scale=d25scale)
+    assert np.all(np.diff(gal_idx) >= 0)
+    assert set(zip(gal_idx, src_idx)) == set(zip(*np.nonzero(inside)))
+
+    # flags, the galaxy latest in the table is reported
+    flag, names, redshifts = large_gal_flags(sources["ra"], sources["dec"], galaxies,
+                                             d25scale=d25scale)
+    assert np.array_equal(flag, inside.any(axis=0))
+
+    last = len(galaxies) - 1 - np.argmax(inside[::-1], axis=0)
+    assert np.all(names[flag] == np.asarray(galaxies["PGC"])[last[flag]])
+    assert np.all(names[~flag] == "NoGalaxy")
+    assert redshifts[flag] == pytest.approx(np.asarray(galaxies["NEDRedshift"])[last[flag]])
+    assert np.all(redshifts[~flag] == 0)
+
+    outTest, outNames, outRedshift = check_all_large_gal(galaxies, sources, d25scale)
+    assert np.array_equal(outTest, flag)
+    assert np.all(outNames == names)
@@ -0,0 +1,173 @@
+"""
+
+Tests for the vectorized masking helpers
+
+"""
+import pytest
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from hetdex_api.mask import (flag_in_intervals, flag_in_boxes,
+                             meteor_distance_from_radec)
+
+
+def test_flag_in_intervals_matches_loop():
+    """
+    Compare against the per-interval loop it
+    replaces, including overlapping intervals
+    and keys with no intervals
+    """
+    rng = np.random.RandomState(42)
+
+    interval_keys = rng.choice(["multi_a", "multi_b", "multi_c"], 40)
+    low = rng.randint(20170101, 20170301, 40)
+    high = low + rng.randint(0, 60, 40)
+
+    keys = rng.choice(["multi_a", "multi_b", "multi_c", "multi_d"], 1000)
+    values = rng.randint(20170101, 20170401, 1000)
+
+    expected = np.zeros(1000, dtype=bool)
+    for key, lo, hi in zip(interval_keys, low, high):
+        expected |= (keys == key) & (values >= lo) & (values <= hi)
+
+    flag = flag_in_intervals(keys, values, interval_keys, low, high)
+
+    assert np.array_equal(flag, expected)
+
+
+def test_flag_in_intervals_no_intervals():
+    """ Nothing is flagged if there are no intervals """
+    flag = flag_in_intervals(["a", "b"], [1, 2], [], [], [])
+    assert not np.any(flag)
+
+
+def test_flag_in_boxes_matches_loop():
+    """
+    Compare the box join against a loop over
+    the boxes, including overlapping boxes
+    """
+    rng = np.random.RandomState(7)
+
+    box_keys = rng.choice(["multi_a", "multi_b", "multi_c"], 30)
+    x1 = rng.randint(0, 1000, 30)
+    x2 = x1 + rng.randint(0, 100, 30)
+    y1 = rng.randint(0, 1000, 30)
+    y2 = y1 + rng.randint(0, 100, 30)
+
+    keys = rng.choice(["multi_a", "multi_b", "multi_c", "multi_d"], 5000)
+    x = rng.randint(0, 1032, 5000)
+    y = rng.randint(0, 1032, 5000)
+
+    expected = np.zeros(5000, dtype=bool)
+    for key, xl, xh, yl, yh in zip(box_keys, x1, x2, y1, y2):
+        expected |= (keys == key) & (x >= xl) & (x <= xh) & (y >= yl) & (y <= yh)
+
+    flag = flag_in_boxes(keys, x, y, box_keys, x1, x2, y1, y2)
+
+    assert np.any(expected)
+    assert np.array_equal(flag, expected)
+
+
+@pytest.mark.parametrize("a, b, ra0", [(58.7236404, 1.88234169E-02, 10.0),
+                                       (182.943863, -6.71583080, 20.0),
+                                       (-2277.91968, 15.2037601, 152.0)])
+def test_meteor_distance(a, b, ra0):
+    """
+    Compare the analytic distance to a streak with
+    the closest of many points sampled along it
+    """
+    dec0 = a + b*ra0 + 5.0/3600.0
+    coord = SkyCoord(ra0*u.deg, dec0*u.deg)
+
+    ra_met = ra0 + np.linspace(-60, 60, 200001)/3600.0
+    met_coords = SkyCoord(ra_met*u.deg, (a + b*ra_met)*u.deg)
+    expected = np.min(coord.separation(met_coords).arcsec)
+
+    dist = 3600.0*meteor_distance_from_radec(ra0, dec0, a, b)
+
+    assert dist == pytest.approx(expected, abs=0.01)
+
+
+def test_amp_flag_lookup():
+    """
+    Batch amp flags from the lookup agree with a
+    row by row search of the table
+    """
+    from astropy.table import Table
+    from hetdex_api.mask import (amp_flag_from_shotid_multiframe,
+                                 amp_flag_from_fiberids,
+                                 amp_flag_from_fiberid,
+                                 build_amp_flag_lookup,
+                                 amp_flag_shot_slice)
+
+    bad_amps = Table()
+    bad_amps["shotid"] = [20180124010, 20180124010, 20190201012, 20190201012]
+    bad_amps["multiframe"] = ["multi_319_083_023_LL", "multi_319_083_023_RU",
+                              "multi_319_083_023_LL", "multi_051_105_051_RL"]
+    bad_amps["flag"] = [1, 0, 0, 1]
+
+    flags = amp_flag_from_shotid_multiframe(bad_amps["shotid"],
+                                            bad_amps["multiframe"],
+                                            bad_amps_table=bad_amps)
+    assert np.array_equal(flags, bad_amps["flag"].astype(bool))
+
+    fiberids = ["20190201012_1_multi_051_105_051_RL_045",
+                "20180124010_1_multi_319_083_023_RU_001",
+                "20180124010_1_multi_051_105_051_RL_045"]
+
+    flags = amp_flag_from_fiberids(fiberids, bad_amps_table=bad_amps,
+                                   missing=True)
+    assert np.array_equal(flags, [True, False, True])
+
+    assert amp_flag_from_fiberid(fiberids[0], bad_amps)
+    with pytest.raises(IndexError):
+        amp_flag_from_fiberid(fiberids[2], bad_amps)
+
+    # the amps of one shot
+    lookup = build_amp_flag_lookup(bad_amps)
+    nmf = len(lookup["multiframes"])
+    for shotid in [20180124009, 20180124010, 20190201012, 20190201013]:
+        sl = amp_flag_shot_slice(lookup, shotid)
+        sel = bad_amps["shotid"] == shotid
+        assert (sorted(lookup["multiframes"][lookup["keys"][sl] % nmf])
+                == sorted(bad_amps["multiframe"][sel]))
+        assert np.all(lookup["keys"][sl] // nmf == shotid)
+
+
+def test_amp_flag_lookup_reloads_changed_file(tmpdir):
+    """
+    The lookup of an amp flag file is rebuilt when
+    the file is rewritten in place
+    """
+    import os
+    from astropy.table import Table
+    from hetdex_api import mask
+    from hetdex_api.mask import load_amp_flag_lookup, amp_flag_from_shotid_multiframe
+
+    filename = tmpdir.join("amp_flag.fits").strpath
+    bad_amps = Table([[20190201012], ["multi_319_083_023_LL"], [1]],
+                     names=["shotid", "multiframe", "flag"])
+    bad_amps.write(filename)
+
+    lookup = load_amp_flag_lookup(filename)
+    assert load_amp_flag_lookup(filename) is lookup
+    nlookups = len(mask._amp_flag_lookups)
+    assert amp_flag_from_shotid_multiframe(20190201012, "multi_319_083_023_LL",
+                                           bad_amps_table=lookup)[0]
+
+    bad_amps["flag"][0] = 0
+    bad_amps.add_row([20190201012, "multi_051_105_051_RL", 1])
+    bad_amps.write(filename, overwrite=True)
+    mtime = os.stat(filename).st_mtime_ns
+    os.utime(filename, ns=(mtime, mtime + 1))
+
+    lookup = load_amp_flag_lookup(filename)
+    assert not amp_flag_from_shotid_multiframe(20190201012, "multi_319_083_023_LL",
+                                               bad_amps_table=lookup)[0]
+    assert load_amp_flag_lookup(filename, reload=True) is not lookup
+
+    # only one entry is kept per file and only the last table passed
+    assert len(mask._amp_flag_lookups) == nlookups
+    amp_flag_from_shotid_multiframe(20190201012, "multi_319_083_023_LL",
+                                    bad_amps_table=bad_amps)
+    assert mask._amp_flag_table_lookup[0] is bad_amps
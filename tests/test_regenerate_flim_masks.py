@@ -0,0 +1,113 @@
+"""
+
+Test that the flux limit mask driver only remakes
+masks whose inputs have changed
+
+"""
+import os
+import pytest
+import numpy as np
+import tables as tb
+from astropy.table import Table
+from hetdex_tools.regenerate_flim_masks import (regenerate_flim_masks, shot_input_hash,
+                                                stored_input_hash)
+
+SHOTID = 20181203013
+
+
+@pytest.fixture(scope="function")
+def inputs(tmpdir, datadir):
+    """ Amp flags, meteors and fibers with nothing to mask in the shot """
+
+    badamp = Table()
+    badamp["shotid"] = [SHOTID, 20190101001]
+    badamp["multiframe"] = ["multi_319_083_023_LL", "multi_319_083_023_LL"]
+    badamp["flag"] = [1, 0]
+    badamp_fn = tmpdir.join("amp_flag.fits").strpath
+    badamp.write(badamp_fn)
+
+    meteor = Table([[20190101001], [10.0], [0.5]], names=["shotid", "a", "b"])
+    meteor_fn = tmpdir.join("meteor.txt").strpath
+    meteor.write(meteor_fn, format="ascii")
+
+    fiberindex_fn = tmpdir.join("fiber_index.h5").strpath
+    with tb.open_file(fiberindex_fn, "w") as fileh:
+        fileh.create_table(fileh.root, "FiberIndex",
+                           obj=np.array([(SHOTID, 161.4, 50.9)],
+                                        dtype=[("shotid", "i8"), ("ra", "f8"),
+                                               ("dec", "f8")]))
+
+    return dict(flim_filenames={SHOTID: datadir.join("test_hdf.h5").strpath},
+                badamp=badamp_fn, meteor=meteor_fn, fiberindex_fn=fiberindex_fn,
+                badshots=[])
+
+
+def test_shot_input_hash(inputs):
+    """ The hash only depends on the inputs of the shot """
+    from hetdex_api.mask import build_amp_flag_lookup
+
+    badamp = Table.read(inputs["badamp"])
+    met_tab = Table.read(inputs["meteor"], format="ascii")
+    flim_fn = inputs["flim_filenames"][SHOTID]
+
+    hash1 = shot_input_hash(SHOTID, flim_fn, build_amp_flag_lookup(badamp),
+                            met_tab, False)
+    assert shot_input_hash(SHOTID, flim_fn, build_amp_flag_lookup(badamp),
+                           met_tab, False) == hash1
+    assert shot_input_hash(SHOTID, flim_fn, build_amp_flag_lookup(badamp),
+                           met_tab, True) != hash1
+
+    # amps and meteors of other shots don't matter
+    badamp["flag"][1] = 1
+    met_tab["a"][0] = 11.0
+    assert shot_input_hash(SHOTID, flim_fn, build_amp_flag_lookup(badamp),
+                           met_tab, False) == hash1
+
+    badamp["flag"][0] = 0
+    assert shot_input_hash(SHOTID, flim_fn, build_amp_flag_lookup(badamp),
+                           met_tab, False) != hash1
+
+
+def test_regenerate_flim_masks(tmpdir, inputs):
+    """ Unchanged shots are skipped, changed ones rewritten """
+
+    outdir = tmpdir.join("masks").strpath
+    outfile = os.path.join(outdir, "20181203v013_mask.h5")
+
+    status = regenerate_flim_masks([SHOTID], outdir, **inputs)
+    assert list(status["status"]) == ["written"]
+
+    input_hash = stored_input_hash(outfile)
+    assert input_hash is not None
+    with tb.open_file(outfile) as fileh:
+        assert np.all(fileh.root.Mask.ifuslot_063.read() == 1)
+
+    mtime = os.stat(outfile).st_mtime_ns
+    status = regenerate_flim_masks([SHOTID], outdir, **inputs)
+    assert list(status["status"]) == ["skipped"]
+    assert os.stat(outfile).st_mtime_ns == mtime
+
+    status = regenerate_flim_masks([SHOTID], outdir, overwrite=True, **inputs)
+    assert list(status["status"]) == ["written"]
+    assert stored_input_hash(outfile) == input_hash
+
+    # a new amp flag of the shot, written to the same file,
+    # changes its inputs
+    badamp = Table.read(inputs["badamp"])
+    badamp.add_row([SHOTID, "multi_051_105_051_RL", 1])
+    badamp.write(inputs["badamp"], overwrite=True)
+
+    status = regenerate_flim_masks([SHOTID], outdir, **inputs)
+    assert list(status["status"]) == ["written"]
+    assert stored_input_hash(outfile) != input_hash
+
+    # and so does a meteor in the shot
+    input_hash = stored_input_hash(outfile)
+    meteor = Table.read(inputs["meteor"], format="ascii")
+    meteor.add_row([SHOTID, 60.0, -0.1])
+    meteor.write(inputs["meteor"], format="ascii", overwrite=True)
+
+    status = regenerate_flim_masks([SHOTID], outdir, **inputs)
+    assert list(status["status"]) == ["written"]
+    assert stored_input_hash(outfile) != input_hash
+    assert not any(f.startswith("20181203v013_mask.h5.tmp") for f in os.listdir(outdir))